@@ -0,0 +1,583 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Single-threaded HTTP server, built on asyncore.
+#
+# The threaded server ties up a thread (and its stack) for as long as each
+# stream is playing. This server instead handles all connections, and collects
+# the output of all encoders, in a single event loop. Rate shaping is done with
+# timers instead of by sleeping.
+#
+# Requests other than audio streams are passed to the regular request handler
+# (see zeya.ZeyaHandler), which runs against the request data in memory.
+
+import StringIO
+import asyncore
+import fcntl
+import heapq
+import itertools
+import os
+import socket
+import time
+
+import backends
+import encoders
+
+# Maximum amount of time to wait for an event when no timers are pending.
+POLL_TIMEOUT = 30.0
+# Maximum size of the request line and headers.
+MAX_REQUEST_SIZE = 65536
+# How often to check whether processes we're waiting for have exited.
+REAP_INTERVAL = 0.05
+
+class OutputBuffer(StringIO.StringIO):
+    """
+    In-memory stand-in for a request handler's wfile. The handler closes its
+    wfile when it's done, but we still need to read its contents afterwards.
+    """
+    def close(self):
+        pass
+
+def AsyncHandler(handler_class):
+    """
+    Return a subclass of handler_class (as returned by zeya.ZeyaHandler) that
+    handles a request which has already been read, and collects its response
+    in memory. Requests for audio streams are only parsed. They are recorded in
+    the content_request attribute, to be served by the event loop. Likewise,
+    the body of a static.Resource is left in the body_chunks attribute, so it
+    can be sent without copying all of it into memory.
+    """
+    class AsyncHandlerImpl(handler_class):
+        def setup(self):
+            self.connection = None
+            self.rfile = StringIO.StringIO(self.request)
+            self.wfile = OutputBuffer()
+            self.content_request = None
+            self.body_chunks = None
+
+        def finish(self):
+            pass
+
+        def address_string(self):
+            # Don't block the event loop with a reverse DNS lookup.
+            return self.client_address[0]
+
+        def serve_content(self, query):
+            self.content_request = self.parse_content_query(query)
+
+        def send_body(self, chunks):
+            self.body_chunks = chunks
+
+        def start_prefetch(self, key, format, bitrate, client):
+            # Start the encoder, and any encoder that has to wait for a slot,
+            # in the event loop.
+            server = self.server
+            server.backend.prefetch_content(
+                key, bitrate, client, start_transcode=server.start_transcode,
+                call_soon=lambda function: server.call_later(0, function),
+                format=format)
+
+        def take_output(self):
+            """
+            Return the output written so far, and clear it.
+            """
+            data = self.wfile.getvalue()
+            self.wfile = OutputBuffer()
+            return data
+
+    return AsyncHandlerImpl
+
+class FileSource(object):
+    """
+    Reads part of a file, with the same interface as backends.TranscodeReader.
+    """
+    def __init__(self, fd, offset, length):
+        self._fd = fd
+        self._offset = offset
+        self._remaining = length
+
+    def read(self, max_bytes):
+        if self._remaining <= 0:
+            return ''
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        data = os.read(self._fd, min(max_bytes, self._remaining))
+        if not data:
+            # The file is shorter than we expected.
+            self._remaining = 0
+        self._offset += len(data)
+        self._remaining -= len(data)
+        return data
+
+    def at_end(self):
+        return self._remaining <= 0
+
+class ChunkSource(object):
+    """
+    Reads the concatenation of the strings produced by an iterable, with the
+    same interface as backends.TranscodeReader.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._finished = False
+
+    def read(self, max_bytes):
+        while not self._buffer and not self._finished:
+            try:
+                self._buffer = self._chunks.next()
+            except StopIteration:
+                self._finished = True
+        data = self._buffer[:max_bytes]
+        self._buffer = self._buffer[max_bytes:]
+        return data
+
+    def at_end(self):
+        return self._finished and not self._buffer
+
+class TranscodeCollector(asyncore.file_dispatcher):
+    """
+    Collects the output of a backends.SharedTranscode in the event loop.
+    """
+    def __init__(self, transcode, server):
+        asyncore.dispatcher.__init__(self, map=server.socket_map)
+        self._server = server
+        self._transcode = transcode
+        # Number of bytes of decoder output still to be discarded before the
+        # encoder is started.
+        self._skip_remaining = transcode.skip_bytes
+        self._finished = False
+        if self._skip_remaining > 0:
+            self._watch(transcode.decoder.stdout)
+        else:
+            self._start_encoder()
+
+    def _watch(self, fileobj):
+        fd = fileobj.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.set_file(fd)
+
+    def _start_encoder(self):
+        transcode = self._transcode
+        if self.socket is not None:
+            self.del_channel()
+            self.socket.close()
+            self.socket = None
+            # The encoder reads the rest of the decoder output itself, and
+            # doesn't expect a non-blocking pipe.
+            fd = transcode.decoder.stdout.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        if not transcode.start_encoder():
+            self._server.reap([transcode.decoder],
+                              lambda success: self._finish(False))
+            return
+        self._watch(transcode.encoder.stdout)
+
+    def _finish(self, success):
+        if not self._finished:
+            self._finished = True
+            self._transcode.finish(success)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        if self._skip_remaining > 0:
+            data = self.recv(min(self._skip_remaining,
+                                 backends.STREAM_CHUNK_SIZE))
+            if data:
+                self._skip_remaining -= len(data)
+                if self._skip_remaining == 0:
+                    self._start_encoder()
+        else:
+            data = self.recv(backends.STREAM_CHUNK_SIZE)
+            if data:
+                self._transcode.add_output(data)
+
+    def handle_close(self):
+        self.close()
+        transcode = self._transcode
+        if self._skip_remaining > 0:
+            # The decoder exited before producing as much output as we were
+            # asked to skip.
+            transcode.stop()
+            self._server.reap([transcode.decoder],
+                              lambda success: self._finish(False))
+        else:
+            # The encoder has closed its output, so it's about to exit.
+            transcode.encoder.stdout.close()
+            self._server.reap([transcode.encoder, transcode.decoder],
+                              self._finish)
+
+    def handle_error(self):
+        nil, t, v, tbinfo = asyncore.compact_traceback()
+        print "Error: couldn't run encoder: %s" % (v,)
+        self.close()
+        transcode = self._transcode
+        transcode.stop()
+        processes = [transcode.decoder]
+        if transcode.encoder is not None:
+            processes.append(transcode.encoder)
+        self._server.reap(processes, lambda success: self._finish(False))
+
+class SlotUnavailableError(Exception):
+    """
+    Indicates that a stream has to wait for a free encoder slot.
+    """
+
+class HTTPChannel(asyncore.dispatcher):
+    """
+    A single client connection.
+    """
+    def __init__(self, sock, client_address, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        self._client_address = client_address
+        self._server = server
+        self._request_data = ''
+        self._handler = None
+        # Data waiting to be sent.
+        self._out = ''
+        # Object from which the response body is read (a FileSource,
+        # ChunkSource, or TranscodeReader), if it is not all in self._out.
+        self._source = None
+        self._limiter = None
+        self._chunk_size = backends.STREAM_CHUNK_SIZE
+        # Measures how fast the client accepts the response body.
+        self._meter = backends.ThroughputMeter()
+        # Set while we're waiting to be allowed to send more data.
+        self._paused = False
+        # TranscodeReader for a buffered stream whose encoder hasn't finished
+        # yet.
+        self._pending_reader = None
+        # Objects to clean up when the connection is closed.
+        self._reader = None
+        self._file = None
+        # Set when the whole response has been queued in self._out.
+        self._done = False
+        # SlotWaiter for the encoder slot we're waiting for, and the
+        # parameters of the stream that needs it.
+        self._waiter = None
+        self._content_request = None
+        # MIME type of the audio stream we're serving.
+        self._content_type = None
+        self._closed = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        self._fill()
+        return bool(self._out) or self._done
+
+    def handle_read(self):
+        data = self.recv(8192)
+        if self._handler is not None:
+            # Ignore anything sent after the request headers.
+            return
+        self._request_data += data
+        if '\r\n\r\n' in self._request_data or '\n\n' in self._request_data:
+            self._handle_request()
+        elif len(self._request_data) > MAX_REQUEST_SIZE:
+            self._cleanup()
+            self.close()
+
+    def _handle_request(self):
+        handler = self._server.handler_class(
+            self._request_data, self._client_address, self._server)
+        self._handler = handler
+        self._out = handler.take_output()
+        if handler.body_chunks is not None:
+            self._source = ChunkSource(handler.body_chunks)
+            self._limiter = backends.RateLimiter(None)
+            self._chunk_size = backends.UNSHAPED_CHUNK_SIZE
+        elif handler.content_request is None:
+            self._done = True
+        else:
+            self._start_content(*handler.content_request)
+
+    def _start_content(self, key, buffered, shaped, start, prefetch, format,
+                       bitrate, client, slot=None):
+        """
+        Begin serving an audio stream (see ZeyaHandler.serve_content). slot is
+        the TranscodeSlot we've been granted, if we had to wait for one.
+        """
+        server = self._server
+        handler = self._handler
+        slots = server.backend.transcode_slots
+        self._content_type = encoders.content_types[format]
+        self._meter = handler.make_meter(self.socket)
+        self._limiter = backends.RateLimiter(bitrate if shaped else None)
+        if not shaped:
+            self._chunk_size = backends.UNSHAPED_CHUNK_SIZE
+        acquire_slot = None
+        if slots is not None:
+            granted = [slot]
+            def acquire_slot():
+                if granted[0] is not None:
+                    slot = granted[0]
+                    granted[0] = None
+                    return slot
+                slot = slots.try_acquire(client, prefetch)
+                if slot is None:
+                    raise SlotUnavailableError()
+                return slot
+        try:
+            content = server.backend.open_content(
+                key, bitrate, start, client=client,
+                start_transcode=server.start_transcode,
+                acquire_slot=acquire_slot, format=format)
+        except SlotUnavailableError:
+            # Wait for a slot without blocking the event loop, and try again
+            # when we get one.
+            self._content_request = (key, buffered, shaped, start, prefetch,
+                                     format, bitrate, client)
+            self._waiter = slots.wait(
+                client, prefetch,
+                lambda slot: server.call_later(
+                    0, lambda: self._slot_granted(slot)))
+            server.call_later(slots.max_wait, self._slot_timeout)
+            return
+        except (KeyError, ValueError):
+            print "Received invalid request for key %r" % (key,)
+            content = None
+        except backends.StreamGenerationError, e:
+            print "Error: %s" % (e,)
+            content = None
+        finally:
+            # Give back the slot we were granted if we ended up not needing
+            # it after all.
+            if slot is not None and granted[0] is not None:
+                granted[0].release()
+        if content is None:
+            # Send an empty stream, as the threaded server does.
+            handler.send_empty_stream(buffered, self._content_type)
+            self._out += handler.take_output()
+            self._done = True
+        elif isinstance(content, backends.TranscodeReader):
+            self._reader = content
+            if buffered:
+                # Wait for the encoder to finish, so we can send the
+                # Content-Length (see _fill).
+                self._pending_reader = content
+            else:
+                handler.send_response(200)
+                handler.send_header('Content-type', self._content_type)
+                handler.end_headers()
+                self._out += handler.take_output()
+                self._source = content
+        else:
+            self._file = content
+            size = os.fstat(content.fileno()).st_size
+            self._serve_file(content.fileno(), size)
+
+    def _slot_granted(self, slot):
+        self._waiter = None
+        if self._closed:
+            slot.release()
+        else:
+            self._start_content(*(self._content_request + (slot,)))
+
+    def _slot_timeout(self):
+        slots = self._server.backend.transcode_slots
+        if self._waiter is not None and slots.cancel(self._waiter):
+            self._waiter = None
+            error = slots.busy_error()
+            print "Error: %s" % (error,)
+            self._handler.send_busy(error.retry_after)
+            self._out += self._handler.take_output()
+            self._done = True
+
+    def _serve_file(self, fd, size):
+        byte_range = self._handler.send_complete_file_headers(
+            size, self._content_type)
+        self._out += self._handler.take_output()
+        if byte_range is None:
+            self._done = True
+        else:
+            first, length = byte_range
+            self._source = FileSource(fd, first, length)
+
+    def _fill(self):
+        """
+        Read more of the response body into self._out, if it's needed and
+        we're allowed to send it.
+        """
+        reader = self._pending_reader
+        if reader is not None and reader.transcode.finished:
+            self._pending_reader = None
+            self._serve_file(reader.fileno(), reader.transcode.size)
+        if self._out or self._source is None or self._paused:
+            return
+        delay = self._limiter.delay(self._chunk_size)
+        if delay > 0:
+            self._paused = True
+            self._server.call_later(delay, self._resume)
+            return
+        data = self._source.read(self._chunk_size)
+        if data:
+            self._limiter.record(len(data))
+            self._out = data
+            self._meter.start()
+        elif self._source.at_end():
+            self._source = None
+            self._done = True
+
+    def _resume(self):
+        self._paused = False
+
+    def handle_write(self):
+        if self._out:
+            sent = self.send(self._out)
+            self._out = self._out[sent:]
+            self._meter.finish(sent)
+            if self._out:
+                # We're still waiting for the client to accept the rest.
+                self._meter.start()
+            # Refill now rather than in the next call to writable, so that
+            # any timer we need is scheduled before the event loop decides how
+            # long to wait.
+            self._fill()
+        elif self._done:
+            self.handle_close()
+
+    def handle_close(self):
+        self._cleanup()
+        self.close()
+
+    def _cleanup(self):
+        if not self._closed and self._content_type is not None:
+            self._handler.record_throughput(self._meter)
+        self._closed = True
+        if self._waiter is not None:
+            # If the slot was granted already, _slot_granted releases it.
+            self._server.backend.transcode_slots.cancel(self._waiter)
+            self._waiter = None
+        if self._reader is not None:
+            self._reader.release()
+            self._reader = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._source = None
+        self._pending_reader = None
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """
+    HTTP server that handles all requests in a single thread.
+
+    This has the same interface as ThreadedHTTPServer, but also needs the
+    backend and bitrate, so it can serve audio streams itself.
+    """
+    address_family = socket.AF_INET
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, backend, bitrate):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.handler_class = AsyncHandler(handler_class)
+        self.backend = backend
+        self.bitrate = bitrate
+        # Heap of (time, sequence number, function) for functions to be
+        # called at the given time.
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self.create_socket(self.address_family, socket.SOCK_STREAM)
+        try:
+            self.set_reuse_addr()
+            self.server_bind(server_address)
+            self.listen(self.request_queue_size)
+        except socket.error:
+            self.close()
+            raise
+
+    def server_bind(self, server_address):
+        self.bind(server_address)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            HTTPChannel(sock, client_address, self)
+
+    def start_transcode(self, transcode):
+        """
+        Start a backends.SharedTranscode whose output is collected by the
+        event loop.
+        """
+        transcode.start_decoder()
+        try:
+            TranscodeCollector(transcode, self)
+        except OSError:
+            transcode.stop()
+            self.reap([transcode.decoder])
+            raise
+
+    def call_later(self, delay, function):
+        """
+        Call function (with no arguments) after delay seconds.
+        """
+        heapq.heappush(self._timers, (time.time() + delay,
+                                      self._timer_sequence.next(), function))
+
+    def reap(self, processes, callback=None):
+        """
+        Wait for processes (subprocess.Popen objects) to exit without
+        blocking the event loop, by polling them every REAP_INTERVAL seconds.
+        Then call callback, if supplied, with True if they all exited
+        successfully, or False otherwise.
+        """
+        if [process for process in processes if process.poll() is None]:
+            self.call_later(REAP_INTERVAL,
+                            lambda: self.reap(processes, callback))
+        elif callback is not None:
+            callback(all([process.returncode == 0 for process in processes]))
+
+    def serve_forever(self):
+        while True:
+            self.poll()
+
+    def poll(self, timeout=POLL_TIMEOUT):
+        """
+        Wait for at most timeout seconds (or until the next timer is due) for
+        an event, handle it, and call any functions whose timers are due.
+        """
+        if self._timers:
+            timeout = min(timeout, max(0, self._timers[0][0] - time.time()))
+        asyncore.loop(timeout, map=self.socket_map, count=1)
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            heapq.heappop(self._timers)[2]()
+
+    def server_close(self):
+        asyncore.close_all(self.socket_map)
+
+class IPV6AsyncHTTPServer(AsyncHTTPServer):
+    # Allow IPv6 connections if possible.
+    if socket.has_ipv6:
+        address_family = socket.AF_INET6
+
+    def server_bind(self, server_address):
+        if socket.has_ipv6:
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        AsyncHTTPServer.server_bind(self, server_address)
@@ -19,18 +19,29 @@
 
 # Common code for library backends.
 
-import fcntl
+# Work with python2.5
+from __future__ import with_statement
+
+import hashlib
+import itertools
 import os
+import shutil
 import signal
 import socket
 import subprocess
 import tagpy
+import tempfile
+import threading
 import time
 
 TITLE='title'
 ARTIST='artist'
 ALBUM='album'
 
+# Song keys are less than KEY_LIMIT, so that clients can represent them exactly
+# as JavaScript numbers. (See assign_key.)
+KEY_LIMIT = 2 ** 52
+
 # For Python2.5 compatibility, we create an equivalent to
 # subprocess.Popen.terminate (new in Python2.6) and patch it in.
 try:
@@ -43,16 +54,46 @@ except AttributeError:
     subprocess.Popen.terminate = sub_popen_terminate
 
 import decoders
+import encoders
+from encoders import DEFAULT_FORMAT
 
 # Serve data to the client at a rate of no higher than RATE_MULTIPLIER * (the
 # bitrate of the encoded data).
 RATE_MULTIPLIER = 2.0
 
-# Attempt to write STREAM_CHUNK_SIZE bytes up to (but possibly less than)
-# STREAM_WRITE_FREQUENCY times per second. The maximum possible write rate with
-# these parameters is 8192 bytes * 128 Hz = 1MB/sec.
+# Read and write encoded data STREAM_CHUNK_SIZE bytes at a time.
 STREAM_CHUNK_SIZE = 8192 #bytes
-STREAM_WRITE_FREQUENCY = 128.0 #Hz
+
+# Allow bursts of up to RATE_LIMIT_BURST bytes above the rate limit, e.g. so
+# the start of a stream can be sent right away.
+RATE_LIMIT_BURST = 65536 #bytes
+
+# When copying file data without any rate limit, copy this much at a time.
+UNSHAPED_CHUNK_SIZE = 256 * 1024 #bytes
+
+# A prefetched stream that its client hasn't asked for is dropped after this
+# long.
+PREFETCH_LIFETIME = 3600 #seconds
+
+# With adaptive bitrates (see BitrateAdapter), each client is sent streams at
+# a bitrate that needs no more than ADAPTIVE_HEADROOM times the throughput
+# measured while sending it the last stream. Streams of less than
+# ADAPTIVE_MIN_BYTES are too short to measure, and measurements are forgotten
+# after ADAPTIVE_LIFETIME.
+ADAPTIVE_HEADROOM = 0.8
+ADAPTIVE_MIN_BYTES = 512 * 1024 #bytes
+ADAPTIVE_LIFETIME = 3600 #seconds
+# The kernel's send buffer for each measured stream is limited to this size,
+# so that a client that falls behind makes our writes block, instead of the
+# stream piling up in a buffer that may grow to several MB.
+ADAPTIVE_SEND_BUFFER = 128 * 1024 #bytes
+
+# Encoder pipelines that are currently running, keyed by (filename, encoder
+# command line). A request for a stream that is already being encoded reads
+# the output of the existing pipeline instead of starting another one.
+active_transcodes = {}
+# Guards active_transcodes and the reader counts of its SharedTranscodes.
+active_transcodes_lock = threading.Lock()
 
 class StreamGenerationError(Exception):
     """
@@ -63,84 +104,1100 @@ class StreamGenerationError(Exception):
     def __str__(self):
         return self.msg
 
-def filename_to_stream(filename, out_stream, bitrate, buffered=False):
+class TranscodeBusyError(StreamGenerationError):
+    """
+    Indicates that a stream couldn't be generated because too many encoders
+    are running already. The client may try again after retry_after seconds.
+    """
+    def __init__(self, msg, retry_after):
+        StreamGenerationError.__init__(self, msg)
+        self.retry_after = retry_after
+
+def get_encode_command(bitrate, format=DEFAULT_FORMAT):
+    """
+    Return a command line for encoding raw audio data (read from stdin) to a
+    stream in the given format (written to stdout) at the given bitrate.
+    """
+    if not encoders.has_encoder(format):
+        raise StreamGenerationError(encoders.encoder_messages[format])
+    return encoders.get_encoder(format, bitrate)
+
+def open_stream(filename, bitrate, cache=None, start=0, start_transcode=None,
+                acquire_slot=None, format=DEFAULT_FORMAT):
+    """
+    Return a version of the specified file encoded in the given format (see
+    encoders.encoders). This is either a file object, if the complete stream
+    is available already (because the file can be served as-is, or because it
+    was cached), or a TranscodeReader.
+
+    If cache (a cache.TranscodeCache) is supplied, the encoded data is served
+    from the cache when possible. Otherwise it is written to the cache as it
+    is encoded.
+
+    If start is nonzero, the stream begins that many seconds into the song.
+
+    Concurrent requests for the same stream share a single encoder. See
+    join_transcode for the meaning of start_transcode and acquire_slot.
+    """
     print "Handling request for %s" % (filename,)
     try:
-        decode_command = decoders.get_decoder(filename)
+        decode_command = decoders.get_decoder(filename, start)
     except KeyError:
         raise StreamGenerationError(
             "Couldn't play specified format: %r" % (filename,))
-    encoder_path = "/usr/bin/oggenc"
-    if not os.path.exists(encoder_path):
-        raise StreamGenerationError(
-            ("No Vorbis encoder found at %s. " % (encoder_path,)) + \
-                "Please install 'vorbis-tools'.")
-    encode_command = [encoder_path, "-r", "-Q", "-b", str(bitrate), "-"]
-    # Pipe the decode command into the encode command.
-    p1 = subprocess.Popen(decode_command, stdout=subprocess.PIPE)
-    if buffered:
-        # Read the entire output and then write it to the output stream.
-        p2 = subprocess.Popen(encode_command, stdin=p1.stdout, stdout=subprocess.PIPE)
-        out_stream.write(p2.stdout.read())
+    if start:
+        # Complete streams (the source file, or cached output) can only be
+        # served from the beginning, so always encode a partial stream.
+        if decoders.decoder_can_seek(filename):
+            skip_bytes = 0
+        else:
+            # Discard the beginning of the decoder output instead. This
+            # still saves us from encoding that part of the file, which is
+            # the expensive part.
+            skip_bytes = decoders.get_pcm_offset(start)
+        return join_transcode(filename, decode_command,
+                              get_encode_command(bitrate, format),
+                              start=start,
+                              skip_bytes=skip_bytes,
+                              start_transcode=start_transcode,
+                              acquire_slot=acquire_slot)
+    if format == 'ogg' and decoders.can_pass_through(filename, bitrate):
+        # The file is already in a format (and at a bitrate) we'd produce, so
+        # there's no need to decode and re-encode it.
+        try:
+            return open(filename, 'rb')
+        except IOError, e:
+            raise StreamGenerationError(
+                "Couldn't read %r: %s" % (filename, e))
+    encode_command = get_encode_command(bitrate, format)
+    cache_key = None
+    if cache is not None:
+        try:
+            cache_key = cache.get_key(filename, encode_command, format)
+        except OSError, e:
+            raise StreamGenerationError(
+                "Couldn't read %r: %s" % (filename, e))
+        cached_file = cache.open_entry(cache_key)
+        if cached_file is not None:
+            return cached_file
+    return join_transcode(filename, decode_command, encode_command, cache,
+                          cache_key, start_transcode=start_transcode,
+                          acquire_slot=acquire_slot)
+
+def filename_to_stream(filename, out_stream, bitrate, buffered=False,
+                       cache=None, start=0):
+    """
+    Write an encoded version of the specified file to out_stream. See
+    open_stream.
+    """
+    copy_content(open_stream(filename, bitrate, cache, start), out_stream,
+                 bitrate, buffered)
+
+def copy_content(content, out_stream, bitrate, buffered=False, meter=None):
+    """
+    Write the stream returned by open_stream to out_stream, and close it.
+    """
+    if isinstance(content, TranscodeReader):
+        copy_transcode_output(content, out_stream, bitrate, buffered, meter)
     else:
-        # Stream the encoder output while limiting the total bandwidth used. We
-        # do this by writing the encoder output to a pipe and reading from the
-        # pipe at a limited rate.
-        (read_fd, write_fd) = os.pipe()
-        p2 = subprocess.Popen(encode_command, stdin=p1.stdout,
-                              stdout=os.fdopen(write_fd, 'wb'))
-        # Don't let reads block when we've read to the end of the encoded song
-        # data.
-        fcntl.fcntl(read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
         try:
-            copy_output_with_shaping(read_fd, out_stream, bitrate,
-                                     lambda : p2.poll() != None)
-        except socket.error:
-            p1.terminate()
-            p2.terminate()
-        # Close the FIFO we opened.
+            copy_complete_file(content, out_stream, bitrate, buffered, meter)
+        finally:
+            content.close()
+
+def copy_transcode_output(reader, out_stream, bitrate, buffered=False,
+                          meter=None):
+    """
+    Write the data from the given TranscodeReader to out_stream, and release
+    the reader when done. If meter (a ThroughputMeter) is supplied, unbuffered
+    writes are measured with it.
+    """
+    try:
+        if buffered:
+            for data in reader.chunks():
+                out_stream.write(data)
+        else:
+            try:
+                write_with_shaping(reader.chunks(), out_stream, bitrate,
+                                   meter)
+            except socket.error:
+                pass
+    finally:
+        reader.release()
+
+def join_transcode(filename, decode_command, encode_command, cache=None,
+                   cache_key=None, start=0, skip_bytes=0,
+                   start_transcode=None, acquire_slot=None):
+    """
+    Return a TranscodeReader for the output of encode_command for the given
+    file, starting a new pipeline only if there isn't one running already. The
+    caller must call release() on the returned object when it is done reading
+    from it.
+
+    If a new pipeline is started and cache is supplied, its output is also
+    saved in the cache under cache_key.
+
+    start gives the position (in seconds) at which decode_command begins
+    decoding, and skip_bytes the amount of decoder output to discard before
+    encoding.
+
+    start_transcode is called with a new SharedTranscode in order to start it.
+    By default, SharedTranscode.start is used, which collects the pipeline's
+    output in a separate thread.
+
+    If acquire_slot is supplied, it is called before a new pipeline is
+    started, and should return a TranscodeSlot (or raise an exception if the
+    pipeline may not be started). The slot is released when the pipeline
+    finishes.
+    """
+    transcode_id = (filename, start, tuple(encode_command))
+    with active_transcodes_lock:
+        transcode = active_transcodes.get(transcode_id)
+        if transcode is not None:
+            print "Sharing encoder output with another request for %s" \
+                % (filename,)
+            return _add_reader(transcode)
+    # Waiting for a slot may take a while, so don't hold the lock meanwhile.
+    slot = None
+    if acquire_slot is not None:
+        slot = acquire_slot()
+    with active_transcodes_lock:
+        transcode = active_transcodes.get(transcode_id)
+        if transcode is None:
+            if cache is not None:
+                spool = cache.begin_fill(cache_key)
+            else:
+                spool = SpoolFile()
+            transcode = SharedTranscode(transcode_id, decode_command,
+                                        encode_command, spool, skip_bytes,
+                                        slot)
+            try:
+                if start_transcode is None:
+                    transcode.start()
+                else:
+                    start_transcode(transcode)
+            except OSError, e:
+                spool.abort()
+                failed = True
+            else:
+                failed = False
+                active_transcodes[transcode_id] = transcode
+                reader = _add_reader(transcode)
+        else:
+            # Another request started the same pipeline while we were waiting.
+            print "Sharing encoder output with another request for %s" \
+                % (filename,)
+            failed = False
+            reader = _add_reader(transcode)
+    if slot is not None and (failed or transcode.slot is not slot):
+        slot.release()
+    if failed:
+        raise StreamGenerationError(
+            "Couldn't start encoder for %r: %s" % (filename, e))
+    return reader
+
+def _add_reader(transcode):
+    """
+    Return a new TranscodeReader for transcode. Must be called with
+    active_transcodes_lock held.
+    """
+    # Open the spool file now, while we know it hasn't been moved or removed.
+    reader = TranscodeReader(transcode)
+    transcode.readers += 1
+    return reader
+
+class SpoolFile(object):
+    """
+    Temporary file that holds the output of a SharedTranscode whose output is
+    not being cached. This has the same interface as cache.CacheFill, but the
+    file is always deleted in the end.
+    """
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='zeya-', suffix='.spool')
+        self._file = os.fdopen(fd, 'wb', 0)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self):
+        self.abort()
+
+    def abort(self):
+        self._file.close()
         try:
-            os.close(read_fd)
+            os.remove(self.path)
         except OSError:
             pass
 
-def copy_output_with_shaping(read_fd, out_stream, bitrate,
-                             encoder_finished_callback = lambda : True):
-    """
-    Copies data from the input stream with the specified FD to the given output
-    stream. Do not copy data faster than BITRATE * RATE_MULTIPLIER bits/second.
-
-    Ceases copying data when the input stream is empty AND
-    encoder_finished_callback() evaluates to True in a boolean context.
-    """
-    bytes_written = 0
-    start_time = time.time()
-    # Compute the output rate, converting kilobits/sec to bytes/sec.
-    max_bytes_per_sec = RATE_MULTIPLIER * bitrate * 1024 / 8
-    encoder_finished = False
-    while True:
-        time.sleep(1/STREAM_WRITE_FREQUENCY)
-        # If the average transfer rate exceeds the threshold, sleep for a
-        # while longer.
-        if bytes_written >= (time.time() - start_time) * max_bytes_per_sec:
-            continue
-        # Detect when the source (encoder) process has finished. We assume that
-        # data written by the encoder is immediately available via os.read.
-        # Therefore, if the encoder has finished, and we subsequently cannot
-        # read data from the input stream, we can conclude that we have read
-        # all the data.
-        if encoder_finished_callback():
-            encoder_finished = True
+class SharedTranscode(object):
+    """
+    The output of a single decoder/encoder pipeline, which may be read by any
+    number of requests at once.
+
+    The encoded data is written to a spool file (the cache entry being filled,
+    if caching is enabled), and each reader reads that file at its own pace.
+    This way each reader receives the complete stream from the beginning, no
+    matter when it started reading, and the amount of memory used doesn't
+    depend on the length of the song.
+
+    start() runs the pipeline with a thread that collects its output. Callers
+    that want to collect the output themselves (e.g. in an event loop) can
+    instead use start_decoder, start_encoder, add_output and finish.
+    """
+    def __init__(self, transcode_id, decode_command, encode_command, spool,
+                 skip_bytes=0, slot=None):
+        self._id = transcode_id
+        self._decode_command = decode_command
+        self._encode_command = encode_command
+        # Object (a cache.CacheFill or SpoolFile) with an unbuffered write
+        # method, and whose contents can be read from the file named by its
+        # 'path' attribute.
+        self.spool = spool
+        # Number of bytes of decoder output to discard before starting the
+        # encoder.
+        self.skip_bytes = skip_bytes
+        # TranscodeSlot held while the pipeline runs, if any.
+        self.slot = slot
+        # Number of requests reading from this object. Guarded by
+        # active_transcodes_lock.
+        self.readers = 0
+        # Number of bytes that have been written to the spool file.
+        self.size = 0
+        self.finished = False
+        # Set when the pipeline is stopped before it finishes.
+        self._stopped = False
+        self.decoder = None
+        self.encoder = None
+        # Notified whenever data is written to the spool file or the encoder
+        # finishes. Also guards self._stopped and self.encoder.
+        self.condition = threading.Condition()
+
+    def start(self):
+        """
+        Start the pipeline, and a thread that collects its output.
+        """
+        self.start_decoder()
+        thread = threading.Thread(target=self._collect_output)
+        thread.setDaemon(True)
+        thread.start()
+
+    def start_decoder(self):
+        self.decoder = subprocess.Popen(self._decode_command,
+                                        stdout=subprocess.PIPE)
+
+    def start_encoder(self):
+        """
+        Start the encoder, reading from the decoder output (after skip_bytes
+        of it have been discarded). Returns False if the pipeline was stopped
+        in the meantime.
+        """
+        with self.condition:
+            if self._stopped:
+                return False
+            # Pipe the decode command into the encode command.
+            self.encoder = subprocess.Popen(self._encode_command,
+                                            stdin=self.decoder.stdout,
+                                            stdout=subprocess.PIPE)
+        # The encoder holds its own copy of this pipe. Closing ours ensures
+        # the decoder is interrupted if the encoder exits early.
+        self.decoder.stdout.close()
+        return True
+
+    def add_output(self, data):
+        """
+        Record a piece of the encoder output.
+        """
+        self.spool.write(data)
+        with self.condition:
+            self.size += len(data)
+            self.condition.notifyAll()
+
+    def finish(self, success):
+        """
+        Record that the pipeline has exited, successfully or not.
+        """
+        with active_transcodes_lock:
+            if active_transcodes.get(self._id) is self:
+                del active_transcodes[self._id]
+        # Readers that have already joined keep the spool file open, so it can
+        # be moved or deleted now. Only keep the cached copy if the encoder ran
+        # to completion.
+        if success:
+            self.spool.commit()
+        else:
+            self.spool.abort()
+        with self.condition:
+            self.finished = True
+            self.condition.notifyAll()
+        if self.slot is not None:
+            self.slot.release()
+
+    def wait_for_exit(self):
+        """
+        Wait for the pipeline to exit, and return True if it succeeded.
+        """
+        return self.encoder.wait() == 0 and self.decoder.wait() == 0
+
+    def stop(self):
+        """
+        Terminate the pipeline.
+        """
+        with self.condition:
+            self._stopped = True
+            encoder = self.encoder
+        self.decoder.terminate()
+        if encoder is not None:
+            encoder.terminate()
+
+    def _collect_output(self):
+        """
+        Copy the encoder output to the spool file until the encoder exits.
+        """
+        success = False
         try:
-            data = os.read(read_fd, STREAM_CHUNK_SIZE)
-        except OSError:
-            # OSError will be thrown if we read before the pipe has had any
-            # data written to it.
-            data = ""
-        if encoder_finished and len(data) == 0:
-            break
-        out_stream.write(data)
-        bytes_written = bytes_written + len(data)
+            # Discard the part of the decoder output we were asked to skip.
+            # This has to be done before the encoder starts reading from the
+            # pipe.
+            decoder_fd = self.decoder.stdout.fileno()
+            remaining = self.skip_bytes
+            while remaining > 0:
+                data = os.read(decoder_fd, min(remaining, STREAM_CHUNK_SIZE))
+                if not data:
+                    break
+                remaining -= len(data)
+            if remaining > 0 or not self.start_encoder():
+                self.stop()
+                self.decoder.wait()
+                return
+            read_fd = self.encoder.stdout.fileno()
+            while True:
+                data = os.read(read_fd, STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                self.add_output(data)
+            self.encoder.stdout.close()
+            success = self.wait_for_exit()
+        except (IOError, OSError), e:
+            print "Error: couldn't run encoder: %s" % (e,)
+            self.stop()
+        finally:
+            self.finish(success)
+
+    def release(self):
+        """
+        Indicate that a reader is no longer using this object. The pipeline is
+        stopped if it is still running and nobody is reading its output.
+        """
+        with active_transcodes_lock:
+            self.readers -= 1
+            abandoned = self.readers == 0 and not self.finished
+            if abandoned and active_transcodes.get(self._id) is self:
+                # Don't let any new requests join a pipeline we're stopping.
+                del active_transcodes[self._id]
+        if abandoned:
+            self.stop()
+
+class TranscodeReader(object):
+    """
+    Reads the output of a SharedTranscode from the beginning.
+    """
+    def __init__(self, transcode):
+        self.transcode = transcode
+        # Number of bytes read so far.
+        self.offset = 0
+        self._fd = os.open(transcode.spool.path, os.O_RDONLY)
+
+    def fileno(self):
+        return self._fd
+
+    def read(self, max_bytes=STREAM_CHUNK_SIZE):
+        """
+        Return up to max_bytes of the data that's available now, without
+        blocking. Returns an empty string if no data is available yet, or if
+        the stream has ended (see at_end).
+        """
+        available = self.transcode.size - self.offset
+        if available <= 0:
+            return ''
+        data = os.read(self._fd, min(available, max_bytes))
+        self.offset += len(data)
+        return data
+
+    def at_end(self):
+        """
+        Returns True if all of the encoder output has been read.
+        """
+        return self.transcode.finished \
+            and self.offset >= self.transcode.size
+
+    def chunks(self):
+        """
+        Generate the encoded data, blocking until more data is available or
+        the encoder has finished.
+        """
+        transcode = self.transcode
+        while True:
+            with transcode.condition:
+                while self.offset >= transcode.size \
+                        and not transcode.finished:
+                    transcode.condition.wait()
+            data = self.read()
+            if not data:
+                return
+            yield data
+
+    def release(self):
+        """
+        Stop reading. The reader can't be used after this is called.
+        """
+        os.close(self._fd)
+        self.transcode.release()
+
+class TranscodeSlots(object):
+    """
+    Limits the number of encoder pipelines that run at once.
+
+    Requests for new pipelines that can't be started right away wait in a
+    queue, for at most max_wait seconds. When a slot becomes free, requests for
+    playback go ahead of prefetches. Among those, the client that has the
+    fewest pipelines running goes first (so that one client can't starve the
+    others), and then the request that has been waiting the longest.
+    """
+    def __init__(self, max_transcodes, max_wait):
+        self.max_transcodes = max_transcodes
+        self.max_wait = max_wait
+        # Guards all of the following, and is notified when a waiting request
+        # is granted a slot.
+        self._condition = threading.Condition()
+        # Map from client to the number of slots it holds.
+        self._running = {}
+        self._num_running = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def acquire(self, client, prefetch=False):
+        """
+        Return a TranscodeSlot for the given client, waiting for one to become
+        free if necessary. Raises TranscodeBusyError if no slot becomes free
+        within max_wait seconds.
+        """
+        waiter = self.wait(client, prefetch)
+        deadline = time.time() + self.max_wait
+        with self._condition:
+            while waiter.slot is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._waiters.remove(waiter)
+                    raise self.busy_error()
+                self._condition.wait(remaining)
+        return waiter.slot
+
+    def try_acquire(self, client, prefetch=False):
+        """
+        Return a TranscodeSlot for the given client if one is free and nobody
+        else is waiting for one, or None otherwise.
+        """
+        with self._condition:
+            if self._waiters or self._num_running >= self.max_transcodes:
+                return None
+            return self._take_slot(client)
+
+    def wait(self, client, prefetch=False, callback=None):
+        """
+        Queue a request for a slot, and return a SlotWaiter whose slot
+        attribute is set when the request is granted. If callback is
+        supplied, it is also called with the slot at that point (from the
+        thread that released the slot). Use cancel to stop waiting.
+        """
+        with self._condition:
+            waiter = SlotWaiter(client, prefetch, callback,
+                                self._sequence.next())
+            self._waiters.append(waiter)
+            granted = self._grant()
+        self._run_callbacks(granted)
+        return waiter
+
+    def cancel(self, waiter):
+        """
+        Stop waiting for a slot. Returns False if the slot was granted
+        already, in which case the caller is responsible for releasing it.
+        """
+        with self._condition:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return True
+            return False
+
+    def busy_error(self):
+        return TranscodeBusyError("Too many encoders are running",
+                                  max(1, int(self.max_wait)))
+
+    def _take_slot(self, client):
+        self._running[client] = self._running.get(client, 0) + 1
+        self._num_running += 1
+        return TranscodeSlot(self, client)
+
+    def _release(self, slot):
+        with self._condition:
+            self._running[slot.client] -= 1
+            if not self._running[slot.client]:
+                del self._running[slot.client]
+            self._num_running -= 1
+            granted = self._grant()
+        self._run_callbacks(granted)
+
+    def _grant(self):
+        """
+        Hand out free slots to waiting requests, and return the waiters
+        whose callbacks need to be run. Must be called with the lock held.
+        """
+        granted = []
+        while self._waiters and self._num_running < self.max_transcodes:
+            waiter = min(self._waiters,
+                         key=lambda w: (w.prefetch,
+                                        self._running.get(w.client, 0),
+                                        w.sequence))
+            self._waiters.remove(waiter)
+            waiter.slot = self._take_slot(waiter.client)
+            if waiter.callback is not None:
+                granted.append(waiter)
+        self._condition.notifyAll()
+        return granted
+
+    def _run_callbacks(self, granted):
+        for waiter in granted:
+            waiter.callback(waiter.slot)
+
+class SlotWaiter(object):
+    """
+    A request waiting for a TranscodeSlot.
+    """
+    def __init__(self, client, prefetch, callback, sequence):
+        self.client = client
+        self.prefetch = prefetch
+        self.callback = callback
+        self.sequence = sequence
+        self.slot = None
+
+class TranscodeSlot(object):
+    """
+    Permission from TranscodeSlots to run one encoder pipeline.
+    """
+    def __init__(self, slots, client):
+        self._slots = slots
+        self.client = client
+        self._released = False
+
+    def release(self):
+        """
+        Give up the slot. Calling this more than once has no effect.
+        """
+        if not self._released:
+            self._released = True
+            self._slots._release(self)
+
+class Prefetcher(object):
+    """
+    Encodes the songs that clients are expected to play next, ahead of time,
+    so that their streams can be served as soon as they're requested.
+
+    Each client has at most one prefetch at a time. Prefetches wait for an
+    encoder slot behind requests for songs that are being played (see
+    TranscodeSlots), and a client's prefetch is cancelled as soon as it skips
+    to a different song. A prefetch that its client doesn't ask for within
+    lifetime seconds is cancelled too, on a timer, so that it doesn't keep
+    its stream open for good.
+    """
+    def __init__(self, lifetime=PREFETCH_LIFETIME):
+        self.lifetime = lifetime
+        # Guards the following, and the state of each Prefetch.
+        self._lock = threading.Lock()
+        # Map from client to its Prefetch.
+        self._prefetches = {}
+        # Map from client to the stream it requested last (see claim), and
+        # the time of the request.
+        self._playing = {}
+        # threading.Timer that calls _expire when the oldest prefetch
+        # expires, if there are any prefetches.
+        self._timer = None
+
+    def start(self, client, stream_id, open_prefetch, slots=None,
+              call_soon=None):
+        """
+        Start a prefetch for the given client, of the stream identified by
+        stream_id, unless one is in progress already. Any other prefetch for
+        the client is cancelled.
+
+        open_prefetch is called with an acquire_slot function (see
+        join_transcode) to open the stream, as open_stream does. If slots (a
+        TranscodeSlots) is supplied, it's only called once a slot is free,
+        via call_soon (which calls a function with no arguments, by default
+        right away).
+        """
+        now = time.time()
+        with self._lock:
+            cancelled = self._remove_expired(now)
+            existing = self._prefetches.get(client)
+            if existing is not None and existing.stream_id == stream_id:
+                prefetch = None
+            else:
+                if existing is not None:
+                    cancelled.append(existing)
+                prefetch = self._prefetches[client] = \
+                    Prefetch(stream_id, now)
+            self._schedule_expiry()
+        for old_prefetch in cancelled:
+            self._cancel(old_prefetch)
+        if prefetch is None:
+            return
+        if call_soon is None:
+            call_soon = lambda function: function()
+        def run(slot=None):
+            call_soon(lambda: self._run(prefetch, open_prefetch, slot))
+        if slots is None:
+            run()
+        else:
+            waiter = slots.wait(client, True, run)
+            with self._lock:
+                prefetch.slots = slots
+                prefetch.waiter = waiter
+                cancelled = prefetch.cancelled
+            if cancelled:
+                # The prefetch was cancelled while we were queueing it. If the
+                # slot was granted already, _run releases it.
+                slots.cancel(waiter)
+
+    def _run(self, prefetch, open_prefetch, slot):
+        """
+        Open the stream for prefetch, now that we have the slot it needs (if
+        any).
+        """
+        with self._lock:
+            prefetch.waiter = None
+            cancelled = prefetch.cancelled
+        granted = [slot]
+        def acquire_slot():
+            slot = granted[0]
+            granted[0] = None
+            return slot
+        try:
+            if cancelled:
+                return
+            try:
+                content = open_prefetch(
+                    acquire_slot if slot is not None else None)
+            except (StreamGenerationError, KeyError, ValueError), e:
+                print "Error: couldn't prefetch stream: %s" % (e,)
+                return
+            if not isinstance(content, TranscodeReader):
+                # The complete stream is available already.
+                content.close()
+                return
+            with self._lock:
+                if not prefetch.cancelled:
+                    prefetch.reader = content
+                    content = None
+            if content is not None:
+                content.release()
+        finally:
+            # Give back the slot if it wasn't needed after all.
+            if granted[0] is not None:
+                granted[0].release()
+
+    def claim(self, client, stream_id, complete=True):
+        """
+        Record that the client has requested the stream identified by
+        stream_id (all of it, or part of it if complete is False). Return a
+        TranscodeReader for the client's prefetch if it's for the complete
+        stream and has been started, or None otherwise. The caller must
+        release the returned reader.
+
+        Otherwise the client's prefetch is cancelled, unless the client asked
+        for the same stream as it did last time (e.g. to seek within the song
+        it's playing).
+        """
+        now = time.time()
+        reader = None
+        with self._lock:
+            cancelled = self._remove_expired(now)
+            previous = self._playing.get(client)
+            self._playing[client] = (stream_id, now)
+            prefetch = self._prefetches.get(client)
+            if prefetch is None:
+                pass
+            elif prefetch.stream_id == stream_id and complete \
+                    and prefetch.reader is not None:
+                del self._prefetches[client]
+                reader = prefetch.reader
+                prefetch.reader = None
+            elif prefetch.stream_id != stream_id and previous is not None \
+                    and previous[0] == stream_id:
+                pass
+            else:
+                del self._prefetches[client]
+                cancelled.append(prefetch)
+            self._schedule_expiry()
+        for old_prefetch in cancelled:
+            self._cancel(old_prefetch)
+        return reader
+
+    def get_stream_id(self, client):
+        """
+        Return the stream_id of the client's prefetch, or None if it has
+        none.
+        """
+        with self._lock:
+            cancelled = self._remove_expired(time.time())
+            self._schedule_expiry()
+            prefetch = self._prefetches.get(client)
+        for old_prefetch in cancelled:
+            self._cancel(old_prefetch)
+        if prefetch is None:
+            return None
+        return prefetch.stream_id
+
+    def _remove_expired(self, now):
+        """
+        Forget the prefetches (and the streams that clients were playing)
+        that are more than lifetime seconds old, and return the prefetches,
+        which the caller must cancel once it has released the lock.
+        """
+        deadline = now - self.lifetime
+        expired = [self._prefetches.pop(client)
+                   for client, prefetch in self._prefetches.items()
+                   if prefetch.started < deadline]
+        for client, (playing, requested) in self._playing.items():
+            if requested < deadline:
+                del self._playing[client]
+        return expired
+
+    def _schedule_expiry(self):
+        """
+        Start a timer for the oldest prefetch, unless one is running already,
+        or stop the timer if there aren't any prefetches left. Must be called
+        with the lock held.
+        """
+        if not self._prefetches:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return
+        if self._timer is not None:
+            return
+        oldest = min([prefetch.started
+                      for prefetch in self._prefetches.itervalues()])
+        delay = max(0, oldest + self.lifetime - time.time())
+        # Expire prefetches a little late rather than a little early, so a
+        # timer doesn't fire just before the prefetch it's for expires.
+        self._timer = threading.Timer(delay + 0.01, self._expire)
+        self._timer.setDaemon(True)
+        self._timer.start()
+
+    def _expire(self):
+        """
+        Cancel the prefetches that have expired, and wait for the next one.
+        """
+        with self._lock:
+            if self._timer is threading.currentThread():
+                self._timer = None
+            cancelled = self._remove_expired(time.time())
+            self._schedule_expiry()
+        for prefetch in cancelled:
+            self._cancel(prefetch)
+
+    def _cancel(self, prefetch):
+        """
+        Stop a prefetch, if nobody else is using the stream.
+        """
+        with self._lock:
+            prefetch.cancelled = True
+            waiter = prefetch.waiter
+            prefetch.waiter = None
+            reader = prefetch.reader
+            prefetch.reader = None
+        if waiter is not None:
+            # If the slot was granted already, _run releases it.
+            prefetch.slots.cancel(waiter)
+        if reader is not None:
+            reader.release()
+
+class Prefetch(object):
+    """
+    A stream being encoded ahead of time by a Prefetcher.
+    """
+    def __init__(self, stream_id, started):
+        self.stream_id = stream_id
+        self.started = started
+        self.cancelled = False
+        # TranscodeSlots we're waiting on, and the SlotWaiter, until the slot
+        # is granted.
+        self.slots = None
+        self.waiter = None
+        # TranscodeReader for the stream, once it's started.
+        self.reader = None
+
+class BitrateAdapter(object):
+    """
+    Chooses the bitrate of each client's streams according to how fast it
+    accepted the last one, so that clients on slow links are sent streams
+    they can receive in real time instead of stalling.
+
+    The throughput of each stream is measured with a ThroughputMeter, and
+    streams that are too short to tell are ignored. A client's next stream is
+    encoded at the highest bitrate on the ladder, up to the one it asked for,
+    that needs no more than ADAPTIVE_HEADROOM of that throughput. Bitrates
+    are those of Ogg Vorbis streams of the same quality (see
+    encoders.get_bitrate).
+    """
+    def __init__(self, ladder=encoders.DEFAULT_BITRATE_LADDER,
+                 lifetime=ADAPTIVE_LIFETIME):
+        self.ladder = ladder
+        self.lifetime = lifetime
+        # Guards _throughputs.
+        self._lock = threading.Lock()
+        # Map from client to its measured throughput (kbits/sec), and the
+        # time it was measured.
+        self._throughputs = {}
+
+    def make_meter(self, sock):
+        """
+        Return a ThroughputMeter for a stream that is about to be sent over
+        the given socket, after limiting its send buffer to
+        ADAPTIVE_SEND_BUFFER.
+        """
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            ADAPTIVE_SEND_BUFFER)
+            buffer_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        except socket.error:
+            buffer_size = ADAPTIVE_SEND_BUFFER
+        return ThroughputMeter(buffer_size)
+
+    def record(self, client, meter):
+        """
+        Record the throughput measured by meter while sending a stream to the
+        given client.
+        """
+        if meter.num_bytes < ADAPTIVE_MIN_BYTES:
+            return
+        throughput = meter.get_throughput()
+        now = time.time()
+        with self._lock:
+            deadline = now - self.lifetime
+            for c, (t, measured) in self._throughputs.items():
+                if measured < deadline:
+                    del self._throughputs[c]
+            if throughput is None:
+                # The client never kept us waiting, so it can keep up with
+                # any bitrate.
+                self._throughputs.pop(client, None)
+            else:
+                self._throughputs[client] = (throughput, now)
+
+    def choose(self, client, format, bitrate):
+        """
+        Return the bitrate at which to encode a stream in the given format for
+        the given client, which asked for the given bitrate.
+        """
+        with self._lock:
+            entry = self._throughputs.get(client)
+        if entry is None or entry[1] < time.time() - self.lifetime:
+            return bitrate
+        usable = entry[0] * ADAPTIVE_HEADROOM
+        rungs = [rung for rung in self.ladder if rung < bitrate] + [bitrate]
+        for rung in reversed(rungs):
+            if encoders.get_bitrate(format, rung) <= usable:
+                return rung
+        return rungs[0]
+
+def copy_complete_file(in_file, out_stream, bitrate, buffered=False,
+                       meter=None):
+    """
+    Write the contents of in_file, which contains a complete encoded stream, to
+    out_stream. If meter (a ThroughputMeter) is supplied, unbuffered writes are
+    measured with it.
+    """
+    if buffered:
+        shutil.copyfileobj(in_file, out_stream, STREAM_CHUNK_SIZE)
+    else:
+        try:
+            copy_file_with_shaping(in_file, out_stream, bitrate, meter=meter)
+        except socket.error:
+            pass
+
+# os.sendfile is not available in all versions of Python. When it's missing, we
+# copy file data to the client through a buffer instead.
+try:
+    sendfile = os.sendfile
+except AttributeError:
+    sendfile = None
+
+class RateLimiter(object):
+    """
+    Token bucket that limits writes to BITRATE * RATE_MULTIPLIER bits/second,
+    allowing bursts of up to RATE_LIMIT_BURST bytes. If BITRATE is None,
+    writes are not limited.
+
+    Callers sleep only as long as needed before each write, so an idle or
+    rate-limited stream doesn't cause any wakeups.
+    """
+    def __init__(self, bitrate, burst=RATE_LIMIT_BURST):
+        # Compute the output rate, converting kilobits/sec to bytes/sec.
+        self._bytes_per_sec = None
+        if bitrate is not None:
+            self._bytes_per_sec = RATE_MULTIPLIER * bitrate * 1024 / 8
+        self._capacity = burst
+        # Number of bytes that can be written right now. The bucket starts
+        # out full.
+        self._tokens = burst
+        self._last_refill = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self._capacity, self._tokens
+                           + (now - self._last_refill) * self._bytes_per_sec)
+        self._last_refill = now
+
+    def delay(self, num_bytes):
+        """
+        Return the number of seconds to wait before it's acceptable to write
+        num_bytes bytes.
+        """
+        if self._bytes_per_sec is None:
+            return 0
+        self._refill()
+        # Requests larger than the bucket are allowed once it's full.
+        needed = min(num_bytes, self._capacity) - self._tokens
+        return max(needed, 0) / self._bytes_per_sec
+
+    def wait(self, num_bytes):
+        """
+        Block until it's acceptable to write num_bytes bytes.
+        """
+        seconds = self.delay(num_bytes)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def record(self, num_bytes):
+        """
+        Record that num_bytes bytes were written.
+        """
+        if self._bytes_per_sec is None:
+            return
+        self._refill()
+        self._tokens -= num_bytes
+
+class ThroughputMeter(object):
+    """
+    Measures how fast a client accepts the data sent to it: the number of
+    bytes written to it, and the time spent waiting for it to accept them.
+    Time spent waiting for data to send, or for a RateLimiter, isn't counted.
+
+    buffer_size is the amount of data that can be written without the client
+    accepting any of it (e.g. the size of the socket's send buffer), which
+    isn't counted either.
+    """
+    def __init__(self, buffer_size=0):
+        self.buffer_size = buffer_size
+        self.num_bytes = 0
+        self.seconds = 0.0
+        self._started = None
+
+    def start(self):
+        """
+        Record that we're waiting for the client to accept some data.
+        """
+        if self._started is None:
+            self._started = time.time()
+
+    def finish(self, num_bytes):
+        """
+        Record that the client accepted num_bytes bytes, and that we're no
+        longer waiting for it.
+        """
+        if self._started is not None:
+            self.seconds += time.time() - self._started
+            self._started = None
+        self.num_bytes += num_bytes
+
+    def get_throughput(self):
+        """
+        Return the measured throughput in kbits/sec, or None if the client
+        never kept us waiting.
+        """
+        num_bytes = self.num_bytes - self.buffer_size
+        if num_bytes <= 0 or self.seconds <= 0:
+            return None
+        return num_bytes * 8 / 1024.0 / self.seconds
+
+def write_with_shaping(chunks, out_stream, bitrate, meter=None):
+    """
+    Writes each of the strings generated by chunks to the given output stream.
+    Do not write data faster than BITRATE * RATE_MULTIPLIER bits/second.
+
+    If meter (a ThroughputMeter) is supplied, the writes are measured with it.
+    """
+    limiter = RateLimiter(bitrate)
+    if meter is None:
+        meter = ThroughputMeter()
+    for data in chunks:
+        for offset in xrange(0, len(data), STREAM_CHUNK_SIZE):
+            piece = data[offset:offset + STREAM_CHUNK_SIZE]
+            limiter.wait(len(piece))
+            meter.start()
+            out_stream.write(piece)
+            meter.finish(len(piece))
+            limiter.record(len(piece))
+
+def copy_file_with_shaping(in_file, out_stream, bitrate, out_fd=None,
+                           length=None, meter=None):
+    """
+    Copies the contents of in_file (a real file), from its current position to
+    the end, to the given output stream. Do not copy data faster than
+    BITRATE * RATE_MULTIPLIER bits/second, unless BITRATE is None.
+
+    If length is supplied, copy no more than that many bytes.
+
+    If out_fd, the file descriptor underlying out_stream, is supplied, the data
+    is sent with sendfile where possible, without being copied into this
+    process. Otherwise it's copied through a buffer of bounded size.
+
+    If meter (a ThroughputMeter) is supplied, the writes are measured with it.
+    """
+    limiter = RateLimiter(bitrate)
+    if meter is None:
+        meter = ThroughputMeter()
+    if bitrate is None:
+        chunk_size = UNSHAPED_CHUNK_SIZE
+    else:
+        chunk_size = STREAM_CHUNK_SIZE
+    if length is None:
+        length = os.fstat(in_file.fileno()).st_size - in_file.tell()
+    if sendfile is not None and out_fd is not None:
+        out_stream.flush()
+        in_fd = in_file.fileno()
+        offset = in_file.tell()
+        while length > 0:
+            limiter.wait(min(length, chunk_size))
+            meter.start()
+            sent = sendfile(out_fd, in_fd, offset, min(length, chunk_size))
+            meter.finish(sent)
+            if sent == 0:
+                break
+            offset += sent
+            length -= sent
+            limiter.record(sent)
+    else:
+        while length > 0:
+            limiter.wait(min(length, chunk_size))
+            data = in_file.read(min(length, chunk_size))
+            if not data:
+                break
+            meter.start()
+            out_stream.write(data)
+            meter.finish(len(data))
+            length -= len(data)
+            limiter.record(len(data))
 
 # This interface is implemented by all library backends.
 
@@ -165,6 +1222,10 @@ class LibraryBackend():
 
         The items will be displayed to the user in the order that they appear
         here.
+
+        Backends with large collections should return a songtable.SongTable
+        instead of a list, which holds the same information much more
+        compactly (along with the filename of each song).
         """
         raise NotImplementedError()
 
@@ -187,29 +1248,224 @@ class LibraryBackend():
         """
         raise NotImplementedError()
 
-    def get_content(self, key, out_stream, bitrate, buffered=False):
+    def reload(self):
+        """
+        Bring the library up to date with the underlying collection (so that
+        the next calls to get_library_contents and get_playlists reflect any
+        changes to it), rereading as little as possible.
+
+        Songs that are still present must keep the same keys, so that clients
+        can continue to refer to them. This method may be called from a
+        different thread than the other methods, which must keep working
+        (with the old data) while it runs.
+
+        The default implementation does nothing, which is appropriate for
+        backends that read the collection every time get_library_contents is
+        called.
+        """
+        pass
+
+    def needs_reload(self):
+        """
+        Return whether the library was loaded from a saved copy that may be
+        out of date, so that it should be reloaded (see reload) as soon as
+        possible.
+        """
+        return False
+
+    def watch(self, callback):
+        """
+        Start watching the collection for changes, in the background. When it
+        changes, callback is called (from another thread) with a function
+        that brings this backend up to date, like reload does but possibly
+        more cheaply, and returns whether anything changed.
+
+        Raises NotImplementedError if the backend can't watch for changes, or
+        OSError if watching fails.
+        """
+        raise NotImplementedError()
+
+    # TranscodeCache used to store encoded streams, or None if encoded streams
+    # should not be cached. See set_transcode_cache.
+    transcode_cache = None
+
+    def set_transcode_cache(self, cache):
+        """
+        Cache the output of get_content in the given cache.TranscodeCache.
+        """
+        self.transcode_cache = cache
+
+    # TranscodeSlots limiting the number of encoders we run at once, or None
+    # if there's no limit. See set_transcode_slots.
+    transcode_slots = None
+
+    def set_transcode_slots(self, slots):
+        """
+        Limit the number of encoders that run at once with the given
+        TranscodeSlots.
+        """
+        self.transcode_slots = slots
+
+    # Prefetcher used to encode streams ahead of time, or None if streams
+    # should not be prefetched. See set_prefetcher.
+    prefetcher = None
+
+    def set_prefetcher(self, prefetcher):
+        """
+        Encode the streams requested with prefetch_content ahead of time with
+        the given Prefetcher.
+        """
+        self.prefetcher = prefetcher
+
+    def get_content(self, key, out_stream, bitrate, buffered=False, start=0):
         """
         Retrieve the file data associated with the specified key and write an
         audio/ogg encoded version to out_stream.
+
+        If start is nonzero, the encoded version begins that many seconds
+        into the song.
         """
         # This is a convenience implementation of this method.
         try:
-            filename = self.get_filename_from_key(key)
-        except KeyError:
+            content = self.open_content(key, bitrate, start)
+        except (KeyError, ValueError):
             print "Received invalid request for key %r" % (key,)
-        try:
-            filename_to_stream(filename, out_stream, bitrate, buffered)
+            return
         except StreamGenerationError, e:
             print "Error: %s" % (e,)
+            return
+        copy_content(content, out_stream, bitrate, buffered)
+
+    def open_content(self, key, bitrate, start=0, client=None, prefetch=False,
+                     start_transcode=None, acquire_slot=None,
+                     format=DEFAULT_FORMAT):
+        """
+        Return a version of the file data associated with the specified key,
+        encoded in the given format (audio/ogg by default), as returned by
+        open_stream. The caller must close (or, for a TranscodeReader,
+        release) the returned object.
+
+        If a new encoder has to be started and the number of encoders is
+        limited (see set_transcode_slots), wait for a slot on behalf of the
+        given client. prefetch indicates that the stream isn't going to be
+        played right away. Alternatively, a different acquire_slot function
+        may be supplied (see join_transcode).
+
+        If the client's prefetch (see prefetch_content) is for this stream,
+        the prefetched stream is returned. If the client has skipped to a
+        different song, the prefetch is cancelled (see Prefetcher.claim).
+
+        Raises KeyError (or ValueError) if the key is not valid, and
+        StreamGenerationError (or TranscodeBusyError) if the data can't be
+        encoded.
+        """
+        filename = self.get_filename_from_key(key)
+        if self.prefetcher is not None and client is not None:
+            # Only complete streams are prefetched.
+            reader = self.prefetcher.claim(client,
+                                           (filename, bitrate, format),
+                                           complete=not start)
+            if reader is not None:
+                print "Serving prefetched stream for %s" % (filename,)
+                return reader
+        slots = self.transcode_slots
+        if acquire_slot is None and slots is not None:
+            acquire_slot = lambda: slots.acquire(client, prefetch)
+        return open_stream(filename, bitrate, self.transcode_cache, start,
+                           start_transcode, acquire_slot, format)
+
+    def prefetch_content(self, key, bitrate, client, start_transcode=None,
+                         call_soon=None, format=DEFAULT_FORMAT):
+        """
+        Start encoding the file data associated with the specified key in the
+        given format, in the background (as a low-priority request of the
+        given client), so that it is ready by the time the client requests it
+        with open_content. This has no effect unless a Prefetcher has been
+        set.
+
+        See join_transcode for the meaning of start_transcode, and
+        Prefetcher.start for call_soon.
+
+        Raises KeyError (or ValueError) if the key is not valid.
+        """
+        filename = self.get_filename_from_key(key)
+        if self.prefetcher is None:
+            return
+        print "Prefetching %s" % (filename,)
+        def open_prefetch(acquire_slot):
+            return open_stream(filename, bitrate, self.transcode_cache,
+                               start_transcode=start_transcode,
+                               acquire_slot=acquire_slot, format=format)
+        self.prefetcher.start(client, (filename, bitrate, format),
+                              open_prefetch, self.transcode_slots, call_soon)
+
+    def get_prefetch_bitrate(self, key, client, format=DEFAULT_FORMAT):
+        """
+        Return the bitrate of the client's prefetch (see prefetch_content) if
+        it's for the file data associated with the specified key, in the
+        given format, or None otherwise.
+
+        Raises KeyError (or ValueError) if the key is not valid.
+        """
+        filename = self.get_filename_from_key(key)
+        if self.prefetcher is None:
+            return None
+        stream_id = self.prefetcher.get_stream_id(client)
+        if stream_id is None:
+            return None
+        prefetch_filename, bitrate, prefetch_format = stream_id
+        if prefetch_filename != filename or prefetch_format != format:
+            return None
+        return bitrate
+
+    def get_complete_content(self, key, bitrate, format=DEFAULT_FORMAT):
+        """
+        Return a file object containing the complete encoded data (in the
+        given format) associated with the specified key, or None if that data
+        is not immediately available (i.e. it would have to be encoded first).
+        """
+        try:
+            filename = self.get_filename_from_key(key)
+        except (KeyError, ValueError):
+            return None
+        if format == 'ogg' and decoders.can_pass_through(filename, bitrate):
+            try:
+                return open(filename, 'rb')
+            except IOError:
+                return None
+        if self.transcode_cache is None:
+            return None
+        try:
+            cache_key = self.transcode_cache.get_key(
+                filename, get_encode_command(bitrate, format), format)
+        except (OSError, StreamGenerationError):
+            return None
+        return self.transcode_cache.open_entry(cache_key)
 
     def get_filename_from_key(self, key):
         # Retrieve the filename that 'key' is backed by. This is not part of
-        # the public API, but is used in the default implementation of
-        # get_content.
+        # the public API, but is used in the default implementations of
+        # get_content, open_content and get_complete_content.
         #
         # Raise KeyError if the key is not valid.
         raise NotImplementedError()
 
+def assign_key(filename, keys_in_use):
+    """
+    Return the key to use for the song with the given filename.
+
+    The key is derived from a hash of the filename, so a song has the same key
+    every time Zeya runs, and clients can continue to refer to it. In the
+    unlikely event that the key is already in keys_in_use (a dict or set of
+    the keys assigned to other songs), the next free one is used instead.
+    """
+    if isinstance(filename, unicode):
+        filename = filename.encode('UTF-8')
+    key = int(int(hashlib.sha1(filename).hexdigest(), 16) % KEY_LIMIT)
+    while key in keys_in_use:
+        key = (key + 1) % KEY_LIMIT
+    return key
+
 def extract_metadata(filename, tagpy_module=tagpy):
     """
     Returns a metadata dictionary (a dictionary {ARTIST: ..., ...}) containing
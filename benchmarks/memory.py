@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Compares the memory used by a library stored as a list of dicts (along with
+# dicts mapping keys to filenames and back) and by a SongTable, and reports the
+# memory used by the SearchIndex built for the SongTable.
+#
+# Usage:
+#   benchmarks/memory.py [SONGS]
+#
+# Generates SONGS songs (default: 300000), in albums of 12 songs by artists
+# with 10 albums each. Each layout is built in a separate process, and the
+# growth of its resident set size is reported. (Linux only.)
+
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from search import SearchIndex
+from songtable import SongTable
+
+DEFAULT_SONGS = 300000
+
+def generate_songs(num_songs):
+    """
+    Iterate over the (key, title, artist, album, filename) of each song. Every
+    string is a new object, as it would be when read from a file.
+    """
+    for i in xrange(num_songs):
+        key = (i * 2654435761) % (2 ** 52)
+        artist = u'Artist %d' % (i // 120,)
+        album = u'Album %d' % (i // 12,)
+        title = u'Track %d' % (i,)
+        filename = '/home/user/Music/%s/%s/%02d - %s.ogg' \
+            % (artist, album, i % 12 + 1, title)
+        yield key, title, artist, album, filename
+
+def build_dicts(num_songs):
+    songs = []
+    key_filename = {}
+    filename_key = {}
+    for key, title, artist, album, filename in generate_songs(num_songs):
+        songs.append({'key': key, 'title': title, 'artist': artist,
+                      'album': album})
+        key_filename[key] = filename
+        filename_key[filename] = key
+    return songs, key_filename, filename_key
+
+def build_song_table(num_songs):
+    table = SongTable(generate_songs(num_songs))
+    # Build the index used to look up filenames, as serving a song would.
+    table.get_filename(table.keys[0])
+    return table
+
+def build_search_index(num_songs):
+    table = build_song_table(num_songs)
+    return table, SearchIndex(table)
+
+def get_rss():
+    """
+    Return the resident set size of this process, in bytes.
+    """
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def measure(build, num_songs):
+    """
+    Return the number of bytes by which a new process grows when it calls
+    build(num_songs) and keeps the result.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        start_rss = get_rss()
+        result = build(num_songs)
+        gc.collect()
+        os.write(write_fd, str(get_rss() - start_rss))
+        os._exit(0)
+    os.close(write_fd)
+    data = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(data)
+
+def main(args):
+    if len(args) > 1:
+        print "Usage: %s [SONGS]" % (os.path.basename(sys.argv[0]),)
+        sys.exit(1)
+    if args:
+        num_songs = int(args[0])
+    else:
+        num_songs = DEFAULT_SONGS
+    dict_size = measure(build_dicts, num_songs)
+    table_size = measure(build_song_table, num_songs)
+    index_size = measure(build_search_index, num_songs) - table_size
+    for name, size in (("Dicts", dict_size), ("SongTable", table_size)):
+        print "%-12s %7.1f MB (%d bytes per song)" \
+            % (name + ':', size / 1048576.0, size // num_songs)
+    print "Reduction: %.1fx" % (float(dict_size) / max(table_size, 1),)
+    print "%-12s %7.1f MB (%d bytes per song)" \
+        % ("SearchIndex:", index_size / 1048576.0, index_size // num_songs)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
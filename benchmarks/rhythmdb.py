@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Measures how long it takes to read a large Rhythmbox library.
+#
+# Usage:
+#   benchmarks/rhythmdb.py [ENTRIES]
+#
+# Generates a rhythmdb.xml with ENTRIES entries (default: 500000) by repeating
+# the songs in testdata/rhythmbox.xml, each time with a different location.
+# One entry in ten is a podcast or radio station instead, as in a real
+# library, and should be skipped.
+
+import os
+import re
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from rhythmbox import RhythmboxBackend
+
+TEMPLATE = os.path.join(ROOT, 'testdata', 'rhythmbox.xml')
+DEFAULT_ENTRIES = 500000
+
+NON_SONG_ENTRIES = [
+    '  <entry type="iradio">\n'
+    '    <title>Radio %d</title>\n'
+    '    <genre>Talk</genre>\n'
+    '    <location>http://radio.example.com/%d</location>\n'
+    '  </entry>\n',
+    '  <entry type="podcast-post">\n'
+    '    <title>Episode %d</title>\n'
+    '    <album>Podcast</album>\n'
+    '    <description>An episode of a podcast.</description>\n'
+    '    <location>http://podcast.example.com/%d.mp3</location>\n'
+    '  </entry>\n',
+    ]
+
+def write_library(outfile, num_entries):
+    """
+    Write a Rhythmbox library with num_entries entries to outfile, and return
+    the number of songs in it.
+    """
+    template = open(TEMPLATE).read()
+    entries = re.findall(r'  <entry type="song">.*?</entry>\n', template,
+                         re.DOTALL)
+    header = template[:template.index(entries[0])]
+    footer = template[template.rindex(entries[-1]) + len(entries[-1]):]
+    outfile.write(header)
+    num_songs = 0
+    for i in xrange(num_entries):
+        if i % 10 == 9:
+            entry = NON_SONG_ENTRIES[(i // 10) % len(NON_SONG_ENTRIES)]
+            outfile.write(entry % (i, i))
+        else:
+            entry = entries[i % len(entries)]
+            outfile.write(entry.replace('file:///', 'file:///%d/' % (i,)))
+            num_songs += 1
+    outfile.write(footer)
+    return num_songs
+
+def main(args):
+    if len(args) > 1:
+        print "Usage: %s [ENTRIES]" % (os.path.basename(sys.argv[0]),)
+        sys.exit(1)
+    if args:
+        num_entries = int(args[0])
+    else:
+        num_entries = DEFAULT_ENTRIES
+    dbfile = tempfile.TemporaryFile()
+    num_songs = write_library(dbfile, num_entries)
+    print "Generated %d entries (%d songs, %d bytes)." \
+        % (num_entries, num_songs, dbfile.tell())
+    dbfile.seek(0)
+
+    start_time = time.time()
+    backend = RhythmboxBackend(dbfile)
+    contents = backend.get_library_contents()
+    elapsed = time.time() - start_time
+    if len(contents) != num_songs:
+        print "Error: read %d songs, expected %d." % (len(contents), num_songs)
+        sys.exit(1)
+    print "Read %d songs in %.2f s (%d entries/s)" \
+        % (len(contents), elapsed, num_entries / max(elapsed, 1e-6))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
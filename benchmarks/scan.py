@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Compares serial and parallel scans of a music directory.
+#
+# Usage:
+#   benchmarks/scan.py DIRECTORY [WORKERS]
+#
+# Each scan starts cold (ignoring any zeya.db in the directory, and without
+# writing one), so every file's metadata is read. The parallel scan uses
+# WORKERS processes (default: the number of CPUs). The results of the two
+# scans are checked to be identical.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import multiprocessing
+
+from directory import DirectoryBackend
+
+class ColdDirectoryBackend(DirectoryBackend):
+    def load_previous_db(self):
+        return {}
+
+def scan(path, workers):
+    start_time = time.time()
+    backend = ColdDirectoryBackend(path, save_db=False, scan_workers=workers)
+    elapsed = time.time() - start_time
+    print "%d worker(s): %d songs in %.2f s" \
+        % (workers, len(backend.get_library_contents()), elapsed)
+    return backend, elapsed
+
+def main(args):
+    if len(args) not in (1, 2):
+        print "Usage: %s DIRECTORY [WORKERS]" % (os.path.basename(sys.argv[0]),)
+        sys.exit(1)
+    path = args[0]
+    if len(args) == 2:
+        workers = int(args[1])
+    else:
+        workers = multiprocessing.cpu_count()
+    serial, serial_time = scan(path, 1)
+    parallel, parallel_time = scan(path, workers)
+    if serial.get_library_contents() != parallel.get_library_contents() \
+            or serial.get_playlists() != parallel.get_playlists():
+        print "Error: the scans produced different results."
+        sys.exit(1)
+    print "Speedup: %.2fx" % (serial_time / max(parallel_time, 1e-6),)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# On-disk cache of encoded streams.
+#
+# Each entry holds the complete encoder output for one (source file, encoder
+# settings) pair. Entries are named after a hash of the source path, its mtime
+# and size, and the encoder command line, so a modified source file or a
+# different bitrate simply misses the cache. The hash is followed by the
+# format of the stream (e.g. '.ogg'), so each format has its own namespace of
+# entries. The least recently used entries are evicted when the total size of
+# the cache exceeds its limit.
+
+# Work with python2.5
+from __future__ import with_statement
+
+import hashlib
+import os
+import tempfile
+import threading
+
+# Suffix used for entries that are still being written.
+PARTIAL_SUFFIX = '.part'
+
+class TranscodeCache(object):
+    """
+    Cache of encoded streams, stored as files in a single directory.
+    """
+    def __init__(self, cache_dir, max_size):
+        """
+        Initializes a cache in cache_dir (which is created if necessary) that
+        holds at most max_size bytes of data.
+        """
+        self._cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self._max_size = max_size
+        # Serializes evictions, so that two concurrent fills don't race each
+        # other when deleting entries.
+        self._lock = threading.Lock()
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        # Remove partial entries left behind by a previous run.
+        for name in os.listdir(self._cache_dir):
+            if name.endswith(PARTIAL_SUFFIX):
+                try:
+                    os.remove(os.path.join(self._cache_dir, name))
+                except OSError:
+                    pass
+
+    def get_key(self, filename, encode_command, format='ogg'):
+        """
+        Return the cache key for the output of encode_command (a stream in
+        the given format) when applied to the decoded contents of filename.
+
+        Raises OSError if filename can't be read.
+        """
+        st = os.stat(filename)
+        h = hashlib.sha1()
+        h.update(repr((filename, st.st_mtime, st.st_size,
+                       tuple(encode_command))))
+        return '%s.%s' % (h.hexdigest(), format)
+
+    def get_entry_path(self, key):
+        return os.path.join(self._cache_dir, key)
+
+    def open_entry(self, key):
+        """
+        Return a file object from which the cached data for key can be read,
+        or None if there is no such entry.
+        """
+        path = self.get_entry_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        # Bump the entry's mtime, which is what eviction is based on.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def begin_fill(self, key):
+        """
+        Return a CacheFill object that accepts the data for key.
+        """
+        fd, partial_path = tempfile.mkstemp(
+            suffix=PARTIAL_SUFFIX, prefix=key + '.', dir=self._cache_dir)
+        return CacheFill(self, key, os.fdopen(fd, 'wb', 0), partial_path)
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the total size of the
+        cache is no larger than max_size.
+        """
+        with self._lock:
+            entries = []
+            total_size = 0
+            for name in os.listdir(self._cache_dir):
+                if name.endswith(PARTIAL_SUFFIX):
+                    continue
+                path = os.path.join(self._cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total_size <= self._max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+
+class CacheFill(object):
+    """
+    File-like object that writes a new cache entry.
+
+    Data is written to a temporary file, which is moved into place by commit().
+    Readers of the cache never see a partially written entry, but the data
+    written so far may be read from the temporary file, whose name is given by
+    the 'path' attribute.
+    """
+    def __init__(self, cache, key, fileobj, partial_path):
+        self._cache = cache
+        self._key = key
+        self._file = fileobj
+        self.path = partial_path
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self):
+        """
+        Publish the data written so far as the cache entry.
+        """
+        self._file.close()
+        os.rename(self.path, self._cache.get_entry_path(self._key))
+        self._cache.evict()
+
+    def abort(self):
+        """
+        Discard the data written so far.
+        """
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
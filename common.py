@@ -22,6 +22,10 @@
 
 import re
 
+# Splits a filename into runs of digits, slashes, and everything else.
+FILENAME_TOKEN_RE = re.compile(r'(/|\d+)')
+DIGITS = frozenset('0123456789')
+
 def tokenize_filename(filename):
     """
     Return a list such that sorting a list of filenames by tokenize_filename(f)
@@ -32,15 +36,42 @@ def tokenize_filename(filename):
     # Sort lexicographically by components of the path, except we treat runs of
     # digits as separate components and sort those by numeric value. That way
     # we can, for example, sort "9.ogg" and "10.ogg" in the sensible way.
-    def maybe_convert_to_int(s):
-        """
-        Return int(s) if s represents an integer and s otherwise.
-
-        s: a string
-        """
-        try:
-            return int(s)
-        except ValueError:
-            # Normalize case so we alphabetize logically.
-            return s.lower()
-    return [maybe_convert_to_int(s) for s in re.split(r'(/|\d+)', filename)]
+    # Runs of digits are the only tokens that start with a digit. Other tokens
+    # are normalized to lower case so we alphabetize logically.
+    return [int(s) if s[:1] in DIGITS else s.lower()
+            for s in FILENAME_TOKEN_RE.split(filename)]
+
+def parse_byte_range(range_header, size):
+    """
+    Parse the value of an HTTP Range header for an entity of the given size.
+
+    Returns a tuple (first, last) giving the (inclusive) offsets of the first
+    and last bytes requested. Returns None if the range can't be satisfied.
+    Raises ValueError if the header is malformed, or requests more than one
+    range, in which case it should be ignored.
+
+    range_header: string such as 'bytes=0-499', 'bytes=500-' or 'bytes=-500'
+    size: total size of the entity in bytes
+    """
+    units, _, range_spec = range_header.strip().partition('=')
+    if units.strip().lower() != 'bytes' or ',' in range_spec:
+        raise ValueError("Unsupported range %r" % (range_header,))
+    first, _, last = range_spec.strip().partition('-')
+    first = first.strip()
+    last = last.strip()
+    if not first:
+        # A suffix range (e.g. 'bytes=-500') requests the last N bytes.
+        suffix_length = int(last)
+        if suffix_length <= 0 or size == 0:
+            return None
+        return (max(0, size - suffix_length), size - 1)
+    first = int(first)
+    if last:
+        last = int(last)
+        if first > last:
+            raise ValueError("Invalid range %r" % (range_header,))
+    else:
+        last = size - 1
+    if first >= size:
+        return None
+    return (first, min(last, size - 1))
@@ -21,6 +21,7 @@
 # Logic for selecting which decoder to run for a given file.
 
 import os
+import struct
 
 # TODO: detect available decoders at startup and disable extensions if they
 # can't be played.
@@ -33,6 +34,17 @@ decoders = {
     'm4a': ("/usr/bin/faad", "-w", "-q"),
     }
 
+# Options that make a decoder begin decoding partway into a file, for the
+# decoders that support this. Each function takes an offset in seconds and
+# returns the arguments to add to the command line (before the filename).
+decoder_seek_options = {
+    'flac': lambda seconds: ("--skip=%d:%06.3f" % divmod(seconds, 60),),
+    }
+
+# The encoder reads the decoder output as raw 16-bit stereo samples at 44.1
+# kHz. This is the number of bytes of such data per second of audio.
+PCM_BYTES_PER_SECOND = 44100 * 2 * 2
+
 decoder_messages = {
     'flac': "/usr/bin/flac not found. Please install 'flac' to play .flac files.",
     'mp3': "/usr/bin/mpg123 not found. Please install 'mpg123' to play .mp3 files.",
@@ -40,6 +52,11 @@ decoder_messages = {
     'm4a': "/usr/bin/faad not found. Please install 'faad' to play .m4a files.",
     }
 
+# Number of bytes to read from the start of an Ogg file in order to find the
+# Vorbis identification header. This header is always alone on the first Ogg
+# page, and is much shorter than this.
+OGG_HEADER_READ_SIZE = 512
+
 # The set of extensions for which we've warned the user that the decoder is not
 # available. We maintain this set so we don't prompt the user more than once
 # for the same codec.
@@ -78,12 +95,70 @@ def is_decoder_registered(filename):
         return False
     return decoders.has_key(extension)
 
-def get_decoder(filename):
+def get_decoder(filename, start=0):
     """
     Returns a command line for decoding the given filename.
 
     This command line can be passed to subprocess.Popen, and writes all data to
-    stdout.
+    stdout. If start is nonzero and the decoder supports it (see
+    decoder_can_seek), decoding begins that many seconds into the file.
     """
     extension = get_extension(filename)
-    return list(decoders[extension] + (filename,))
+    seek_args = ()
+    if start and extension in decoder_seek_options:
+        seek_args = decoder_seek_options[extension](start)
+    return list(decoders[extension] + seek_args + (filename,))
+
+def decoder_can_seek(filename):
+    """
+    Returns True if the decoder for the given filename can begin decoding
+    partway into the file.
+    """
+    return get_extension(filename) in decoder_seek_options
+
+def get_pcm_offset(seconds):
+    """
+    Returns the offset in the decoder output (in bytes) that corresponds to
+    the given time.
+    """
+    # Round down to a whole sample frame so the channels stay aligned.
+    return int(seconds * PCM_BYTES_PER_SECOND) // 4 * 4
+
+def get_vorbis_nominal_bitrate(filename):
+    """
+    Returns the nominal bitrate (bits/sec) recorded in the header of the given
+    Ogg Vorbis file, or None if the file is not an Ogg Vorbis file or does not
+    specify a nominal bitrate.
+    """
+    try:
+        f = open(filename, 'rb')
+        try:
+            header = f.read(OGG_HEADER_READ_SIZE)
+        finally:
+            f.close()
+    except IOError:
+        return None
+    # The Ogg page header is 27 bytes long, followed by a table of segment
+    # lengths, the size of which is given by the last byte of the header.
+    if len(header) < 27 or not header.startswith('OggS'):
+        return None
+    packet_start = 27 + ord(header[26])
+    packet = header[packet_start:packet_start + 30]
+    if len(packet) < 30 or not packet.startswith('\x01vorbis'):
+        return None
+    (version, channels, sample_rate, bitrate_maximum, bitrate_nominal,
+     bitrate_minimum) = struct.unpack('<IBIiii', packet[7:28])
+    if version != 0 or bitrate_nominal <= 0:
+        return None
+    return bitrate_nominal
+
+def can_pass_through(filename, bitrate):
+    """
+    Returns True if the given file can be served as-is in place of a stream
+    encoded at the specified bitrate (kbits/sec). That is the case for Ogg
+    Vorbis files whose nominal bitrate is no higher than that.
+    """
+    if get_extension(filename) != 'ogg':
+        return False
+    nominal_bitrate = get_vorbis_nominal_bitrate(filename)
+    return nominal_bitrate is not None and nominal_bitrate <= bitrate * 1000
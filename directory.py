@@ -21,46 +21,259 @@
 # Directory backend.
 #
 # Files in the specified directory are read for artist/title/album tag which is
-# then saved in a database (zeya.db) stored in that directory.
+# then saved in a database (zeya.db) stored in that directory. (See metadb.py;
+# older versions of Zeya saved a pickle there instead.)
 
+import array
+import copy
+import itertools
 import os
+import select
+from stat import S_ISDIR
 import tagpy
 import pickle
+import threading
+import time
+import traceback
 
+try:
+    import multiprocessing
+    import multiprocessing.pool
+except ImportError:
+    # Python 2.5 and earlier don't have multiprocessing; we'll always scan
+    # serially.
+    multiprocessing = None
+
+import inotify
+import metadb
 from backends import LibraryBackend
+from backends import TITLE, ARTIST, ALBUM
+from backends import assign_key
 from backends import extract_metadata
 from common import tokenize_filename
 from m3u import M3uPlaylist
 from pls import PlsPlaylist
+from songtable import SongTable
 
 KEY = 'key'
 
+# Keys of the pickled database used by older versions.
 DB = 'db'
 KEY_FILENAME = 'key_filename'
 MTIMES = 'mtimes'
 
+# When watching for changes, wait until no events have arrived for BATCH_DELAY
+# seconds (but no more than MAX_BATCH_DELAY seconds in all) before updating the
+# library, so that copying a whole album in results in a single update.
+BATCH_DELAY = 2
+MAX_BATCH_DELAY = 30
+
+# Number of threads used to stat files in a parallel scan (these mostly wait
+# for the disk, or the network if the music is on a file server), and the
+# number of files handed to each worker process at a time.
+STAT_THREADS = 16
+SCAN_CHUNK_SIZE = 32
+
+# The listing of a directory is only saved if its mtime is at least this many
+# seconds old, since a directory could change again within the same tick of a
+# coarse-grained mtime without its mtime changing.
+MTIME_GRANULARITY = 2
+
+def is_playlist(filename):
+    return filename.lower().endswith('.m3u') \
+        or filename.lower().endswith('.pls')
+
+def walk(path):
+    """
+    Like os.walk, but follow symlinks if possible.
+    """
+    try:
+        return os.walk(path, followlinks=True)
+    except TypeError:
+        # os.walk in Python 2.5 and earlier don't support the followlinks
+        # argument. Fall back to not including it (in this case, Zeya will
+        # not index music underneath symlinked directories).
+        return os.walk(path)
+
+def find_files(path):
+    """
+    Return the absolute paths of the files in the given directory (and its
+    subdirectories), or [path] if path is a file.
+    """
+    if not os.path.isdir(path):
+        return [os.path.abspath(path)]
+    filenames = []
+    for dirpath, dirs, files in walk(path):
+        for filename in files:
+            filenames.append(os.path.abspath(os.path.join(dirpath, filename)))
+    return filenames
+
+def list_directory(path):
+    """
+    Return the names of the files and of the subdirectories in the given
+    directory, each as a tuple in the order in which they should be visited.
+    Broken symlinks are omitted.
+    """
+    files = []
+    subdirs = []
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return (), ()
+    for name in names:
+        try:
+            mode = os.stat(os.path.join(path, name)).st_mode
+        except OSError:
+            continue
+        if S_ISDIR(mode):
+            subdirs.append(name)
+        else:
+            files.append(name)
+    files.sort(key=get_name_sort_key)
+    subdirs.sort(key=get_name_sort_key)
+    return tuple(files), tuple(subdirs)
+
+def get_name_sort_key(name):
+    """
+    Return a key such that sorting the names of the files (or of the
+    subdirectories) in a directory by it puts them in the order in which they
+    are visited. Names that tokenize the same way are ordered by the names
+    themselves, so that the order doesn't depend on that of os.listdir.
+    """
+    return (tokenize_filename(name), name)
+
+def get_stats(filename):
+    """
+    Return the (mtime, size) of the given file, or None if it can't be read.
+    """
+    if u'\0' in filename:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+def is_fresh(cached_stats, stats):
+    """
+    Return whether metadata that was read from a file when it had the given
+    (mtime, size) cached_stats is still valid, now that it has the given
+    stats. (The size may be unknown, as in databases migrated from older
+    versions, in which case only the mtime is checked.)
+    """
+    cached_mtime, cached_size = cached_stats
+    mtime, size = stats
+    return cached_mtime is not None and cached_mtime >= mtime \
+        and (cached_size is None or cached_size == size)
+
+def read_metadata(filename):
+    """
+    Return the metadata for the given file, or None if it's not something we
+    could play. (This runs in the worker processes of a parallel scan.)
+    """
+    try:
+        return extract_metadata(filename)
+    except ValueError:
+        return None
+
+class FileTable(SongTable):
+    """
+    A SongTable that also holds the (mtime, size) of each song's file, in
+    arrays rather than a tuple per song.
+    """
+    def __init__(self):
+        SongTable.__init__(self)
+        self.mtimes = array.array('d')
+        # The sizes of files whose size wasn't recorded (by older versions)
+        # are stored as -1.
+        self.sizes = array.array('d')
+
+    def append(self, key, title, artist, album, filename, mtime, size):
+        SongTable.append(self, key, title, artist, album, filename)
+        self.mtimes.append(mtime)
+        if size is None:
+            size = -1
+        self.sizes.append(size)
+
+    def _copy_rows(self, indices):
+        table = SongTable._copy_rows(self, indices)
+        table.mtimes = array.array('d', [self.mtimes[i] for i in indices])
+        table.sizes = array.array('d', [self.sizes[i] for i in indices])
+        return table
+
+    def get_file_stats(self, index):
+        """
+        Return the (mtime, size) of the file of the song at the given index.
+        """
+        size = self.sizes[index]
+        if size < 0:
+            return (self.mtimes[index], None)
+        return (self.mtimes[index], int(size))
+
+    def stat_rows(self):
+        """
+        Iterate over the (key, title, artist, album, filename, mtime, size) of
+        each song.
+        """
+        for index, row in enumerate(self.rows()):
+            yield row + self.get_file_stats(index)
+
+    def get_metadb_row(self, index):
+        """
+        Return the row that is stored in the database for the song at the
+        given index (see metadb.make_row).
+        """
+        mtime, size = self.get_file_stats(index)
+        return metadb.make_row(mtime, size, {TITLE: self.titles[index],
+                                             ARTIST: self.artists[index],
+                                             ALBUM: self.albums[index]})
+
+    def __eq__(self, other):
+        if isinstance(other, FileTable) and (self.mtimes != other.mtimes
+                                             or self.sizes != other.sizes):
+            return False
+        return SongTable.__eq__(self, other)
+
 class DirectoryBackend(LibraryBackend):
     """
     Object that controls access to music in a given directory.
     """
-    def __init__(self, media_path, save_db=True):
+    def __init__(self, media_path, save_db=True, scan_workers=1):
         """
         Initializes a DirectoryBackend that reads from the specified directory.
 
         save_db can be set to False to prevent the db from being written back
         to disk. This is probably only useful for debugging purposes.
+
+        If scan_workers is greater than 1, the metadata of new and modified
+        files is read by that many processes at once. The results are the
+        same as those of a serial scan.
         """
         self._media_path = os.path.expanduser(media_path)
         self._save_db = save_db
-        # Sequence of dicts containing song metadata (key, artist, title, album)
-        self.db = []
+        self._scan_workers = scan_workers
+        if scan_workers > 1 and multiprocessing is None:
+            print "Warning: parallel scans require Python 2.6 or later."
+            self._scan_workers = 1
+        # FileTable containing the songs (key, artist, title, album, and
+        # filename, and the mtime and size of the file)
+        self.db = FileTable()
         # Playlists
         self._playlists = []
-        # Dict mapping keys to source filenames and vice versa
-        self.key_filename = {}
-        self.filename_key = {}
-        # Dict mapping filenames to mtimes
-        self.mtimes = {}
+        # While scanning, a dict mapping the filenames of the songs found so
+        # far to their keys, and the set of those keys (see start_scan)
+        self._scan_keys = None
+        self._keys_in_use = None
+        # Dict mapping each directory to its (mtime, files, subdirs) as of the
+        # last scan (see list_files)
+        self.directories = {}
+        # The contents of the database on disk (as a FileTable, whose keys
+        # aren't meaningful, and in the form returned by
+        # metadb.MetadataStore.load_directories), so save_db can write only
+        # what changed.
+        self._saved_db = FileTable()
+        self._saved_directories = {}
+        self._store = metadb.MetadataStore(self.get_db_filename())
 
         self.setup_db()
 
@@ -72,14 +285,64 @@ class DirectoryBackend(LibraryBackend):
         # representation where it can serve as a metadata cache (keyed by
         # filename) when we load the file collection.
         previous_db = self.load_previous_db()
-        self.fill_db(previous_db)
+        self.fill_db(previous_db, self._saved_directories)
         if self._save_db:
             self.save_db()
 
     def load_previous_db(self):
         """
         Read the existing database on disk and return a dict mapping each
-        filename to the (mtime, metadata) associated with the filename.
+        filename to the (mtime, size, metadata) associated with the filename.
+        A pickled database from an older version is converted first.
+        """
+        db_filename = self.get_db_filename()
+        try:
+            if os.path.exists(db_filename) \
+                    and not metadb.is_sqlite_file(db_filename):
+                if not self._save_db:
+                    return self.load_pickled_db()
+                self.migrate_pickled_db()
+            rows = self._store.load()
+            self._saved_directories = self._store.load_directories()
+        except (IOError, OSError, metadb.Error), e:
+            print "Warning: couldn't read the metadata cache %r: %s" \
+                % (db_filename, e)
+            rows = {}
+            self._saved_directories = {}
+        previous_db = {}
+        self._saved_db = FileTable()
+        for filename, row in rows.iteritems():
+            mtime, size, title, artist, album = row
+            previous_db[filename] = \
+                (mtime, size, {'title': title, 'artist': artist,
+                               'album': album})
+            self._saved_db.append(0, title, artist, album, filename, mtime,
+                                  size)
+        return previous_db
+
+    def migrate_pickled_db(self):
+        """
+        Replace the pickled database on disk with an equivalent SQLite one.
+        """
+        print "Converting the metadata cache to the new format..."
+        pickled_db = self.load_pickled_db()
+        db_filename = self.get_db_filename()
+        # Build the new database alongside the old one, then move it into
+        # place, so we never leave a partially written database behind.
+        new_filename = db_filename + '.new'
+        if os.path.exists(new_filename):
+            os.remove(new_filename)
+        rows = {}
+        for filename, (mtime, size, metadata) in pickled_db.iteritems():
+            rows[filename] = metadb.make_row(mtime, size, metadata)
+        metadb.MetadataStore(new_filename).update(rows, [])
+        os.rename(new_filename, db_filename)
+
+    def load_pickled_db(self):
+        """
+        Read a pickled database written by an older version, and return it in
+        the same form as load_previous_db. (The sizes of the files weren't
+        recorded, so they're None.)
         """
         filename_to_metadata_map = {}
         try:
@@ -94,78 +357,158 @@ class DirectoryBackend(LibraryBackend):
             # with that file.
             for (key, filename) in info[KEY_FILENAME].iteritems():
                 filename_to_metadata_map[filename] = \
-                    (prev_mtimes[filename], key_to_metadata_map[key])
-        except IOError:
+                    (prev_mtimes[filename], None, key_to_metadata_map[key])
+        except (IOError, EOFError, pickle.UnpicklingError, KeyError):
             # Couldn't read the file. Just return an empty data structure.
             pass
         return filename_to_metadata_map
 
+    def reload(self):
+        """
+        Rescan the directory. Only files that are new or have been modified
+        are read again. Unlike the scan on startup, this checks every file,
+        even in directories that haven't changed.
+        """
+        previous_db = {}
+        for key, title, artist, album, filename, mtime, size \
+                in self.db.stat_rows():
+            previous_db[filename] = \
+                (mtime, size, {TITLE: title, ARTIST: artist, ALBUM: album})
+        # Scan into a copy of this backend, so that requests can keep using
+        # the current data in the meantime, then switch over to the results.
+        scan = copy.copy(self)
+        scan._playlists = []
+        scan.fill_db(previous_db)
+        self.directories = scan.directories
+        self._playlists = scan._playlists
+        self.db = scan.db
+        if self._save_db:
+            self.save_db()
+
     def save_db(self):
-        self.info = {DB: self.db,
-                     MTIMES: self.mtimes,
-                     KEY_FILENAME: self.key_filename}
+        """
+        Write the metadata of any songs that have been added or modified since
+        the database was last read or written, and remove the songs that are
+        gone, in a single transaction. The directory listings are updated in
+        the same way.
+        """
+        db = self.db
+        saved_db = self._saved_db
+        changed_rows = {}
+        for index, filename in enumerate(db.filenames):
+            row = db.get_metadb_row(index)
+            try:
+                saved_row = saved_db.get_metadb_row(
+                    saved_db.find_filename(filename))
+            except KeyError:
+                saved_row = None
+            if row != saved_row:
+                changed_rows[filename] = row
+        filenames = set(db.filenames)
+        removed = [filename for filename in saved_db.filenames
+                   if filename not in filenames]
+        changed_directories = {}
+        for path, listing in self.directories.iteritems():
+            if self._saved_directories.get(path) != listing:
+                changed_directories[path] = listing
+        removed_directories = [path for path in self._saved_directories
+                               if path not in self.directories]
         try:
-            pickle.dump(self.info, open(self.get_db_filename(), 'wb+'))
-        except IOError, e:
+            if changed_rows or removed or changed_directories \
+                    or removed_directories:
+                self._store.update(changed_rows, removed,
+                                   changed_directories, removed_directories)
+            self._saved_db = db
+            self._saved_directories = self.directories
+        except (IOError, OSError, metadb.Error), e:
             print "Warning: the metadata cache could not be written to disk:"
             print "  " + str(e)
             print "(Zeya will continue, but the directory will need to be",
             print "re-scanned the next time Zeya is run.)"
 
-    def write_metadata(self, filename, previous_db):
+    def start_scan(self, db=None):
+        """
+        Prepare to add songs to the database with write_metadata, starting
+        with the songs in db (a FileTable), if supplied.
+        """
+        if db is None:
+            db = FileTable()
+        self.db = db
+        self._scan_keys = dict(itertools.izip(self.db.filenames, self.db.keys))
+        self._keys_in_use = set(self.db.keys)
+
+    def finish_scan(self):
+        self._scan_keys = None
+        self._keys_in_use = None
+
+    def write_metadata(self, filename, previous_db, stats=None):
         """
         Obtains and writes the metadata for the specified FILENAME to the
         database. The metadata may be found by looking in the cache
         (PREVIOUS_DB), and failing that, by pulling the metadata from the file
         itself.
 
-        Returns the key associated with the filename.
+        STATS, if supplied, maps filenames to their current (mtime, size) (see
+        list_files and read_metadata_in_parallel), so we don't have to stat
+        them again.
+
+        Returns the key associated with the filename. (This may only be called
+        during a scan; see start_scan.)
         """
-        if filename in self.filename_key:
+        if filename in self._scan_keys:
             # First, if the filename is already in our database, we don't have
             # to do anything. We can encounter the same filename twice if a
             # playlist contains a reference to a file we've already scanned.
-            key = self.filename_key[filename]
+            key = self._scan_keys[filename]
         else:
             # The filename is not in the database. We have to obtain a metadata
             # entry, either by reading it out of our cache, or by calling out
             # to tagpy.
             #
-            # previous_db acts as a cache of mtime and metadata, keyed by
-            # filename.
-            rec_mtime, old_metadata = previous_db.get(filename, (None, None))
+            # previous_db acts as a cache of mtime, size, and metadata, keyed
+            # by filename.
+            rec_mtime, rec_size, old_metadata = \
+                previous_db.get(filename, (None, None, None))
             if u'\0' in filename:
                 # This can happen when the playlist files are malformed;
                 # detect this condition here because stat below gives an
                 # unenlightening error message.
                 raise ValueError('Encountered invalid filename: %r' % (filename,))
-            file_mtime = os.stat(filename).st_mtime
+            if stats is not None and filename in stats:
+                file_stats = stats[filename]
+            else:
+                stat = os.stat(filename)
+                file_stats = (stat.st_mtime, stat.st_size)
 
-            if rec_mtime is not None and rec_mtime >= file_mtime:
-                # Use cached data. However, we potentially renumber the keys
-                # every time the program runs, so the old KEY is no good. We'll
-                # fix up the KEY field below.
+            if is_fresh((rec_mtime, rec_size), file_stats):
+                # Use cached data.
+                if old_metadata is None:
+                    # A parallel scan already found that this isn't something
+                    # we can play.
+                    raise ValueError("Error reading metadata from %r"
+                                     % (filename,))
                 metadata = old_metadata
             else:
                 # In this branch, we actually need to read the file and
                 # extract its metadata.
                 metadata = extract_metadata(filename)
 
-            # Assign a key for this song. These are just integers assigned
-            # sequentially.
-            key = len(self.key_filename)
-            metadata[KEY] = key
+            # Assign a key for this song, which is the same every time the
+            # directory is scanned.
+            key = assign_key(filename, self._keys_in_use)
 
-            self.db.append(metadata)
-            self.key_filename[key] = filename
-            self.filename_key[filename] = key
-            self.mtimes[filename] = file_mtime
+            mtime, size = file_stats
+            self.db.append(key, metadata[TITLE], metadata[ARTIST],
+                           metadata[ALBUM], filename, mtime, size)
+            self._keys_in_use.add(key)
+            self._scan_keys[filename] = key
 
         return key
 
-    def fill_db(self, previous_db):
+    def fill_db(self, previous_db, directories=None):
         """
-        Populate the database, given the output of load_previous_db.
+        Populate the database, given the output of load_previous_db, and the
+        directory listings from the last scan, if any (see list_files).
         """
         # By default, os.walk will happily accept a non-existent directory and
         # return an empty sequence. Detect the case of a non-existent path and
@@ -173,26 +516,90 @@ class DirectoryBackend(LibraryBackend):
         if not os.path.exists(self._media_path):
             raise IOError("Error: directory %r doesn't exist." % (self._media_path,))
         print "Scanning for music in %r..." % (os.path.abspath(self._media_path),)
-        # Iterate over all the files.
-        try:
-            all_files_recursively = os.walk(self._media_path, followlinks=True)
-        except TypeError:
-            # os.walk in Python 2.5 and earlier don't support the followlinks
-            # argument. Fall back to not including it (in this case, Zeya will
-            # not index music underneath symlinked directories).
-            all_files_recursively = os.walk(self._media_path)
-        for path, dirs, files in all_files_recursively:
-            # Sort dirs so that subdirectories will subsequently be visited
-            # alphabetically (see os.walk).
-            dirs.sort(key=tokenize_filename)
-            for filename in sorted(files, key=tokenize_filename):
-                filename = os.path.abspath(os.path.join(path, filename))
-
-                # Skip broken symlinks
-                if not os.path.exists(filename):
+        files, stats = self.list_files(previous_db, directories)
+        if self._scan_workers > 1:
+            self.read_metadata_in_parallel(files, previous_db, stats)
+        self.start_scan()
+        # Add the files in order, so that they're numbered the same way no
+        # matter how their metadata was read.
+        for filename, playlist in files:
+            if playlist is not None:
+                items = []
+                for song_filename in playlist.get_filenames():
+                    try:
+                        song_key = self.write_metadata(
+                            song_filename, previous_db, stats)
+                    except (OSError, ValueError):
+                        continue
+                    items.append(song_key)
+                self._playlists.append(
+                    {'name' : playlist.get_title(), 'items': items})
+            else:
+                # Encountered what is possibly a regular music file.
+                try:
+                    self.write_metadata(filename, previous_db, stats)
+                except (OSError, ValueError):
+                    continue
+        self.finish_scan()
+        # Playlists can refer to songs before we reach them (or outside the
+        # directory), so put the songs in order afterwards.
+        self.sort_db()
+
+    def list_files(self, previous_db, directories=None):
+        """
+        Return a list of (filename, playlist) for each file in the directory,
+        in the order in which they should be added to the database. playlist
+        is the parsed playlist if the file is one, and None otherwise.
+
+        The listing of each directory is saved in self.directories. If
+        directories (the listings from the last scan) are supplied, a
+        directory whose mtime hasn't changed since then isn't listed again,
+        and the files in it are assumed to be unchanged too: their (mtime,
+        size) in previous_db are returned in a dict, which write_metadata
+        uses instead of statting them. (Modifying a file in place doesn't
+        change the mtime of its directory, so such changes aren't noticed
+        until the library is reloaded.)
+        """
+        result = []
+        stats = {}
+        self.directories = {}
+        if directories is None:
+            directories = {}
+        db_filename = os.path.abspath(self.get_db_filename())
+        scan_time = time.time()
+        # Visit each directory's files, then its subdirectories, in order.
+        pending = [os.path.abspath(self._media_path)]
+        while pending:
+            path = pending.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            listing = directories.get(path)
+            if listing is not None and listing[0] == mtime:
+                files, subdirs = listing[1:]
+                unchanged = True
+            else:
+                # Stat the directory before listing it, so any changes made
+                # while we're listing it will show up next time.
+                files, subdirs = list_directory(path)
+                unchanged = False
+            if mtime < scan_time - MTIME_GRANULARITY:
+                self.directories[path] = (mtime, files, subdirs)
+            pending.extend([os.path.join(path, subdir)
+                            for subdir in reversed(subdirs)])
+
+            for filename in files:
+                filename = os.path.join(path, filename)
+
+                # Skip the database (and SQLite's temporary files).
+                if filename.startswith(db_filename):
                     continue
 
-                if filename.lower().endswith('.m3u') or filename.lower().endswith('.pls'):
+                if unchanged and filename in previous_db:
+                    stats[filename] = previous_db[filename][:2]
+
+                if is_playlist(filename):
                     # Encountered a playlist file.
                     try:
                         fileobj = open(filename)
@@ -203,22 +610,155 @@ class DirectoryBackend(LibraryBackend):
                         playlist = M3uPlaylist(filename, fileobj)
                     elif filename.lower().endswith('.pls'):
                         playlist = PlsPlaylist(filename, fileobj)
-                    items = []
-                    for song_filename in playlist.get_filenames():
-                        try:
-                            song_key = self.write_metadata(
-                                song_filename, previous_db)
-                        except (OSError, ValueError):
-                            continue
-                        items.append(song_key)
-                    self._playlists.append(
-                        {'name' : playlist.get_title(), 'items': items})
+                    result.append((filename, playlist))
                 else:
-                    # Encountered what is possibly a regular music file.
-                    try:
-                        self.write_metadata(filename, previous_db)
-                    except (OSError, ValueError):
-                        continue
+                    result.append((filename, None))
+        return result, stats
+
+    def read_metadata_in_parallel(self, files, previous_db, stats):
+        """
+        Given the output of list_files, stat the songs whose (mtime, size)
+        aren't already known using a pool of threads, and add them to stats.
+        Then read the metadata of the new and modified songs using a pool of
+        processes, and add it to previous_db (with None as the metadata of
+        files that can't be read).
+        """
+        filenames = []
+        for filename, playlist in files:
+            if playlist is not None:
+                filenames.extend(playlist.get_filenames())
+            else:
+                filenames.append(filename)
+        filenames = [filename for filename in set(filenames)
+                     if filename not in stats]
+
+        threads = multiprocessing.pool.ThreadPool(STAT_THREADS)
+        try:
+            file_stats = threads.map(get_stats, filenames, SCAN_CHUNK_SIZE)
+        finally:
+            threads.close()
+            threads.join()
+        stale_filenames = []
+        for filename, current_stats in zip(filenames, file_stats):
+            if current_stats is None:
+                continue
+            stats[filename] = current_stats
+            cached_stats = previous_db.get(filename, (None, None))[:2]
+            if not is_fresh(cached_stats, current_stats):
+                stale_filenames.append(filename)
+        if not stale_filenames:
+            return
+
+        print "Reading metadata from %d files using %d processes..." \
+            % (len(stale_filenames), self._scan_workers)
+        processes = multiprocessing.Pool(self._scan_workers)
+        try:
+            results = processes.map(read_metadata, stale_filenames,
+                                    SCAN_CHUNK_SIZE)
+        finally:
+            processes.close()
+            processes.join()
+        for filename, metadata in zip(stale_filenames, results):
+            previous_db[filename] = stats[filename] + (metadata,)
+
+    def get_sort_key(self, filename):
+        """
+        Return a key such that sorting filenames by it puts them in the order
+        in which list_files visits them.
+        """
+        media_path = os.path.abspath(self._media_path) + os.sep
+        if filename.startswith(media_path):
+            filename = filename[len(media_path):]
+        components = filename.split(os.sep)
+        # Each directory's files are visited before its subdirectories.
+        return [(1, get_name_sort_key(directory))
+                for directory in components[:-1]] \
+            + [(0, get_name_sort_key(components[-1]))]
+
+    def sort_db(self):
+        """
+        Sort the songs into the order in which list_files visits them (see
+        get_sort_key). Both fill_db and update_files do this, so the library
+        is the same no matter how it was built.
+        """
+        self.db = self.db.sort_by_filename(self.get_sort_key)
+
+    def update_files(self, paths):
+        """
+        Update the library after the given files or directories (absolute
+        paths) have been created, modified, moved, or deleted. Only those
+        files are read again. Returns True if the library changed.
+        """
+        # Ignore the database (and SQLite's temporary files).
+        db_filename = os.path.abspath(self.get_db_filename())
+        paths = [path for path in paths if not path.startswith(db_filename)]
+        filenames = []
+        for path in paths:
+            filenames.extend(find_files(path))
+        if [path for path in paths + filenames if is_playlist(path)]:
+            # We don't keep track of which file each playlist came from, so
+            # rescan everything in order to update the playlists.
+            self.reload()
+            return True
+
+        def is_affected(filename):
+            for path in paths:
+                if filename == path or filename.startswith(path + os.sep):
+                    return True
+            return False
+        # Remove the songs under the given paths, but remember their metadata
+        # for the ones that are still there.
+        previous_db = {}
+        for key, title, artist, album, filename, mtime, size \
+                in self.db.stat_rows():
+            if is_affected(filename):
+                previous_db[filename] = \
+                    (mtime, size, {TITLE: title, ARTIST: artist, ALBUM: album})
+        # As in reload, update a copy of the backend, then switch over to it.
+        scan = copy.copy(self)
+        scan.start_scan(self.db.filter_filenames(
+                lambda filename: filename not in previous_db))
+        for filename in filenames:
+            # Skip broken symlinks
+            if not os.path.exists(filename):
+                continue
+            try:
+                scan.write_metadata(filename, previous_db)
+            except (OSError, ValueError):
+                continue
+        keys = scan._keys_in_use
+        scan.finish_scan()
+        scan.sort_db()
+        if scan.db == self.db:
+            return False
+        # Songs that are gone can't be in playlists anymore.
+        scan._playlists = [
+            {'name': playlist['name'],
+             'items': [key for key in playlist['items'] if key in keys]}
+            for playlist in self._playlists]
+
+        self._playlists = scan._playlists
+        self.db = scan.db
+        if self._save_db:
+            self.save_db()
+        return True
+
+    def watch(self, callback):
+        """
+        Watch the directory with inotify, and update the library when any
+        files in it change (see update_files).
+        """
+        def on_change(paths):
+            if paths is None:
+                # Some events were lost, so rescan everything.
+                def update():
+                    self.reload()
+                    return True
+            else:
+                def update():
+                    return self.update_files(paths)
+            callback(update)
+        DirectoryWatcher(os.path.abspath(self._media_path), on_change).start()
 
     def get_library_contents(self):
         return self.db
@@ -227,4 +767,92 @@ class DirectoryBackend(LibraryBackend):
         return self._playlists
 
     def get_filename_from_key(self, key):
-        return self.key_filename[int(key)]
+        return self.db.get_filename(int(key))
+
+class DirectoryWatcher(object):
+    """
+    Watches a directory tree with inotify, and reports changes to it in
+    batches.
+    """
+    def __init__(self, path, callback):
+        """
+        Initializes a watcher for the given directory (and its
+        subdirectories). callback will be called, from another thread, with
+        the set of files and directories that have been created, modified,
+        moved, or deleted, or with None if some changes may have been missed.
+
+        Raises OSError if inotify isn't available.
+        """
+        self._watches = inotify.Inotify()
+        self._mask = inotify.IN_CLOSE_WRITE | inotify.IN_CREATE \
+            | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+        self._callback = callback
+        # Map from watch descriptor to the directory being watched.
+        self._paths = {}
+        self.add_watches(path)
+
+    def add_watches(self, path):
+        """
+        Watch the given directory and its subdirectories.
+        """
+        for dirpath, dirs, files in walk(path):
+            try:
+                wd = self._watches.add_watch(dirpath, self._mask)
+            except OSError, e:
+                print "Warning: can't watch %r for changes: %s" \
+                    % (dirpath, e.strerror)
+                continue
+            self._paths[wd] = dirpath
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self):
+        while True:
+            try:
+                changed = set()
+                self.handle_events(self._watches.read_events(), changed)
+                deadline = time.time() + MAX_BATCH_DELAY
+                while time.time() < deadline and self.wait(BATCH_DELAY):
+                    self.handle_events(self._watches.read_events(), changed)
+                if None in changed:
+                    changed = None
+                self._callback(changed)
+            except Exception:
+                print "Error while watching for changes:"
+                traceback.print_exc()
+                time.sleep(BATCH_DELAY)
+
+    def wait(self, timeout):
+        """
+        Return True if events arrive within timeout seconds.
+        """
+        try:
+            return bool(select.select([self._watches], [], [], timeout)[0])
+        except select.error:
+            # Interrupted by a signal.
+            return False
+
+    def handle_events(self, events, changed):
+        """
+        Add the paths affected by the given events to the set changed (or
+        add None if some events were lost).
+        """
+        for wd, mask, cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                changed.add(None)
+                continue
+            if mask & inotify.IN_IGNORED:
+                # The directory was deleted.
+                self._paths.pop(wd, None)
+                continue
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & inotify.IN_ISDIR \
+                    and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.add_watches(path)
+            changed.add(path)
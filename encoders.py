@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Logic for selecting which encoder to run for a stream, and in which format.
+
+import os
+
+# Format used for streams unless the client asks for a different one.
+DEFAULT_FORMAT = 'ogg'
+
+# Command lines for encoding raw 16-bit little-endian stereo samples at 44.1
+# kHz (the decoder output, see decoders.PCM_BYTES_PER_SECOND), read from
+# stdin, to a stream written to stdout. Each function takes the bitrate in
+# kbits/sec.
+encoders = {
+    'ogg': lambda bitrate: ("/usr/bin/oggenc", "-r", "-Q", "-b", str(bitrate),
+                            "-"),
+    'opus': lambda bitrate: ("/usr/bin/opusenc", "--quiet", "--raw",
+                             "--raw-rate", "44100", "--bitrate", str(bitrate),
+                             "-", "-"),
+    'mp3': lambda bitrate: ("/usr/bin/lame", "-r", "-s", "44.1",
+                            "--bitwidth", "16", "--signed", "--little-endian",
+                            "--quiet", "-b", str(bitrate), "-", "-"),
+    }
+
+content_types = {
+    'ogg': 'audio/ogg',
+    'opus': 'audio/ogg; codecs=opus',
+    'mp3': 'audio/mpeg',
+    }
+
+encoder_messages = {
+    'ogg': "No Vorbis encoder found at /usr/bin/oggenc. "
+           "Please install 'vorbis-tools'.",
+    'opus': "No Opus encoder found at /usr/bin/opusenc. "
+            "Please install 'opus-tools'.",
+    'mp3': "No MP3 encoder found at /usr/bin/lame. Please install 'lame'.",
+    }
+
+# Bitrates (kbits/sec, for Ogg Vorbis) that clients may ask for, unless the
+# server is configured with a different ladder. Requests for other bitrates
+# are clamped to the ladder (see clamp_bitrate).
+DEFAULT_BITRATE_LADDER = (32, 48, 64, 96, 128, 160, 192, 256, 320)
+
+# The bitrates (kbits/sec) at which each format may be encoded, or None if any
+# bitrate will do. A stream is encoded at the highest bitrate on its format's
+# ladder that doesn't exceed the equivalent of the requested bitrate (see
+# get_bitrate).
+bitrate_ladders = {
+    'ogg': None,
+    'opus': (16, 24, 32, 40, 48, 64, 80, 96, 128, 160, 192, 256),
+    'mp3': (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    }
+
+# The bitrate each format needs in order to match the quality of Vorbis, as a
+# fraction of the Vorbis bitrate. (The configured bitrate is the one for
+# Vorbis.)
+bitrate_factors = {
+    'ogg': 1.0,
+    'opus': 0.5,
+    'mp3': 1.25,
+    }
+
+def has_encoder(format):
+    """
+    Returns True if an encoder for the given format is registered and present
+    on the system.
+    """
+    return format in encoders and os.path.exists(encoders[format](0)[0])
+
+def get_encoder(format, bitrate):
+    """
+    Returns a command line for encoding a stream in the given format at the
+    given bitrate (kbits/sec), which can be passed to subprocess.Popen.
+    """
+    return list(encoders[format](bitrate))
+
+def get_bitrate(format, bitrate):
+    """
+    Returns the bitrate (kbits/sec) at which to encode a stream in the given
+    format, given the bitrate for an Ogg Vorbis stream of the same quality.
+    """
+    target = bitrate * bitrate_factors[format]
+    ladder = bitrate_ladders[format]
+    if ladder is None:
+        return int(target)
+    return clamp_bitrate(target, ladder)
+
+def clamp_bitrate(bitrate, ladder):
+    """
+    Returns the highest bitrate on the given ladder (a sorted sequence of
+    bitrates) that doesn't exceed the given bitrate, or the lowest one if they
+    all do.
+    """
+    rungs = [rung for rung in ladder if rung <= bitrate]
+    if not rungs:
+        return ladder[0]
+    return rungs[-1]
+
+def choose_format(accept, available):
+    """
+    Returns the format (one of available, a list in order of preference) to
+    use for a client that sent the given Accept header, or None if none of
+    them is acceptable. Formats the client prefers (with a higher q-value) go
+    first.
+    """
+    if not accept:
+        return available[0] if available else None
+    # Map from each media range to its q-value.
+    ranges = {}
+    for item in accept.split(','):
+        params = item.split(';')
+        media_range = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        ranges[media_range] = quality
+    best_format = None
+    best_quality = 0
+    for format in available:
+        media_type = content_types[format].split(';')[0]
+        # The most specific matching range determines the q-value.
+        for media_range in (media_type, media_type.split('/')[0] + '/*',
+                            '*/*'):
+            if media_range in ranges:
+                quality = ranges[media_range]
+                break
+        else:
+            continue
+        if quality > best_quality:
+            best_format = format
+            best_quality = quality
+    return best_format
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Minimal interface to the Linux inotify API, using ctypes.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+# Event masks (see inotify(7)).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# struct inotify_event, without the name that follows it.
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def get_libc():
+    """
+    Return the C library, or raise OSError if it doesn't provide inotify.
+    """
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        _libc = libc
+    return _libc
+
+def check_result(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+class Inotify(object):
+    """
+    An inotify instance, which reports events for the paths that it watches.
+    """
+    def __init__(self):
+        self._libc = get_libc()
+        self._fd = check_result(self._libc.inotify_init())
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """
+        Watch the given path for the events in mask, and return the watch
+        descriptor. (Adding a watch for a file that's already being watched
+        returns the same descriptor as before.)
+        """
+        return check_result(self._libc.inotify_add_watch(
+                self._fd, ctypes.c_char_p(path), ctypes.c_uint32(mask)))
+
+    def read_events(self):
+        """
+        Wait for events, and return a list of (watch descriptor, mask,
+        cookie, name) for each of them. name is the name of the file, within
+        the watched directory, that the event applies to (or '').
+        """
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = \
+                EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self._fd)
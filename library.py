@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# The library (songs and playlists) as presented to clients.
+
+# Work with python2.5
+from __future__ import with_statement
+
+import threading
+import traceback
+
+try:
+    import json
+    json.dumps
+except (ImportError, AttributeError):
+    import simplejson as json
+
+import decoders
+import search
+import static
+from songtable import SongTable
+
+# Attributes of each song that clients may request.
+SONG_FIELDS = ['key', 'title', 'artist', 'album']
+# Number of items returned by get_page if no limit is given, and the maximum
+# number that may be requested at once.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+def load_library(backend):
+    """
+    Read the songs and playlists from the given backend, and return a Library
+    containing them.
+    """
+    library_contents = backend.get_library_contents()
+    if not library_contents:
+        print "Warning: no tracks were found. Check that you've specified " \
+            + "the right backend/path."
+    if not isinstance(library_contents, SongTable):
+        library_contents = SongTable.from_songs(
+            library_contents, backend.get_filename_from_key)
+    # Filter out songs that we won't be able to decode.
+    filtered_library_contents = \
+        library_contents.filter_filenames(decoders.has_decoder)
+    if not filtered_library_contents and library_contents:
+        print "Warning: no playable tracks were found. You may need to " \
+            "install one or more decoders."
+
+    try:
+        playlists = backend.get_playlists()
+    except NotImplementedError:
+        playlists = None
+
+    return Library(filtered_library_contents, playlists)
+
+class LibraryLoader(object):
+    """
+    Holds the current Library for a backend, and replaces it with a new one
+    when the backend is reloaded.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self._lock = threading.Lock()
+        # The current Library. Each request should read this once and use the
+        # same Library throughout.
+        self.current = load_library(backend)
+        if backend.needs_reload():
+            # Serve the library we have while the backend catches up.
+            print "The library may be out of date; reloading it in the " \
+                "background."
+            self.reload_in_background()
+
+    def reload(self):
+        """
+        Reload the backend and switch to a Library containing its new
+        contents. Requests that started earlier continue to use the old one.
+        """
+        with self._lock:
+            print "Reloading library..."
+            self._backend.reload()
+            self.current = load_library(self._backend)
+            print "Library reloaded (%d songs)." % (len(self.current.songs),)
+
+    def reload_in_background(self):
+        """
+        Reload the library in a new thread (see reload).
+        """
+        thread = threading.Thread(target=self._reload_or_report)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _reload_or_report(self):
+        try:
+            self.reload()
+        except Exception:
+            print "Error reloading the library; continuing to use the " \
+                "old one."
+            traceback.print_exc()
+
+    def update(self, update_backend):
+        """
+        Call update_backend, a function that updates the backend and returns
+        whether anything changed, and if so, switch to a Library containing
+        the backend's new contents.
+        """
+        with self._lock:
+            try:
+                if not update_backend():
+                    return
+            except Exception:
+                print "Error updating the library; continuing to use the " \
+                    "old one."
+                traceback.print_exc()
+                return
+            self.current = load_library(self._backend)
+            print "Library updated (%d songs)." % (len(self.current.songs),)
+
+    def watch(self):
+        """
+        Update the library whenever the backend's collection changes. Raises
+        NotImplementedError or OSError if the backend can't watch for
+        changes.
+        """
+        self._backend.watch(self.update)
+
+def get_page(items, offset, limit):
+    """
+    Return the part of the list items selected by offset and limit (which may
+    be None to use the default), or raise ValueError if they're not valid.
+    """
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if offset < 0 or limit < 0 or limit > MAX_PAGE_SIZE:
+        raise ValueError("Invalid page (offset %r, limit %r)"
+                         % (offset, limit))
+    return items[offset:offset + limit]
+
+def project(songs, fields):
+    """
+    Return copies of the given songs that contain only the specified
+    attributes (and the key), or raise ValueError if any of them are unknown.
+    """
+    for field in fields:
+        if field not in SONG_FIELDS:
+            raise ValueError("Unknown field %r" % (field,))
+    if 'key' not in fields:
+        fields = ['key'] + fields
+    return [dict([(field, song[field]) for field in fields])
+            for song in songs]
+
+class Library(object):
+    """
+    The songs and playlists available to clients.
+
+    songs is a SongTable or a list of songs in the form returned by
+    LibraryBackend.get_library_contents, and playlists is a list of playlists
+    in the form returned by LibraryBackend.get_playlists (or None if the
+    backend doesn't support playlists).
+
+    Songs are always presented in the order in which they appear in songs, so
+    a client can fetch the library one page at a time.
+    """
+    def __init__(self, songs, playlists):
+        if not isinstance(songs, SongTable):
+            songs = SongTable.from_songs(songs)
+        self.songs = songs
+        self.playlists = playlists
+        # Compress the complete library once, rather than on every request.
+        # Only the compressed data is kept; the library is encoded again, a
+        # piece at a time, for clients that don't support compression.
+        self.resource = static.StreamedResource(self.iter_json, 'text/html')
+        self._search_index = search.SearchIndex(songs)
+
+    def iter_json(self):
+        """
+        Iterate over the parts of the UTF-8-encoded JSON representation of the
+        complete library.
+        """
+        yield '{"library": '
+        for data in self.songs.iter_json():
+            yield data
+        yield ', "playlists": '
+        yield json.dumps(self.playlists)
+        yield '}'
+
+    def get_songs(self, offset=0, limit=None, fields=None):
+        """
+        Return a JSON-serializable object containing the songs selected by
+        offset and limit, and the total number of songs. If fields (a list of
+        attribute names) is supplied, only those attributes (and the key) of
+        each song are included.
+
+        Raises ValueError if any of the arguments are invalid.
+        """
+        page = get_page(self.songs, offset, limit)
+        if fields is not None:
+            page = project(page, fields)
+        return { 'total': len(self.songs),
+                 'offset': offset,
+                 'library': page }
+
+    def search(self, query, offset=0, limit=None, fields=None):
+        """
+        Return a JSON-serializable object containing the keys of the songs
+        that match query (see search.py), best matches first, as selected by
+        offset and limit, and the total number of matching songs. If fields
+        is supplied, the matching songs are included too, with the specified
+        attributes (see get_songs).
+
+        Raises ValueError if any of the arguments are invalid.
+        """
+        keys = self._search_index.search(query)
+        page = get_page(keys, offset, limit)
+        result = { 'total': len(keys),
+                   'offset': offset,
+                   'keys': page }
+        if fields is not None:
+            songs = self.songs
+            result['library'] = project(
+                [songs[songs.find_key(key)] for key in page], fields)
+        return result
+
+    def get_playlist_summaries(self):
+        """
+        Return a JSON-serializable object listing the ID, name, and number of
+        songs of each playlist.
+        """
+        if self.playlists is None:
+            return { 'playlists': None }
+        return { 'playlists': [ { 'id': playlist_id,
+                                  'name': playlist['name'],
+                                  'size': len(playlist['items']) }
+                                for playlist_id, playlist
+                                in enumerate(self.playlists) ] }
+
+    def get_playlist(self, playlist_id, offset=0, limit=None):
+        """
+        Return a JSON-serializable object containing the name of the playlist
+        with the given ID, the keys of the songs in it that are selected by
+        offset and limit, and the total number of songs in it.
+
+        Raises KeyError if there's no such playlist, or ValueError if offset
+        or limit is invalid.
+        """
+        if self.playlists is None or not \
+                0 <= playlist_id < len(self.playlists):
+            raise KeyError(playlist_id)
+        playlist = self.playlists[playlist_id]
+        return { 'id': playlist_id,
+                 'name': playlist['name'],
+                 'total': len(playlist['items']),
+                 'offset': offset,
+                 'items': get_page(playlist['items'], offset, limit) }
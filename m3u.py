@@ -23,6 +23,7 @@ import os.path
 import sys
 
 from backends import LibraryBackend
+from backends import assign_key
 from backends import extract_metadata
 
 class M3uPlaylist(object):
@@ -62,13 +63,13 @@ class M3uBackend(LibraryBackend):
             print "Error: no m3u file was found at %r." % (self.m3u_file,)
             print "Please check the m3u file location, or try --backend=dir instead."
             sys.exit(1)
+        # Dict mapping keys to the original filenames.
+        self.file_list = {}
 
     def get_library_contents(self):
         # Sequence of dicts containing the metadata for all the songs.
         library = []
-        # Dict mapping keys to the original filenames.
-        self.file_list = {}
-        next_index = 0
+        file_list = {}
         try:
             playlist = M3uPlaylist(self.m3u_file, open(self.m3u_file))
             for filename in playlist.get_filenames():
@@ -76,15 +77,15 @@ class M3uBackend(LibraryBackend):
                     metadata = extract_metadata(os.path.abspath(filename))
                 except ValueError:
                     continue
-                metadata['key'] = next_index
-                self.file_list[next_index] = filename
+                key = assign_key(filename, file_list)
+                metadata['key'] = key
+                file_list[key] = filename
                 library.append(metadata)
-                next_index = next_index + 1
+            self.file_list = file_list
             return library
-        except IOError:
-            print "Error: could not read the specified playlist (%r)" \
-                % (self.m3u_file,)
-            sys.exit(1)
+        except IOError, e:
+            raise IOError("Error: could not read the specified playlist "
+                          "(%r): %s" % (self.m3u_file, e))
 
     def get_filename_from_key(self, key):
         return self.file_list[int(key)]
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# SQLite database in which the directory backend caches the metadata it reads
+# from each file, along with the file's mtime and size at the time, so that it
+# doesn't have to read the file again unless it changes.
+
+import sqlite3
+
+from backends import TITLE, ARTIST, ALBUM
+
+# The first bytes of every SQLite database file.
+SQLITE_HEADER = 'SQLite format 3\0'
+
+# The statements that bring the database from each version of the schema to
+# the next one. (The version is stored in the user_version pragma, which is 0
+# for a new database.)
+MIGRATIONS = [
+    """
+    CREATE TABLE songs (
+      filename BLOB PRIMARY KEY,
+      mtime REAL NOT NULL,
+      size INTEGER,
+      title TEXT NOT NULL,
+      artist TEXT NOT NULL,
+      album TEXT NOT NULL
+    )
+    """,
+    # The files and subdirectories of each directory, as of when the directory
+    # had the given mtime. Names are separated by NULs.
+    """
+    CREATE TABLE directories (
+      path BLOB PRIMARY KEY,
+      mtime REAL NOT NULL,
+      files BLOB NOT NULL,
+      subdirs BLOB NOT NULL
+    )
+    """,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+Error = sqlite3.Error
+
+def is_sqlite_file(filename):
+    """
+    Return whether the given file is a SQLite database.
+    """
+    f = open(filename, 'rb')
+    try:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    finally:
+        f.close()
+
+def to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def make_row(mtime, size, metadata):
+    """
+    Return the tuple (mtime, size, title, artist, album) that is stored for a
+    file with the given stats and metadata.
+    """
+    return (mtime, size, to_unicode(metadata[TITLE]),
+            to_unicode(metadata[ARTIST]), to_unicode(metadata[ALBUM]))
+
+def split_names(data):
+    data = str(data)
+    if not data:
+        return ()
+    return tuple(data.split('\0'))
+
+class MetadataStore(object):
+    """
+    The metadata of a collection of files, stored in a SQLite database.
+
+    Each method opens its own connection, so a MetadataStore can be used from
+    any thread.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def connect(self):
+        """
+        Open the database, creating the tables if necessary.
+        """
+        connection = sqlite3.connect(self.filename)
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise sqlite3.DatabaseError(
+                    "Unsupported metadata database version %d" % (version,))
+            if version < SCHEMA_VERSION:
+                for statement in MIGRATIONS[version:]:
+                    connection.execute(statement)
+                connection.execute('PRAGMA user_version = %d'
+                                   % (SCHEMA_VERSION,))
+                connection.commit()
+        except:
+            connection.close()
+            raise
+        return connection
+
+    def load(self):
+        """
+        Return a dict mapping each filename to its row (see make_row).
+        """
+        connection = self.connect()
+        try:
+            rows = {}
+            for row in connection.execute(
+                'SELECT filename, mtime, size, title, artist, album '
+                'FROM songs'):
+                rows[str(row[0])] = tuple(row[1:])
+            return rows
+        finally:
+            connection.close()
+
+    def load_directories(self):
+        """
+        Return a dict mapping the path of each directory to its (mtime, files,
+        subdirs), where files and subdirs are tuples of names.
+        """
+        connection = self.connect()
+        try:
+            directories = {}
+            for path, mtime, files, subdirs in connection.execute(
+                'SELECT path, mtime, files, subdirs FROM directories'):
+                directories[str(path)] = \
+                    (mtime, split_names(files), split_names(subdirs))
+            return directories
+        finally:
+            connection.close()
+
+    def update(self, rows, removed, directories={}, removed_directories=[]):
+        """
+        In a single transaction, store the given rows (a dict mapping
+        filenames to rows, which replace any existing ones for those files),
+        and delete the rows for the filenames in the list removed. Likewise,
+        store the given directories (in the form returned by
+        load_directories) and delete the ones in removed_directories.
+        """
+        connection = self.connect()
+        try:
+            try:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO songs '
+                    '(filename, mtime, size, title, artist, album) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [(sqlite3.Binary(filename),) + row
+                     for filename, row in rows.iteritems()])
+                connection.executemany(
+                    'DELETE FROM songs WHERE filename = ?',
+                    [(sqlite3.Binary(filename),) for filename in removed])
+                connection.executemany(
+                    'INSERT OR REPLACE INTO directories '
+                    '(path, mtime, files, subdirs) VALUES (?, ?, ?, ?)',
+                    [(sqlite3.Binary(path), mtime,
+                      sqlite3.Binary('\0'.join(files)),
+                      sqlite3.Binary('\0'.join(subdirs)))
+                     for path, (mtime, files, subdirs)
+                     in directories.iteritems()])
+                connection.executemany(
+                    'DELETE FROM directories WHERE path = ?',
+                    [(sqlite3.Binary(path),) for path in removed_directories])
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+        finally:
+            connection.close()
@@ -24,11 +24,19 @@ import getopt
 import os
 import sys
 
+import encoders
+
 DEFAULT_PORT = 8080
 DEFAULT_BITRATE = 64 #kbits/s
 DEFAULT_BACKEND = 'dir'
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024 #bytes
+DEFAULT_SERVER = 'threaded'
+DEFAULT_MAX_TRANSCODES = 0 #no limit
+DEFAULT_MAX_QUEUE_WAIT = 30 #seconds
+DEFAULT_SCAN_WORKERS = 1
 
 valid_backends = ['rhythmbox', 'dir', 'playlist']
+valid_servers = ['threaded', 'async']
 
 class BadArgsError(Exception):
     """
@@ -41,9 +49,11 @@ class BadArgsError(Exception):
 
 def get_options(remaining_args):
     """
-    Parse the arguments and return a tuple (show_help, backend, bitrate, port,
-    path, basic_auth_file), or raise BadArgsError if the invocation was not
-    valid.
+    Parse the arguments and return a tuple (show_help, backend, bitrate,
+    bind_address, port, path, basic_auth_file, cache_dir, cache_size,
+    shape_buffered, server_type, max_transcodes, max_queue_wait, watch,
+    scan_workers, format, bitrate_ladder, adaptive_bitrate), or raise
+    BadArgsError if the invocation was not valid.
 
     show_help: whether user requested help information
     backend: string indicating backend to use
@@ -52,6 +62,17 @@ def get_options(remaining_args):
     port: port number to listen on
     path: path from which to read music files (for "dir" and "playlist" backends only)
     basic_auth_file: file handle from which to read basic auth config, or None.
+    cache_dir: directory in which to cache encoded streams, or None.
+    cache_size: maximum total size of the cached streams (bytes)
+    shape_buffered: whether to limit the rate at which buffered streams are sent
+    server_type: string indicating the server implementation to use
+    max_transcodes: maximum number of encoders to run at once, or 0 for no limit
+    max_queue_wait: maximum time a request waits for an encoder (seconds)
+    watch: whether to update the library when the music collection changes
+    scan_workers: number of processes used to read metadata ("dir" backend only)
+    format: format of streams for clients that don't ask for a particular one
+    bitrate_ladder: sorted tuple of bitrates clients may ask for (kbits/sec)
+    adaptive_bitrate: whether to lower the bitrate for slow clients
     """
     # TODO: make this return a more useful data structure, e.g. a dict or an
     # object. Returning a huge tuple is kind of unwieldy.
@@ -62,11 +83,25 @@ def get_options(remaining_args):
     bitrate = DEFAULT_BITRATE
     path = None
     basic_auth_file = None
+    cache_dir = None
+    cache_size = DEFAULT_CACHE_SIZE
+    shape_buffered = True
+    server_type = DEFAULT_SERVER
+    max_transcodes = DEFAULT_MAX_TRANSCODES
+    max_queue_wait = DEFAULT_MAX_QUEUE_WAIT
+    watch = False
+    scan_workers = DEFAULT_SCAN_WORKERS
+    format = encoders.DEFAULT_FORMAT
+    bitrate_ladder = encoders.DEFAULT_BITRATE_LADDER
+    adaptive_bitrate = False
     try:
         opts, file_list = getopt.getopt(
             remaining_args, "b:hp:",
             ["help", "backend=", "bitrate=", "bind_address=", "port=", "path=",
-             "basic_auth_file="])
+             "basic_auth_file=", "cache_dir=", "cache_size=",
+             "no_buffered_shaping", "server=", "max_transcodes=",
+             "max_queue_wait=", "watch", "scan_workers=", "format=",
+             "bitrates=", "adaptive_bitrate"])
     except getopt.GetoptError, e:
         raise BadArgsError(e.msg)
     for flag, value in opts:
@@ -98,6 +133,60 @@ def get_options(remaining_args):
                 raise BadArgsError("Invalid port setting %r" % (value,))
         if flag in ("--bind_address",):
             bind_address = value
+        if flag in ("--cache_dir",):
+            cache_dir = value
+        if flag in ("--cache_size",):
+            try:
+                cache_size = int(value) * 1024 * 1024
+                if cache_size <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise BadArgsError("Invalid cache size %r" % (value,))
+        if flag in ("--no_buffered_shaping",):
+            shape_buffered = False
+        if flag in ("--server",):
+            server_type = value
+            if server_type not in valid_servers:
+                raise BadArgsError("Unsupported server type %r"
+                                   % (server_type,))
+        if flag in ("--max_transcodes",):
+            try:
+                max_transcodes = int(value)
+                if max_transcodes < 0:
+                    raise ValueError()
+            except ValueError:
+                raise BadArgsError("Invalid encoder limit %r" % (value,))
+        if flag in ("--max_queue_wait",):
+            try:
+                max_queue_wait = int(value)
+                if max_queue_wait < 0:
+                    raise ValueError()
+            except ValueError:
+                raise BadArgsError("Invalid queue wait %r" % (value,))
+        if flag in ("--watch",):
+            watch = True
+        if flag in ("--scan_workers",):
+            try:
+                scan_workers = int(value)
+                if scan_workers <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise BadArgsError("Invalid number of scan workers %r"
+                                   % (value,))
+        if flag in ("--format",):
+            format = value
+            if format not in encoders.encoders:
+                raise BadArgsError("Unsupported format %r" % (format,))
+        if flag in ("--bitrates",):
+            try:
+                bitrate_ladder = tuple(sorted(set(
+                    [int(rung) for rung in value.split(',')])))
+                if bitrate_ladder[0] <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise BadArgsError("Invalid bitrates %r" % (value,))
+        if flag in ("--adaptive_bitrate",):
+            adaptive_bitrate = True
     if backend_type not in ('dir', 'playlist') and path is not None:
         print "Warning: --path was set but is ignored for --backend=%s" \
             % (backend_type,)
@@ -105,7 +194,10 @@ def get_options(remaining_args):
         path = os.getcwd()
     if backend_type == 'playlist' and path is None:
         raise BadArgsError("Specify --path for playlist backend")
-    return (help_msg, backend_type, bitrate, bind_address, port, path, basic_auth_file)
+    return (help_msg, backend_type, bitrate, bind_address, port, path,
+            basic_auth_file, cache_dir, cache_size, shape_buffered,
+            server_type, max_transcodes, max_queue_wait, watch, scan_workers,
+            format, bitrate_ladder, adaptive_bitrate)
 
 def print_usage():
     print "Usage: %s [OPTIONS]" % (os.path.basename(sys.argv[0]),)
@@ -127,6 +219,25 @@ Options:
 
   -b, --bitrate=N
       Specify the bitrate for output streams, in kbits/sec. (default: 64)
+      Streams in formats other than Ogg Vorbis use a bitrate of about the
+      same quality instead (see --format). Clients may ask for a different
+      bitrate for each stream, which is rounded down to one of --bitrates.
+
+  --bitrates=N,N,...
+      Specify the bitrates, in kbits/sec, that clients may ask for.
+      (default: 32,48,64,96,128,160,192,256,320)
+
+  --adaptive_bitrate
+      Measure how fast each client accepts the streams it's sent, and send
+      slower clients their next songs at a lower one of --bitrates, so that
+      they can be played without stalling.
+
+  --format=FORMAT
+      Specify the format of output streams for clients that don't ask for a
+      particular one. Acceptable values:
+        ogg: (default) Ogg Vorbis, encoded with oggenc
+        opus: Ogg Opus, encoded with opusenc (at half the bitrate)
+        mp3: MP3, encoded with lame
 
   --bindaddress=bindaddress
       Specify the IPv4/IPv6 address to bind to (default: bind to everything)
@@ -136,4 +247,43 @@ Options:
 
   --basic_auth_file=FILENAME
       Require basic HTTP authentication and only allow users named in the
-      specified file. The file should be in 'htpasswd' format."""
+      specified file. The file should be in 'htpasswd' format.
+
+  --cache_dir=DIR
+      Save encoded streams in DIR, and serve subsequent requests for the same
+      song from there instead of re-encoding it. (default: no caching)
+
+  --cache_size=MB
+      Maximum total size of the encoded streams kept in --cache_dir, in
+      megabytes. The least recently played songs are removed first.
+      (default: 1024)
+
+  --no_buffered_shaping
+      Send buffered streams (requested by browsers that need to know the
+      length of a song before playing it) as fast as possible, instead of
+      limiting them to twice the bitrate.
+
+  --server=SERVER
+      Specify the server implementation to use. Acceptable values:
+        threaded: (default) handle each request in a separate thread
+        async: handle all requests in a single event loop, which scales
+          better to many simultaneous streams
+
+  --max_transcodes=N
+      Run at most N encoders at once. Requests that need an encoder wait until
+      one is free, with songs being played taking priority over songs that
+      are only being loaded in advance. Use 0 for no limit. (default: 0)
+
+  --max_queue_wait=SECONDS
+      Maximum time a request waits for an encoder before the server responds
+      that it's busy. (default: 30)
+
+  --watch
+      Watch the music directory for changes (using inotify; Linux only), and
+      update the library as soon as songs are added, modified, or removed.
+      Only supported for --backend=dir.
+
+  --scan_workers=N
+      For --backend=dir, read the metadata of new and modified files using N
+      processes at once, which speeds up scanning a large collection on a
+      machine with several cores. (default: 1)"""
@@ -24,6 +24,7 @@ import sys
 import urllib
 
 from backends import LibraryBackend
+from backends import assign_key
 from backends import extract_metadata
 
 class PlsPlaylist(object):
@@ -75,13 +76,13 @@ class PlsBackend(LibraryBackend):
             print "Error: no pls file was found at %r." % (self.pls_file,)
             print "Please check the pls file location, or try --backend=dir instead."
             sys.exit(1)
+        # Dict mapping keys to the original filenames.
+        self.file_list = {}
 
     def get_library_contents(self):
         # Sequence of dicts containing the metadata for all the songs.
         library = []
-        # Dict mapping keys to the original filenames.
-        self.file_list = {}
-        next_index = 0
+        file_list = {}
         try:
             playlist = PlsPlaylist(self.pls_file, open(self.pls_file))
             for filename in playlist.get_filenames():
@@ -89,15 +90,15 @@ class PlsBackend(LibraryBackend):
                     metadata = extract_metadata(os.path.abspath(filename))
                 except ValueError:
                     continue
-                metadata['key'] = next_index
-                self.file_list[next_index] = filename
+                key = assign_key(filename, file_list)
+                metadata['key'] = key
+                file_list[key] = filename
                 library.append(metadata)
-                next_index = next_index + 1
+            self.file_list = file_list
             return library
-        except IOError:
-            print "Error: could not read the specified playlist (%r)" \
-                % (self.pls_file,)
-            sys.exit(1)
+        except IOError, e:
+            raise IOError("Error: could not read the specified playlist "
+                          "(%r): %s" % (self.pls_file, e))
 
     def get_filename_from_key(self, key):
         return self.file_list[int(key)]
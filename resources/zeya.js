@@ -28,12 +28,20 @@ var search_string = null;
 var is_repeating = false;
 // Whether or not the shuffle feature is activated.
 var is_shuffled = false;
+// Random ID sent with requests for songs, so that the server can tell this
+// page's prefetches apart from those of other clients at the same address.
+var session_id = Math.floor(Math.random() * 4294967296).toString(36);
 // Information to display in the status area.
 var status_info = {
   total_tracks: 0,
   displayed_tracks: 0,
 };
 
+// Number of songs to request in the first page of the collection (which is
+// displayed as soon as it arrives), and in each subsequent request.
+var FIRST_PAGE_SIZE = 200;
+var PAGE_SIZE = 5000;
+
 // We need to buffer streams for Chrome.
 var using_webkit = navigator.userAgent.indexOf("AppleWebKit") > -1;
 // Firefox 3.5 doesn't issue the 'suspend' event, so we need to use a fallback
@@ -93,10 +101,13 @@ function plural(number) {
   return number > 1 ? 's' : '';
 }
 
-// Returns an Audio object corresponding to the track with the given key.
-function get_stream(key) {
+// Returns an Audio object corresponding to the track with the given key. If
+// prefetch is true, the track isn't going to be played right away.
+function get_stream(key, prefetch) {
   var buffer_param = using_webkit ? 'buffered=true&' : '';
-  return new Audio('getcontent?' + buffer_param + 'key=' + escape(key));
+  var prefetch_param = prefetch ? 'prefetch=true&' : '';
+  return new Audio('getcontent?' + buffer_param + prefetch_param + 'session='
+                   + session_id + '&key=' + escape(key));
 }
 
 function update_status_area() {
@@ -170,6 +181,10 @@ function compute_displayed_content(current_playlist, search_query, shuffle) {
   for (var index = 0; index < current_playlist.length; index++) {
     var key = current_playlist[index];
     var item = library[key];
+    // Skip songs that haven't been loaded yet.
+    if (item === undefined) {
+      continue;
+    }
     if (search_query !== null) {
       if (!item_match(item, search_query)) {
         continue;
@@ -265,66 +280,118 @@ function render_collection() {
   update_status_area();
 }
 
-// Request the collection from the server then render it.
-function load_collection() {
+// Send a GET request for the given URL, and pass the deserialized response to
+// callback.
+function get_json(url, callback) {
   var req = new XMLHttpRequest();
-  req.open('GET', 'getlibrary', true);
+  req.open('GET', url, true);
   req.onreadystatechange = function(e) {
     if (req.readyState == 4 && req.status == 200) {
-      server_response = JSON.parse(req.responseText);
-      var library_obj = server_response.library;
-      status_info.total_tracks = library_obj.length;
-      init_playlist_map(library_obj, server_response.playlists);
-      compute_displayed_content(current_playlist, search_string, is_shuffled);
-      render_collection();
+      callback(JSON.parse(req.responseText));
     }
   };
   req.send(null);
 }
 
-// Initialize the playlist_map object, where 'library' and 'playlists' are the
-// deserialized collection objects returned by the server.
-function init_playlist_map(library_obj, playlists) {
-  // Create the default playlist, which corresponds to the entire collection.
-  default_playlist = [];
-  for (var i = 0; i < library_obj.length; i++) {
-    library[library_obj[i].key] = library_obj[i];
-    default_playlist.push(library_obj[i].key);
-  }
-  playlist_map['all'] = default_playlist;
+// Request the collection from the server then render it. The first page of
+// songs is rendered as soon as it arrives. The rest of the collection is loaded
+// in the background, and rendered once it's all there.
+function load_collection() {
+  playlist_map['all'] = [];
+  load_playlists(function() { load_library_page(0, FIRST_PAGE_SIZE); });
+}
+
+// Request the songs starting at the given offset, and then the rest of the
+// collection.
+function load_library_page(offset, limit) {
+  get_json('getlibrary?offset=' + offset + '&limit=' + limit, function(page) {
+    var songs = page.library;
+    for (var i = 0; i < songs.length; i++) {
+      library[songs[i].key] = songs[i];
+      playlist_map['all'].push(songs[i].key);
+    }
+    status_info.total_tracks = page.total;
+    var next_offset = offset + songs.length;
+    var finished = songs.length == 0 || next_offset >= page.total;
+    if (offset == 0 || finished) {
+      clear_collection();
+      compute_displayed_content(current_playlist, search_string, is_shuffled);
+      render_collection();
+    }
+    if (!finished) {
+      load_library_page(next_offset, PAGE_SIZE);
+    }
+  });
+}
 
-  // Show the playlist selector if the backend supports it.
-  if (playlists !== null) {
-    corpus_selector = document.getElementById("corpus-selector");
+// Request the list of playlists, set up the playlist selector, and call
+// callback once the selected playlist has been loaded.
+function load_playlists(callback) {
+  get_json('getplaylists', function(response) {
+    var playlists = response.playlists;
+    // IDs of the playlists that can be selected.
+    var valid_playlist_ids = {'all': true};
 
-    new_playlist_item = document.createElement("option");
-    new_playlist_item.value = "all";
-    new_playlist_item.appendChild(document.createTextNode("All music"));
-    corpus_selector.appendChild(new_playlist_item);
+    // Show the playlist selector if the backend supports it.
+    if (playlists !== null) {
+      corpus_selector = document.getElementById("corpus-selector");
 
-    for (var i = 0; i < playlists.length; i++) {
-      var playlist_id = "playlist:" + i;
       new_playlist_item = document.createElement("option");
-      new_playlist_item.value = playlist_id;
-      new_playlist_item.appendChild(document.createTextNode(playlists[i].name));
+      new_playlist_item.value = "all";
+      new_playlist_item.appendChild(document.createTextNode("All music"));
       corpus_selector.appendChild(new_playlist_item);
-      playlist_map[playlist_id] = playlists[i].items;
-    }
-    corpus_selector.style.display = "block";
 
-    // TODO: add some placeholder items when there are no playlists. (e.g.
-    // simply a disabled item labeled "(No playlists)")
-  }
+      for (var i = 0; i < playlists.length; i++) {
+        var playlist_id = "playlist:" + playlists[i].id;
+        new_playlist_item = document.createElement("option");
+        new_playlist_item.value = playlist_id;
+        new_playlist_item.appendChild(document.createTextNode(playlists[i].name));
+        corpus_selector.appendChild(new_playlist_item);
+        valid_playlist_ids[playlist_id] = true;
+      }
+      corpus_selector.style.display = "block";
 
-  // Attempt to load the previously selected playlist (the browser may persist
-  // the value within shadow-corpus-selector across page reloads.
-  old_playlist_id = window.document.getElementById('shadow-corpus-selector').value;
-  if (playlist_map[old_playlist_id] === undefined) {
-    old_playlist_id = 'all';
-  } else {
-    document.getElementById('corpus-selector').value = old_playlist_id;
+      // TODO: add some placeholder items when there are no playlists. (e.g.
+      // simply a disabled item labeled "(No playlists)")
+    }
+
+    // Attempt to load the previously selected playlist (the browser may
+    // persist the value within shadow-corpus-selector across page reloads.
+    var old_playlist_id = window.document.getElementById('shadow-corpus-selector').value;
+    if (!valid_playlist_ids[old_playlist_id]) {
+      old_playlist_id = 'all';
+    } else {
+      document.getElementById('corpus-selector').value = old_playlist_id;
+    }
+    load_playlist(old_playlist_id, function() {
+      current_playlist = playlist_map[old_playlist_id];
+      callback();
+    });
+  });
+}
+
+// Load the playlist with the given ID (of the form "playlist:N") into
+// playlist_map, if it isn't there already, and then call callback.
+function load_playlist(playlist_id, callback) {
+  if (playlist_map[playlist_id] !== undefined) {
+    callback();
+    return;
   }
-  current_playlist = playlist_map[old_playlist_id];
+  var items = [];
+  var load_page = function(offset) {
+    get_json('getplaylist?id=' + playlist_id.substr('playlist:'.length)
+             + '&offset=' + offset + '&limit=' + PAGE_SIZE,
+             function(page) {
+               items = items.concat(page.items);
+               if (page.items.length > 0 && items.length < page.total) {
+                 load_page(items.length);
+               } else {
+                 playlist_map[playlist_id] = items;
+                 callback();
+               }
+             });
+  };
+  load_page(0);
 }
 
 // Clear displayed collection.
@@ -336,12 +403,14 @@ function clear_collection() {
 
 // Update the collection when the playlist is updated.
 function update_playlist() {
-  corpus_id = document.getElementById('corpus-selector').value;
+  var corpus_id = document.getElementById('corpus-selector').value;
   window.document.getElementById('shadow-corpus-selector').value = corpus_id;
-  current_playlist = playlist_map[corpus_id];
   clear_collection();
-  compute_displayed_content(current_playlist, search_string, is_shuffled);
-  render_collection();
+  load_playlist(corpus_id, function() {
+    current_playlist = playlist_map[corpus_id];
+    compute_displayed_content(current_playlist, search_string, is_shuffled);
+    render_collection();
+  });
 }
 
 // Update current search string and reload collection.
@@ -490,6 +559,24 @@ function add_load_finished_listener(audio_elt, callback) {
   }
 }
 
+// Ask the server to start encoding the next song in the list, unless we've
+// started loading it already, so that it's ready by the time we preload it.
+// (Skipping to any other song cancels this.)
+function prefetch_next_song() {
+  var index = next_index();
+  if (index === null) {
+    return;
+  }
+  var key = library[displayed_content[index]].key;
+  if (key == preload_key) {
+    return;
+  }
+  var req = new XMLHttpRequest();
+  req.open('GET', 'prefetch?session=' + session_id + '&key=' + escape(key),
+           true);
+  req.send(null);
+}
+
 // Start loading the next song in the list, but don't play it.
 function preload_song() {
   // Disable preloading for Gecko 1.9.1. It doesn't seem to deal correctly with
@@ -506,7 +593,7 @@ function preload_song() {
 
   if (preload_key !== null) {
     preload_finished = false;
-    preload_audio = get_stream(preload_key);
+    preload_audio = get_stream(preload_key, true);
     add_load_finished_listener(preload_audio, function() { preload_finished = true; });
     preload_audio.load();
   }
@@ -554,6 +641,16 @@ function select_item(index, play_track) {
   // Hide the spinner when the song has loaded.
   current_audio.addEventListener(
     'play', function() {set_spinner_visible(false);}, false);
+  // Once the song has started (so the server knows it's the one we're
+  // playing), have the server get the next song ready.
+  var prefetched = false;
+  current_audio.addEventListener(
+    'play', function() {
+      if (!prefetched) {
+        prefetched = true;
+        prefetch_next_song();
+      }
+    }, false);
   // Update the time/progress element.
   current_audio.addEventListener(
     'timeupdate', function() {update_time();}, false);
@@ -20,14 +20,19 @@
 
 # Rhythmbox backend.
 
+import itertools
+import marshal
 import os
 import os.path
 import subprocess
 import sys
+import tempfile
 import urllib
 
 from backends import LibraryBackend
+from backends import assign_key
 from common import tokenize_filename
+from songtable import SongTable
 
 from xml.parsers import expat
 
@@ -35,88 +40,88 @@ from xml.parsers import expat
 RB_DBFILE = '~/.local/share/rhythmbox/rhythmdb.xml'
 # Path to XML file containing Rhythmbox playlists
 RB_PLAYLISTFILE = '~/.local/share/rhythmbox/playlists.xml'
+# Path to the file in which we save the parsed library and playlists, so we
+# don't have to parse them again on startup unless they've changed
+RB_CACHEFILE = '~/.cache/zeya/rhythmbox.cache'
+# Version of the format of RB_CACHEFILE
+CACHE_VERSION = 1
+
+# Fields of each song entry that we read.
+ENTRY_FIELDS = ('title', 'artist', 'album', 'location')
 
 class RhythmboxDbHandler():
     """
     Parser for Rhythmbox XML files.
+
+    Rhythmbox libraries can be large, so the parser only calls back into
+    Python for text while we're inside one of the fields we read: the
+    parser's character data handler then appends directly to a list of
+    chunks, and the rest of the time (including throughout entries that
+    aren't songs, such as podcasts and radio stations) it's unset.
     """
-    def __init__(self):
-        # List containing library metadata (see backends.LibraryBackend for
-        # full description).
-        self.contents = []
-        # Map the keys (ints) to the original file paths.
-        self.filelist = []
-        self.in_song = False     # Are we inside a <entry type="song"> ?
-        self.in_title = False    # Are we inside a <title> ?
-        self.in_artist = False   # Are we inside a <artist> ?
-        self.in_album = False    # Are we inside a <album> ?
-        self.in_location = False # Are we inside a <location> ?
+    def __init__(self, parser):
+        # The songs, in the order in which they appear, and the set of their
+        # keys.
+        self.songs = SongTable()
+        self._keys_in_use = set()
+        self._parser = parser
+        parser.buffer_text = True
+        parser.ordered_attributes = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        self._in_song = False    # Are we inside a <entry type="song"> ?
+        # The fields of the current song that have been read so far.
+        self._fields = None
+        # The text of the field we're inside, if any, as a list of chunks.
+        self._chunks = None
     def startElement(self, name, attrs):
-        # Within each <entry type="song">, record the attributes.
-        if name == 'entry' and attrs['type'] == 'song':
-            self.in_song = True
-            self.current_title = ''
-            self.current_artist = ''
-            self.current_album = ''
-            self.current_location = ''
-        if name == 'title':
-            self.in_title = True
-        if name == 'artist':
-            self.in_artist = True
-        if name == 'album':
-            self.in_album = True
-        if name == 'location':
-            self.in_location = True
+        if self._in_song:
+            if name in ENTRY_FIELDS:
+                self._chunks = []
+                self._parser.CharacterDataHandler = self._chunks.append
+        elif name == 'entry':
+            # (attrs is a list of alternating names and values.)
+            if dict(zip(attrs[::2], attrs[1::2])).get('type') == 'song':
+                self._in_song = True
+                self._fields = {}
     def endElement(self, name):
-        if self.in_song and name == 'entry':
+        if not self._in_song:
+            return
+        if self._chunks is not None and name in ENTRY_FIELDS:
+            self._parser.CharacterDataHandler = None
+            self._fields[name] = u''.join(self._chunks)
+            self._chunks = None
+        elif name == 'entry':
             # When a <entry> is closed, construct a new record for the
             # corresponding file.
-            self.in_song = False
-            if self.current_location.startswith('file://'):
+            self._in_song = False
+            fields = self._fields
+            self._fields = None
+            location = fields.get('location', u'')
+            if location.startswith('file://'):
                 # The <location> field contains a URL-encoded version of the
                 # file path. Use the decoded version in all of our data
                 # structures.
-                next_index = len(self.filelist)
-                path = urllib.unquote(str(self.current_location))[7:]
-                self.contents.append(
-                    {'title':self.current_title, 'artist':self.current_artist,
-                     'album':self.current_album, 'key':next_index})
-                self.filelist.append(path)
-        if self.in_title and name == 'title':
-            self.in_title = False
-        if self.in_artist and name == 'artist':
-            self.in_artist = False
-        if self.in_album and name == 'album':
-            self.in_album = False
-        if self.in_location and name == 'location':
-            self.in_location = False
-    def characters(self, ch):
-        if self.in_song:
-            # Record any text we come across and append it to the Title,
-            # Artist, Album, or Location fields as appropriate.
-            if self.in_title:
-                self.current_title += ch
-            if self.in_artist:
-                self.current_artist += ch
-            if self.in_album:
-                self.current_album += ch
-            if self.in_location:
-                self.current_location += ch
-    def getFiles(self):
-        return self.filelist
+                path = urllib.unquote(str(location))[7:]
+                # Assign a key that stays the same when the library is read
+                # again.
+                key = assign_key(path, self._keys_in_use)
+                self._keys_in_use.add(key)
+                self.songs.append(key, fields.get('title', u''),
+                                  fields.get('artist', u''),
+                                  fields.get('album', u''), path)
     def getContents(self):
-        return self.contents
+        return self.songs
 
 class RhythmboxPlaylistsHandler():
     """
     Parser for Rhythmbox playlist XML files.
     """
-    def __init__(self, file_list):
+    def __init__(self, songs):
         # Construct a map of filename to key so we can represent playlists as
-        # lists of keys.
-        self.file_to_key_map = {}
-        for key, filename in enumerate(file_list):
-            self.file_to_key_map[filename] = key
+        # lists of keys. songs is a SongTable of the library.
+        self.file_to_key_map = dict(
+            itertools.izip(songs.filenames, songs.keys))
 
         self.in_playlist = False
         self.in_location = False
@@ -176,11 +181,18 @@ class RhythmboxBackend(LibraryBackend):
     object.
     """
     def __init__(self, infile = None):
-        self._files = set()
+        # SongTable containing the library
         self._contents = None
         self._playlists = None
+        # Paths of the files we read, and their (mtime, size) when we read
+        # them (used by reload).
+        self._db_path = None
+        self._playlist_path = None
+        self._cache_path = None
+        self._stats = None
         if infile:
             self._dbfile = infile
+            self._playlistfile = None
             return
         rhythmbox_db_path = os.path.expanduser(RB_DBFILE)
         # Handle file-not-found before general IOErrors. If the Rhythmbox
@@ -191,59 +203,184 @@ class RhythmboxBackend(LibraryBackend):
             print "No Rhythmbox DB was found at %r." % (rhythmbox_db_path,)
             print "Consider using --path to read from a directory instead."
             sys.exit(1)
+        self._db_path = rhythmbox_db_path
+        self._playlist_path = os.path.expanduser(RB_PLAYLISTFILE)
+        self._cache_path = os.path.expanduser(RB_CACHEFILE)
+        if self.load_cache():
+            # If the files have changed since, the cached library is used
+            # until they've been read again (see needs_reload).
+            return
+        self._stats = self.get_stats()
         try:
-            self._dbfile = open(rhythmbox_db_path)
+            self._contents, self._playlists = self.read_files()
         except IOError:
             print "Couldn't read from Rhythmbox DB (%r)." \
                 % (rhythmbox_db_path,)
             sys.exit(1)
+        self.save_cache()
 
-        rhythmbox_playlist_path = os.path.expanduser(RB_PLAYLISTFILE)
+    def open_playlist_file(self):
         try:
-            self._playlistfile = open(rhythmbox_playlist_path)
+            return open(self._playlist_path)
         except IOError:
-            self._playlistfile = None
             print ("Warning: could not open Rhythmbox playlists.xml file " + \
                        "at %r. Playlists will not be loaded." % \
-                       (rhythmbox_playlist_path,))
+                       (self._playlist_path,))
+            return None
+
+    def get_stats(self):
+        """
+        Return the (mtime, size) of the DB and playlist files (None for a file
+        that doesn't exist).
+        """
+        stats = []
+        for path in (self._db_path, self._playlist_path):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stats.append(None)
+                continue
+            stats.append((stat.st_mtime, stat.st_size))
+        return tuple(stats)
+
+    def read_files(self):
+        """
+        Read the DB and playlist files, and return the library contents and
+        the playlists. Raises IOError if the DB can't be read.
+        """
+        dbfile = open(self._db_path)
+        try:
+            contents = self.read_library(dbfile)
+        finally:
+            dbfile.close()
+        playlistfile = self.open_playlist_file()
+        try:
+            playlists = self.read_playlists(playlistfile, contents)
+        finally:
+            if playlistfile is not None:
+                playlistfile.close()
+        return contents, playlists
+
+    def load_cache(self):
+        """
+        Load the library and playlists saved by save_cache, along with the
+        stats of the files they were read from. Returns False if there's no
+        usable cache.
+        """
+        try:
+            cachefile = open(self._cache_path, 'rb')
+            try:
+                version, paths, stats, songs, playlists = \
+                    marshal.load(cachefile)
+            finally:
+                cachefile.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if version != CACHE_VERSION \
+                or paths != (self._db_path, self._playlist_path):
+            return False
+        self._stats = stats
+        self._contents = SongTable(songs)
+        self._playlists = [{'name': name, 'items': items}
+                           for name, items in playlists]
+        return True
+
+    def save_cache(self):
+        """
+        Save the library and playlists, so they can be loaded by load_cache
+        the next time instead of being parsed again.
+        """
+        songs = list(self._contents.rows())
+        playlists = [(playlist['name'], playlist['items'])
+                     for playlist in self._playlists]
+        data = (CACHE_VERSION, (self._db_path, self._playlist_path),
+                self._stats, songs, playlists)
+        try:
+            cache_dir = os.path.dirname(self._cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Write a new file and move it into place, so that a partially
+            # written cache is never read.
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+            try:
+                cachefile = os.fdopen(fd, 'wb')
+                try:
+                    marshal.dump(data, cachefile)
+                finally:
+                    cachefile.close()
+                os.rename(temp_path, self._cache_path)
+            except:
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError), e:
+            print "Warning: couldn't save the Rhythmbox library to %r: %s" \
+                % (self._cache_path, e)
+
+    def read_library(self, dbfile):
+        """
+        Parse the given Rhythmbox DB and return the library contents (a
+        SongTable).
+        """
+        p = expat.ParserCreate()
+        handler = RhythmboxDbHandler(p)
+        p.ParseFile(dbfile)
+        # Sort the items by filename.
+        return handler.getContents().sort_by_filename(tokenize_filename)
+
+    def read_playlists(self, playlistfile, contents):
+        """
+        Parse the given Rhythmbox playlists file (which may be None) and return
+        the playlists, given the library contents.
+        """
+        if playlistfile is None:
+            return []
+        handler = RhythmboxPlaylistsHandler(contents)
+        p = expat.ParserCreate()
+        p.StartElementHandler = handler.startElement
+        p.EndElementHandler = handler.endElement
+        p.CharacterDataHandler = handler.characters
+        p.ParseFile(playlistfile)
+        playlists = handler.getPlaylists()
+        playlists.sort(key = (lambda playlist: playlist['name']))
+        return playlists
 
     def get_library_contents(self):
-        # Memoize self._contents and self._files.
-        if not self._contents:
-            handler = RhythmboxDbHandler()
-            p = expat.ParserCreate()
-            p.StartElementHandler = handler.startElement
-            p.EndElementHandler = handler.endElement
-            p.CharacterDataHandler = handler.characters
-            p.ParseFile(self._dbfile)
-            self._contents = handler.getContents()
-            self._files = handler.getFiles()
-            # Sort the items by filename.
-            self._contents.sort(
-                key = (lambda item:
-                           tokenize_filename(self._files[item['key']])))
+        # Memoize self._contents.
+        if self._contents is None:
+            self._contents = self.read_library(self._dbfile)
         return self._contents
 
     def get_playlists(self):
-        if not self._contents:
-            # Make sure _contents and _files are populated.
-            self.get_library_contents()
         if self._playlists is None:
-            if self._playlistfile is None:
-                self._playlists = []
-            else:
-                handler = RhythmboxPlaylistsHandler(self._files)
-                p = expat.ParserCreate()
-                p.StartElementHandler = handler.startElement
-                p.EndElementHandler = handler.endElement
-                p.CharacterDataHandler = handler.characters
-                p.ParseFile(self._playlistfile)
-                self._playlists = handler.getPlaylists()
-                self._playlists.sort(key = (lambda playlist: playlist['name']))
+            self._playlists = self.read_playlists(self._playlistfile,
+                                                  self.get_library_contents())
         return self._playlists
 
+    def reload(self):
+        """
+        Read the Rhythmbox DB and playlists again, if either has changed.
+        """
+        if self._db_path is None:
+            # We were given a file object to read from.
+            return
+        stats = self.get_stats()
+        if stats == self._stats:
+            return
+        try:
+            contents, playlists = self.read_files()
+        except IOError:
+            print "Couldn't read from Rhythmbox DB (%r)." % (self._db_path,)
+            return
+        self._stats = stats
+        self._contents = contents
+        self._playlists = playlists
+        self.save_cache()
+
+    def needs_reload(self):
+        return self._db_path is not None and self.get_stats() != self._stats
+
     def get_filename_from_key(self, key):
         try:
-            return self._files[int(key)]
-        except IndexError:
+            return self.get_library_contents().get_filename(int(key))
+        except KeyError:
             raise KeyError("Invalid key: %r" % (key,))
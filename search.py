@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Index for searching the library.
+#
+# A query such as "help, the beatles" matches a song if each comma-separated
+# part of it appears somewhere in the song's title, artist, or album (the same
+# rule zeyaclient has always used). Matching is case-insensitive.
+#
+# Since parts match anywhere within a field, not only at word boundaries, the
+# index maps each trigram (sequence of three characters) to the songs that
+# contain it. The songs containing every trigram of a part are the only ones
+# that can match it, and only those are checked.
+
+import array
+import itertools
+
+from songtable import SongTable
+
+SEARCH_FIELDS = ['title', 'artist', 'album']
+NGRAM_SIZE = 3
+
+def fold(text):
+    """
+    Return the case-folded form of a metadata value or query.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return text.lower()
+
+def get_ngrams(text):
+    return set([text[i:i + NGRAM_SIZE]
+                for i in xrange(len(text) - NGRAM_SIZE + 1)])
+
+def parse_query(query):
+    """
+    Return a list of the (folded) comma-separated parts of the query. Empty
+    parts, which match every song, are omitted.
+    """
+    terms = []
+    for part in fold(query).split(','):
+        part = part.strip()
+        if part:
+            terms.append(part)
+    return terms
+
+def score_match(text, value):
+    """
+    Return how well text matches the (folded) field value: 3 if it's the whole
+    value, 2 if it's at the beginning, 1 if it's at the beginning of a word,
+    0 if it's anywhere else, or None if it doesn't appear at all.
+    """
+    index = value.find(text)
+    if index == -1:
+        return None
+    if value == text:
+        return 3
+    if index == 0:
+        return 2
+    while index != -1:
+        if not value[index - 1].isalnum():
+            return 1
+        index = value.find(text, index + 1)
+    return 0
+
+class SearchIndex(object):
+    """
+    Index of the metadata of a list of songs (a songtable.SongTable, or a list
+    in the form returned by LibraryBackend.get_library_contents).
+    """
+    def __init__(self, songs):
+        if not isinstance(songs, SongTable):
+            songs = SongTable.from_songs(songs)
+        self._keys = songs.keys
+        # Map from each field to a list of the folded value of that field for
+        # each song. Each distinct value is folded once, and values that
+        # folding doesn't change are the SongTable's own strings.
+        self._values = {}
+        folded = {}
+        for field, column in zip(SEARCH_FIELDS,
+                                 [songs.titles, songs.artists, songs.albums]):
+            values = []
+            for value in column:
+                folded_value = folded.get(value)
+                if folded_value is None:
+                    folded_value = fold(value)
+                    if folded_value == value:
+                        folded_value = value
+                    folded[value] = folded_value
+                values.append(folded_value)
+            self._values[field] = values
+        # Map from n-gram to an array of the (increasing) indices of the songs
+        # containing it, in any field.
+        self._postings = {}
+        columns = [self._values[field] for field in SEARCH_FIELDS]
+        for index, values in enumerate(itertools.izip(*columns)):
+            ngrams = set()
+            for value in values:
+                ngrams.update(get_ngrams(value))
+            for ngram in ngrams:
+                posting = self._postings.get(ngram)
+                if posting is None:
+                    posting = self._postings[ngram] = array.array('i')
+                posting.append(index)
+
+    def _get_candidates(self, text):
+        """
+        Return a set of the indices of the songs that may contain text, or
+        None if text is too short for the index to narrow them down.
+        """
+        ngrams = get_ngrams(text)
+        if not ngrams:
+            return None
+        postings = []
+        for ngram in ngrams:
+            posting = self._postings.get(ngram)
+            if posting is None:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, query):
+        """
+        Return the keys of the songs matching the query, best matches first.
+        Songs that match equally well are returned in library order.
+        """
+        terms = parse_query(query)
+        candidates = None
+        for text in terms:
+            term_candidates = self._get_candidates(text)
+            if term_candidates is None:
+                continue
+            if candidates is None:
+                candidates = term_candidates
+            else:
+                candidates &= term_candidates
+        if candidates is None:
+            candidates = xrange(len(self._keys))
+        else:
+            candidates = sorted(candidates)
+        results = []
+        values = self._values
+        for index in candidates:
+            total_score = 0
+            for text in terms:
+                scores = [score_match(text, values[field][index])
+                          for field in SEARCH_FIELDS]
+                scores = [score for score in scores if score is not None]
+                if not scores:
+                    break
+                total_score += max(scores)
+            else:
+                results.append((-total_score, index))
+        results.sort()
+        return [self._keys[index] for score, index in results]
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Compact in-memory representation of the songs in a library.
+#
+# A dict per song costs several hundred bytes, and with a large library (plus
+# the dicts mapping keys to filenames and back) that adds up to hundreds of
+# MB. A SongTable stores each attribute of the songs in its own list instead,
+# with the keys in an array, and shares a single copy of each distinct artist
+# and album name. Songs are only turned into dicts when they're requested.
+
+import array
+import bisect
+import itertools
+
+try:
+    import json
+    json.dumps
+except (ImportError, AttributeError):
+    import simplejson as json
+
+# Number of songs encoded at a time by SongTable.iter_json.
+JSON_CHUNK_SIZE = 1000
+
+def make_key_array(keys=()):
+    """
+    Return an array of the given keys, or a list if a C long can't hold them
+    all. (Keys are less than backends.KEY_LIMIT, which fits in 64 bits.)
+    """
+    if array.array('l').itemsize >= 8:
+        return array.array('l', keys)
+    return list(keys)
+
+def to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+class SongTable(object):
+    """
+    A list of songs, each with a key, title, artist, album, and filename.
+
+    A SongTable can be used as a read-only sequence of the songs in the form
+    returned by LibraryBackend.get_library_contents (a dict per song, built
+    on demand); their filenames are available from get_filename and
+    filenames.
+    """
+    def __init__(self, rows=()):
+        """
+        Initializes a table containing the songs in rows, a sequence of
+        (key, title, artist, album, filename).
+        """
+        self.keys = make_key_array()
+        self.titles = []
+        self.artists = []
+        self.albums = []
+        self.filenames = []
+        # Map from each artist or album name to the copy of it that we keep.
+        self._strings = {}
+        # Indexes used to look up songs by key and by filename (see
+        # find_key and find_filename), built when they're first needed.
+        self._key_index = None
+        self._filename_index = None
+        for row in rows:
+            self.append(*row)
+
+    @classmethod
+    def from_songs(cls, songs, get_filename=None):
+        """
+        Return a table containing the given songs (dicts in the form returned
+        by LibraryBackend.get_library_contents). The filename of each song is
+        obtained by calling get_filename with its key, if supplied.
+        """
+        table = cls()
+        for song in songs:
+            if get_filename is None:
+                filename = None
+            else:
+                filename = get_filename(song['key'])
+            table.append(song['key'], song['title'], song['artist'],
+                         song['album'], filename)
+        return table
+
+    def append(self, key, title, artist, album, filename):
+        self.keys.append(key)
+        self.titles.append(to_unicode(title))
+        strings = self._strings
+        artist = to_unicode(artist)
+        self.artists.append(strings.setdefault(artist, artist))
+        album = to_unicode(album)
+        self.albums.append(strings.setdefault(album, album))
+        self.filenames.append(filename)
+        self._key_index = None
+        self._filename_index = None
+
+    def _copy_rows(self, indices):
+        """
+        Return a table containing the songs at the given indices, in order.
+        """
+        table = self.__class__()
+        table._strings = self._strings
+        table.keys = make_key_array([self.keys[i] for i in indices])
+        for column in ('titles', 'artists', 'albums', 'filenames'):
+            values = getattr(self, column)
+            setattr(table, column, [values[i] for i in indices])
+        return table
+
+    def filter_filenames(self, predicate):
+        """
+        Return a table containing the songs whose filenames satisfy
+        predicate, in the same order.
+        """
+        return self._copy_rows([i for i, filename in enumerate(self.filenames)
+                                if predicate(filename)])
+
+    def sort_by_filename(self, key):
+        """
+        Return a table containing the songs sorted by key(filename).
+        """
+        sort_keys = [key(filename) for filename in self.filenames]
+        return self._copy_rows(sorted(xrange(len(self)),
+                                      key=sort_keys.__getitem__))
+
+    def rows(self):
+        """
+        Iterate over the (key, title, artist, album, filename) of each song.
+        """
+        return itertools.izip(self.keys, self.titles, self.artists,
+                              self.albums, self.filenames)
+
+    def get_song(self, index):
+        return {'key': self.keys[index], 'title': self.titles[index],
+                'artist': self.artists[index], 'album': self.albums[index]}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_song(i)
+                    for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SongTable index out of range")
+        return self.get_song(index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self.get_song(index)
+
+    def __eq__(self, other):
+        if isinstance(other, SongTable):
+            return list(self.rows()) == list(other.rows())
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _find(self, index, value):
+        """
+        Return the index of the song with the given value, using index, a
+        pair of the sorted values of a column and the indices of the songs
+        they belong to (see _make_index).
+        """
+        values, indices = index
+        position = bisect.bisect_left(values, value)
+        if position == len(values) or values[position] != value:
+            raise KeyError(value)
+        return indices[position]
+
+    def _make_index(self, column, make_values):
+        indices = sorted(xrange(len(self)), key=column.__getitem__)
+        return (make_values([column[i] for i in indices]),
+                array.array('i', indices))
+
+    def find_key(self, key):
+        """
+        Return the index of the song with the given key, or raise KeyError if
+        there isn't one.
+        """
+        index = self._key_index
+        if index is None:
+            index = self._key_index = self._make_index(self.keys,
+                                                       make_key_array)
+        return self._find(index, key)
+
+    def find_filename(self, filename):
+        """
+        Return the index of the song with the given filename, or raise
+        KeyError if there isn't one.
+        """
+        index = self._filename_index
+        if index is None:
+            index = self._filename_index = self._make_index(self.filenames,
+                                                            list)
+        return self._find(index, filename)
+
+    def get_filename(self, key):
+        """
+        Return the filename of the song with the given key, or raise KeyError
+        if there isn't one.
+        """
+        return self.filenames[self.find_key(key)]
+
+    def iter_json(self):
+        """
+        Iterate over the parts of a UTF-8-encoded JSON array of the songs
+        (equivalent to json.dumps(list(self))), without building it all at
+        once.
+        """
+        encode = json.encoder.encode_basestring
+        # Each artist and album only needs to be encoded once.
+        encoded = {}
+        def encode_shared(value):
+            result = encoded.get(value)
+            if result is None:
+                result = encoded[value] = encode(value)
+            return result
+        yield '['
+        for start in xrange(0, len(self), JSON_CHUNK_SIZE):
+            end = min(start + JSON_CHUNK_SIZE, len(self))
+            songs = []
+            for i in xrange(start, end):
+                songs.append(
+                    u'{"key": %d, "title": %s, "artist": %s, "album": %s}'
+                    % (self.keys[i], encode(self.titles[i]),
+                       encode_shared(self.artists[i]),
+                       encode_shared(self.albums[i])))
+            if start > 0:
+                yield ', '
+            yield u', '.join(songs).encode('utf-8')
+        yield ']'
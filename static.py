@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Phil Sung
+#
+# This file is part of Zeya.
+#
+# Zeya is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Zeya is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Zeya. If not, see <http://www.gnu.org/licenses/>.
+
+
+# In-memory copies of the data we serve over HTTP (other than audio streams),
+# compressed ahead of time.
+#
+# Large generated resources (the library) are kept only in compressed form, in
+# a single deflate stream that is framed as gzip or zlib data when it's sent.
+# The uncompressed data is generated again, a piece at a time, for clients
+# that need it.
+
+# Work with python2.5
+from __future__ import with_statement
+
+import StringIO
+import email.utils
+import gzip
+import hashlib
+import itertools
+import os
+import struct
+import threading
+import zlib
+
+# Content-codings we can serve, in order of preference.
+ENCODINGS = ['gzip', 'deflate']
+
+def gzip_compress(data):
+    out = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+compressors = {
+    'gzip': gzip_compress,
+    'deflate': zlib.compress,
+}
+
+# Compression level used for StreamedResources (the default for gzip).
+COMPRESSION_LEVEL = 9
+
+# Header of a gzip member with no file name or timestamp (RFC 1952), and of a
+# zlib stream with the default window size (RFC 1950).
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+ZLIB_HEADER = '\x78\xda'
+
+def choose_encoding(accept_encoding, available):
+    """
+    Return the content-coding (one of available, a list in order of
+    preference) to use for a client that sent the given Accept-Encoding
+    header, or None to send the data uncompressed.
+    """
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        # Codings with q=0 are explicitly not acceptable.
+        if quality > 0:
+            accepted.add(coding)
+    for coding in available:
+        if coding in accepted or '*' in accepted:
+            return coding
+    return None
+
+class Resource(object):
+    """
+    A piece of data to be served over HTTP, along with its compressed forms
+    and the validators used for conditional requests.
+    """
+    def __init__(self, data, content_type, mtime=None, compress=True):
+        """
+        Initializes a resource with the given contents. If compress is True,
+        compressed forms of the data are prepared too, in every encoding we
+        support (except those that don't make the data smaller).
+
+        mtime, if supplied, is the time at which the data was last modified.
+        """
+        self.content_type = content_type
+        self.mtime = mtime
+        if mtime is not None:
+            self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        else:
+            self.last_modified = None
+        self._tag = hashlib.sha1(data).hexdigest()
+        # Map from content-coding (None for the uncompressed data) to the
+        # encoded data.
+        self._data = {None: data}
+        if compress:
+            for coding in ENCODINGS:
+                compressed = compressors[coding](data)
+                if len(compressed) < len(data):
+                    self._data[coding] = compressed
+        self.encodings = [coding for coding in ENCODINGS
+                          if coding in self._data]
+
+    def get_data(self, encoding=None):
+        return self._data[encoding]
+
+    def get_length(self, encoding=None):
+        return len(self._data[encoding])
+
+    def get_chunks(self, encoding=None):
+        """
+        Return an iterable of strings which together make up the data in the
+        given encoding.
+        """
+        return [self._data[encoding]]
+
+    def get_etag(self, encoding=None):
+        """
+        Return the (strong) entity tag for the data in the given encoding.
+        """
+        if encoding is None:
+            return '"%s"' % (self._tag,)
+        return '"%s-%s"' % (self._tag, encoding)
+
+    def matches(self, if_none_match, if_modified_since, encoding=None):
+        """
+        Return True if a client that sent the given If-None-Match and
+        If-Modified-Since headers (either of which may be None) already has
+        the current data in the given encoding.
+        """
+        if if_none_match is not None:
+            etag = self.get_etag(encoding)
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        if if_modified_since is not None and self.mtime is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(self.mtime) <= email.utils.mktime_tz(since)
+        return False
+
+class StreamedResource(Resource):
+    """
+    A Resource whose data is too large to keep in memory more than once.
+
+    Only a single compressed copy of the data is stored, from which both of
+    the compressed forms are served. The uncompressed data is generated again
+    whenever it's requested.
+    """
+    def __init__(self, make_chunks, content_type, mtime=None):
+        """
+        Initializes a resource with the contents produced by make_chunks, a
+        function returning an iterable of strings. It must produce the same
+        data every time it's called.
+        """
+        self.content_type = content_type
+        self.mtime = mtime
+        if mtime is not None:
+            self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        else:
+            self.last_modified = None
+        self._make_chunks = make_chunks
+        digest = hashlib.sha1()
+        crc = zlib.crc32('')
+        adler = zlib.adler32('')
+        size = 0
+        # A raw deflate stream (with no header or trailer) of the data.
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+        deflated = []
+        for chunk in make_chunks():
+            digest.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            adler = zlib.adler32(chunk, adler)
+            size += len(chunk)
+            compressed = compressor.compress(chunk)
+            if compressed:
+                deflated.append(compressed)
+        deflated.append(compressor.flush())
+        self._tag = digest.hexdigest()
+        self._size = size
+        self._deflated = deflated
+        self._deflated_size = sum(len(data) for data in deflated)
+        self._headers = {'gzip': GZIP_HEADER, 'deflate': ZLIB_HEADER}
+        self._trailers = {
+            'gzip': struct.pack('<II', crc & 0xffffffff, size & 0xffffffff),
+            'deflate': struct.pack('>I', adler & 0xffffffff),
+            }
+        self.encodings = [coding for coding in ENCODINGS
+                          if self.get_length(coding) < size]
+
+    def get_data(self, encoding=None):
+        return ''.join(self.get_chunks(encoding))
+
+    def get_length(self, encoding=None):
+        if encoding is None:
+            return self._size
+        return len(self._headers[encoding]) + self._deflated_size \
+            + len(self._trailers[encoding])
+
+    def get_chunks(self, encoding=None):
+        if encoding is None:
+            return self._make_chunks()
+        return itertools.chain([self._headers[encoding]], self._deflated,
+                               [self._trailers[encoding]])
+
+class ResourceDirectory(object):
+    """
+    Serves Resources for the files in a directory. Each file is read and
+    compressed the first time it's requested, and again only if it has been
+    modified since then.
+    """
+    def __init__(self, basedir):
+        self._basedir = basedir
+        # Map from filename to Resource.
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, content_type):
+        """
+        Return the Resource for the file with the given path (relative to the
+        base directory), or raise IOError if it can't be read. Files are
+        compressed if content_type is text/*.
+        """
+        filename = os.path.join(self._basedir, path)
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, filename)
+        with self._lock:
+            resource = self._resources.get(filename)
+        if resource is not None and resource.mtime == mtime:
+            return resource
+        with open(filename, 'rb') as f:
+            data = f.read()
+        resource = Resource(data, content_type, mtime,
+                            compress=content_type.startswith('text/'))
+        with self._lock:
+            self._resources[filename] = resource
+        return resource
@@ -32,12 +32,12 @@ import crypt
 import getopt
 import os
 import re
+import signal
 import socket
 import sys
 import tempfile
 import traceback
 import urllib
-import zlib
 
 try:
     from urlparse import parse_qs
@@ -51,8 +51,12 @@ except (ImportError, AttributeError):
     import simplejson as json
 
 import backends
-import decoders
+import encoders
+import library
 import options
+import static
+from cache import TranscodeCache
+from common import parse_byte_range
 
 b64dict = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 auth = 'Authorization'
@@ -72,6 +76,11 @@ no_auth_rval = \
 NO_AUTH = None
 BASIC_AUTH = 'basic'
 
+# Clients may keep copies of the library and the static resources, but must
+# check that they're still current before using them (which is cheap, see
+# send_resource), because their URLs don't change when they do.
+CACHE_CONTROL = 'no-cache'
+
 class BadArgsError(Exception):
     """
     Error due to incorrect command-line invocation of this program.
@@ -103,19 +112,33 @@ def split_user_pass(data):
     """ Split the given data into user and password. """
     return user_pass_regexp.search(data).groups()
 
-def ZeyaHandler(backend, library_repr, resource_basedir, bitrate,
-                auth_type=None, auth_data=None):
+def ZeyaHandler(backend, library_loader, resource_basedir, bitrate,
+                auth_type=None, auth_data=None, shape_buffered=True,
+                default_format=encoders.DEFAULT_FORMAT,
+                bitrate_ladder=encoders.DEFAULT_BITRATE_LADDER,
+                adaptive_bitrate=False):
     """
     Wrapper around the actual HTTP request handler implementation class. We
     need to create a closure so that the inner class can receive the following
     data:
 
     Backend to use.
-    Library data.
+    Source of the library data (a library.LibraryLoader).
     Base directory for resources.
-    Bitrate for encoding.
+    Bitrate for encoding (for Ogg Vorbis streams).
     Authentication data.
+    Whether to limit the rate at which buffered streams are sent.
+    Format of streams for clients that don't ask for a particular one.
+    Bitrates that clients may ask for.
+    Whether to lower the bitrate for clients that can't keep up.
     """
+    static_resources = static.ResourceDirectory(resource_basedir)
+    bitrate_adapter = None
+    if adaptive_bitrate:
+        bitrate_adapter = backends.BitrateAdapter(bitrate_ladder)
+    # Formats we can encode streams in, in order of preference.
+    formats = [default_format] + sorted(
+        [format for format in encoders.encoders if format != default_format])
 
     class ZeyaHandlerImpl(BaseHTTPRequestHandler, object):
         """
@@ -132,10 +155,32 @@ def ZeyaHandler(backend, library_repr, resource_basedir, bitrate,
             # collection.
             elif self.path == '/getlibrary':
                 self.serve_library()
+            # http://host/getlibrary?offset=N&limit=M&fields=F1,F2 returns
+            # part of the music collection, and the total number of songs.
+            elif self.path.startswith('/getlibrary?'):
+                self.serve_library_page(self.path[12:])
+            # http://host/search?q=QUERY&offset=N&limit=M&fields=F1,F2
+            # returns the keys of the matching songs (and, if fields is
+            # given, the songs themselves), best matches first.
+            elif self.path.startswith('/search?'):
+                self.serve_search(self.path[8:])
+            # http://host/getplaylists returns the IDs and names of the
+            # playlists, and http://host/getplaylist?id=N&offset=M&limit=L
+            # returns (part of) the contents of one of them.
+            elif self.path == '/getplaylists':
+                self.send_json(library_loader.current.get_playlist_summaries())
+            elif self.path.startswith('/getplaylist?'):
+                self.serve_playlist(self.path[13:])
             # http://host/getcontent?key=N yields an Ogg stream of the file
-            # associated with the specified key.
+            # associated with the specified key (or, with format=F, a stream
+            # in another format; see encoders.encoders). With bitrate=B, the
+            # stream is encoded at that bitrate instead of the default.
             elif self.path.startswith('/getcontent?'):
                 self.serve_content(urllib.unquote(self.path[12:]))
+            # http://host/prefetch?key=N starts encoding the specified file,
+            # which the client expects to request soon.
+            elif self.path.startswith('/prefetch?'):
+                self.serve_prefetch(urllib.unquote(self.path[10:]))
             # All other paths are assumed to be static content.
             # http://host/foo is mapped to resources/foo.
             else:
@@ -161,11 +206,19 @@ def ZeyaHandler(backend, library_repr, resource_basedir, bitrate,
                 print ("Warning: couldn't identify content-type for %r, "
                        + "serving as application/octet-stream") % (path,)
                 return 'application/octet-stream'
-        def serve_content(self, query):
+        def parse_content_query(self, query):
             """
-            Serve an audio stream (audio/ogg).
+            Parse the query string of a request for an audio stream, and
+            return a tuple (key, buffered, shaped, start, prefetch, format,
+            bitrate, client). If the query is not valid, send an error and
+            return None.
             """
-            # The query is of the form key=N or key=N&buffered=true.
+            # The query is of the form key=N or key=N&buffered=true, and may
+            # also contain start=S to begin the stream S seconds into the
+            # song, prefetch=true if the song isn't going to be played right
+            # away, format=F to request a stream in a particular format,
+            # bitrate=B to request a particular bitrate, or session=S to
+            # identify the client (see get_client).
             args = parse_qs(query)
             key = args['key'][0] if args.has_key('key') else ''
             # If buffering is activated, encode the entire file and serve the
@@ -174,63 +227,396 @@ def ZeyaHandler(backend, library_repr, resource_basedir, bitrate,
             # whole thing. However, Chrome needs the Content-Length header to
             # accompany audio data.
             buffered = args['buffered'][0] if args.has_key('buffered') else ''
+            # Buffered streams are sent as fast as possible, unless we've been
+            # asked to limit their rate like other streams.
+            shaped = shape_buffered or not buffered
+            # Prefetches have to wait for encoders to become free behind
+            # requests for songs that are being played.
+            prefetch = bool(args.get('prefetch', [''])[0])
+            try:
+                start = float(args['start'][0]) if args.has_key('start') else 0
+                if start < 0:
+                    raise ValueError()
+            except ValueError:
+                self.send_error(400, 'Invalid start time')
+                return None
+            format = self.choose_format(args)
+            if format is None:
+                self.send_error(400, 'Unsupported format')
+                return None
+            stream_bitrate = self.choose_bitrate(args, format, key)
+            if stream_bitrate is None:
+                self.send_error(400, 'Invalid bitrate')
+                return None
+            return (key, buffered, shaped, start, prefetch, format,
+                    stream_bitrate, self.get_client(args))
+
+        def get_client(self, args):
+            """
+            Return the name under which the client's prefetch (see
+            backends.Prefetcher) and its encoders are tracked, given the
+            query arguments of its request: its IP address, together with
+            the session argument if there is one. Clients that don't send a
+            session argument are only told apart by IP address, so clients
+            behind the same NAT or proxy share a prefetch.
+            """
+            client = self.client_address[0]
+            if args.has_key('session'):
+                client = '%s %s' % (client, args['session'][0])
+            return client
+
+        def choose_format(self, args):
+            """
+            Return the format in which to encode a stream, given the query
+            arguments of the request for it: the one named by the format
+            argument, if any, or else the one the client prefers according to
+            its Accept header. Returns None if the requested format can't be
+            produced.
+            """
+            if args.has_key('format'):
+                format = args['format'][0]
+                if not encoders.has_encoder(format):
+                    return None
+                return format
+            available = [format for format in formats
+                         if encoders.has_encoder(format)]
+            return encoders.choose_format(self.headers.get('Accept'),
+                                          available) or default_format
+
+        def choose_bitrate(self, args, format, key=None):
+            """
+            Return the bitrate at which to encode a stream in the given
+            format, given the query arguments of the request for it: the one
+            named by the bitrate argument (clamped to the ladder), or else the
+            default bitrate, lowered if the client hasn't been keeping up (see
+            backends.BitrateAdapter). Returns None if the bitrate argument
+            isn't valid.
+
+            If the stream is for the song with the given key, and the client
+            has prefetched that song in that format without asking for a
+            bitrate now, the prefetch's bitrate is used so that it isn't
+            wasted.
+            """
+            if key is not None and not args.has_key('bitrate'):
+                try:
+                    prefetch_bitrate = backend.get_prefetch_bitrate(
+                        key, self.get_client(args), format)
+                except (KeyError, ValueError):
+                    prefetch_bitrate = None
+                if prefetch_bitrate is not None:
+                    return prefetch_bitrate
+            requested = bitrate
+            if args.has_key('bitrate'):
+                try:
+                    requested = int(args['bitrate'][0])
+                    if requested <= 0:
+                        raise ValueError()
+                except ValueError:
+                    return None
+                requested = encoders.clamp_bitrate(requested, bitrate_ladder)
+            if bitrate_adapter is not None:
+                requested = bitrate_adapter.choose(self.client_address[0],
+                                                   format, requested)
+            return encoders.get_bitrate(format, requested)
+
+        def make_meter(self, sock):
+            """
+            Return a backends.ThroughputMeter for measuring how fast the
+            client accepts a stream sent over sock, its socket.
+            """
+            if bitrate_adapter is None:
+                return backends.ThroughputMeter()
+            return bitrate_adapter.make_meter(sock)
+
+        def record_throughput(self, meter):
+            """
+            Record how fast the client accepted a stream, as measured by meter
+            (a backends.ThroughputMeter).
+            """
+            if bitrate_adapter is not None:
+                bitrate_adapter.record(self.client_address[0], meter)
+
+        def serve_content(self, query):
+            """
+            Serve an audio stream (audio/ogg, or another format if the
+            client asked for one).
+            """
+            request = self.parse_content_query(query)
+            if request is None:
+                return
+            (key, buffered, shaped, start, prefetch, format, bitrate,
+             client) = request
+            content_type = encoders.content_types[format]
+            meter = self.make_meter(self.connection)
 
             # TODO: send error 500 when we encounter an error during the
             # decoding phase. This is needed for reliable client-side error
             # dialogs.
-            self.send_response(200)
-            self.send_header('Content-type', 'audio/ogg')
-            if buffered:
+            try:
+                content = backend.open_content(
+                    key, bitrate, start, client=client,
+                    prefetch=prefetch, format=format)
+            except backends.TranscodeBusyError, e:
+                print "Error: %s" % (e,)
+                self.send_busy(e.retry_after)
+                return
+            except (KeyError, ValueError):
+                print "Received invalid request for key %r" % (key,)
+                content = None
+            except backends.StreamGenerationError, e:
+                print "Error: %s" % (e,)
+                content = None
+            if content is None:
+                self.send_empty_stream(buffered, content_type)
+            elif not isinstance(content, backends.TranscodeReader):
+                # The encoded data is already available, either because the
+                # file can be served as-is or because it was cached, so we
+                # can serve it right away (regardless of whether buffering was
+                # requested).
+                self.serve_complete_file(content, content_type,
+                                         bitrate if shaped else None, meter)
+                content.close()
+            elif buffered:
                 # Complete the transcode and write to a temporary file.
                 # Determine its length and serve the Content-Length header.
                 output_file = tempfile.TemporaryFile()
-                backend.get_content(key, output_file, bitrate, buffered=True)
-                output_file.seek(0)
-                data = output_file.read()
-                self.send_header('Content-Length', str(len(data)))
-                self.end_headers()
+                backends.copy_content(content, output_file, bitrate,
+                                      buffered=True)
                 output_file.seek(0)
-                try:
-                    backends.copy_output_with_shaping(
-                        output_file.fileno(), self.wfile, bitrate)
-                except socket.error:
-                    pass
+                self.serve_complete_file(output_file, content_type,
+                                         bitrate if shaped else None, meter)
                 output_file.close()
             else:
                 # Don't determine the Content-Length. Just stream to the client
                 # on the fly.
+                self.send_response(200)
+                self.send_header('Content-type', content_type)
                 self.end_headers()
-                backend.get_content(key, self.wfile, bitrate)
+                backends.copy_content(content, self.wfile, bitrate,
+                                      meter=meter)
+            self.record_throughput(meter)
             self.wfile.close()
 
-        def send_data(self, ctype, data):
+        def serve_prefetch(self, query):
+            """
+            Start encoding a song that the client is going to play next, and
+            respond with 204 No Content.
+            """
+            args = parse_qs(query)
+            key = args['key'][0] if args.has_key('key') else ''
+            format = self.choose_format(args)
+            if format is None:
+                self.send_error(400, 'Unsupported format')
+                return
+            stream_bitrate = self.choose_bitrate(args, format)
+            if stream_bitrate is None:
+                self.send_error(400, 'Invalid bitrate')
+                return
+            try:
+                self.start_prefetch(key, format, stream_bitrate,
+                                    self.get_client(args))
+            except (KeyError, ValueError):
+                print "Received invalid request for key %r" % (key,)
+                self.send_error(404, 'No such song')
+                return
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def start_prefetch(self, key, format, bitrate, client):
+            backend.prefetch_content(key, bitrate, client, format=format)
+
+        def send_empty_stream(self, buffered, content_type='audio/ogg'):
+            """
+            Respond to a request for a stream that couldn't be generated.
+            """
+            if buffered:
+                self.send_complete_file_headers(0, content_type)
+            else:
+                self.send_response(200)
+                self.send_header('Content-type', content_type)
+                self.end_headers()
+
+        def send_busy(self, retry_after):
+            """
+            Respond to a request for a stream that couldn't be generated
+            because the server is too busy.
+            """
+            self.send_response(503)
+            self.send_header('Retry-After', str(retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def serve_complete_file(self, content_file, ctype, bitrate=None,
+                                meter=None):
+            """
+            Serve the contents of content_file, a real file, along with its
+            Content-Length. If the client requested a byte range, serve only
+            that part of the file.
+
+            If bitrate is supplied, limit the rate at which the data is sent
+            according to that bitrate (see backends.copy_file_with_shaping).
+            If meter (a backends.ThroughputMeter) is supplied, the writes are
+            measured with it.
             """
-            Send data to the client.
+            size = os.fstat(content_file.fileno()).st_size
+            byte_range = self.send_complete_file_headers(size, ctype)
+            if byte_range is None:
+                return
+            first, length = byte_range
+            content_file.seek(first)
+            try:
+                backends.copy_file_with_shaping(
+                    content_file, self.wfile, bitrate,
+                    self.connection.fileno(), length, meter)
+            except socket.error:
+                pass
 
-            Use deflate compression if client headers indicate that the
-            other end supports it and if it's appropriate for this
-            content-type.
+        def send_complete_file_headers(self, size, ctype):
             """
-            compress_data = \
-                (ctype.startswith('text/')
-                 and 'Accept-Encoding' in self.headers
-                 and 'deflate' in self.headers['Accept-Encoding'].split(','))
-            self.send_response(200)
-            if compress_data:
-                data = zlib.compress(data)
-                self.send_header('Content-Encoding', 'deflate')
+            Send the headers for a response containing a file of the given
+            size, or the part of it that the client requested. Return a tuple
+            (first, length) giving the part of the file to send, or None if
+            there's nothing to send.
+            """
+            byte_range = None
+            if 'Range' in self.headers:
+                try:
+                    byte_range = parse_byte_range(self.headers['Range'], size)
+                except ValueError:
+                    # Ignore malformed ranges and serve the whole file.
+                    byte_range = (0, size - 1)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % (size,))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return None
+            if byte_range is not None and byte_range != (0, size - 1):
+                first, last = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+            else:
+                first, last = 0, size - 1
+                self.send_response(200)
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            return (first, last - first + 1)
+
+        def send_resource(self, resource):
+            """
+            Send a static.Resource to the client, using one of its compressed
+            forms if the client supports it. If the client's copy is already
+            current, send 304 Not Modified instead.
+            """
+            encoding = static.choose_encoding(
+                self.headers.get('Accept-Encoding'), resource.encodings)
+            if resource.matches(self.headers.get('If-None-Match'),
+                                self.headers.get('If-Modified-Since'),
+                                encoding):
+                self.send_response(304)
+                chunks = []
+            else:
+                self.send_response(200)
+                chunks = resource.get_chunks(encoding)
+                if encoding is not None:
+                    self.send_header('Content-Encoding', encoding)
+                self.send_header('Content-Length',
+                                 str(resource.get_length(encoding)))
+                self.send_header('Content-Type', resource.content_type)
+            self.send_header('ETag', resource.get_etag(encoding))
+            if resource.last_modified is not None:
+                self.send_header('Last-Modified', resource.last_modified)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+            if resource.encodings:
                 self.send_header('Vary', 'Accept-Encoding')
-            self.send_header('Content-Length', str(len(data)))
-            self.send_header('Content-Type', ctype)
             self.end_headers()
-            self.wfile.write(data)
+            self.send_body(chunks)
             self.wfile.close()
 
+        def send_body(self, chunks):
+            """
+            Send the response body made up of the given strings.
+            """
+            for data in chunks:
+                self.wfile.write(data)
+
         def serve_library(self):
             """
             Serve a representation of the library.
             """
-            self.send_data('text/html', library_repr.encode('utf-8'))
+            self.send_resource(library_loader.current.resource)
+
+        def parse_page_args(self, args):
+            """
+            Return the offset and limit (which may be None) specified in the
+            given query arguments. Raises ValueError if they're invalid.
+            """
+            offset = int(args['offset'][0]) if args.has_key('offset') else 0
+            limit = int(args['limit'][0]) if args.has_key('limit') else None
+            return offset, limit
+
+        def serve_library_page(self, query):
+            """
+            Serve part of the library.
+            """
+            args = parse_qs(query)
+            fields = args['fields'][0].split(',') \
+                if args.has_key('fields') else None
+            try:
+                offset, limit = self.parse_page_args(args)
+                page = library_loader.current.get_songs(offset, limit, fields)
+            except ValueError, e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(page)
+
+        def serve_search(self, query):
+            """
+            Serve the results of a search.
+            """
+            args = parse_qs(query)
+            q = args['q'][0] if args.has_key('q') else ''
+            fields = args['fields'][0].split(',') \
+                if args.has_key('fields') else None
+            try:
+                offset, limit = self.parse_page_args(args)
+                results = library_loader.current.search(
+                    q.decode('utf-8', 'replace'), offset, limit, fields)
+            except ValueError, e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(results)
+
+        def serve_playlist(self, query):
+            """
+            Serve (part of) a single playlist.
+            """
+            args = parse_qs(query)
+            try:
+                playlist_id = int(args['id'][0]) if args.has_key('id') else -1
+                offset, limit = self.parse_page_args(args)
+                playlist = library_loader.current.get_playlist(
+                    playlist_id, offset, limit)
+            except KeyError:
+                self.send_error(404, 'No such playlist')
+                return
+            except ValueError, e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(playlist)
+
+        def send_json(self, obj):
+            """
+            Send a JSON representation of obj to the client.
+            """
+            data = json.dumps(obj, ensure_ascii=False)
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            self.send_resource(static.Resource(data, 'application/json'))
 
         def serve_static_content(self, path):
             """
@@ -247,11 +633,13 @@ def ZeyaHandler(backend, library_repr, resource_basedir, bitrate,
                 if not os.path.abspath(full_path).startswith(effective_basedir):
                     self.send_error(404, 'File not found: %s' % (path,))
                     return
-                with open(full_path) as f:
-                    self.send_data(self.get_content_type(path), f.read())
+                resource = static_resources.get(path[1:],
+                                                self.get_content_type(path))
             except IOError:
                 traceback.print_exc()
                 self.send_error(404, 'File not found: %s' % (path,))
+                return
+            self.send_resource(resource)
 
     class ZeyaBasicAuthHandlerImpl(ZeyaHandlerImpl):
         def __init__(self, *args, **kwargs):
@@ -311,7 +699,7 @@ def get_backend(backend_type):
         return RhythmboxBackend()
     elif backend_type == 'dir':
         from directory import DirectoryBackend
-        return DirectoryBackend(path)
+        return DirectoryBackend(path, scan_workers=scan_workers)
     elif backend_type == 'playlist':
         if path.lower().endswith('m3u'):
             from m3u import M3uBackend
@@ -322,31 +710,47 @@ def get_backend(backend_type):
     else:
         raise ValueError("Invalid backend %r" % (backend_type,))
 
-def run_server(backend, bind_address, port, bitrate, basic_auth_file=None):
+def run_server(backend, bind_address, port, bitrate, basic_auth_file=None,
+               cache_dir=None, cache_size=options.DEFAULT_CACHE_SIZE,
+               shape_buffered=True, server_type=options.DEFAULT_SERVER,
+               max_transcodes=options.DEFAULT_MAX_TRANSCODES,
+               max_queue_wait=options.DEFAULT_MAX_QUEUE_WAIT, watch=False,
+               format=encoders.DEFAULT_FORMAT,
+               bitrate_ladder=encoders.DEFAULT_BITRATE_LADDER,
+               adaptive_bitrate=False):
+    if max_transcodes:
+        backend.set_transcode_slots(
+            backends.TranscodeSlots(max_transcodes, max_queue_wait))
+    backend.set_prefetcher(backends.Prefetcher())
+    if cache_dir is not None:
+        try:
+            backend.set_transcode_cache(TranscodeCache(cache_dir, cache_size))
+        except (IOError, OSError), e:
+            print "Warning: couldn't use transcode cache directory %r: %s" \
+                % (cache_dir, e)
+        else:
+            print "Caching encoded streams in %r" % (cache_dir,)
+
     # Read the library.
     print "Loading library..."
-
-    library_contents = backend.get_library_contents()
-    if not library_contents:
-        print "Warning: no tracks were found. Check that you've specified " \
-            + "the right backend/path."
-    # Filter out songs that we won't be able to decode.
-    filtered_library_contents = \
-        [ s for s in library_contents \
-              if decoders.has_decoder(backend.get_filename_from_key(s['key'])) ]
-    if not filtered_library_contents and library_contents:
-        print "Warning: no playable tracks were found. You may need to " \
-            "install one or more decoders."
-
     try:
-        playlists = backend.get_playlists()
-    except NotImplementedError:
-        playlists = None
-
-    output = { 'library': filtered_library_contents,
-               'playlists': playlists }
-
-    library_repr = json.dumps(output, ensure_ascii=False)
+        library_loader = library.LibraryLoader(backend)
+    except IOError, e:
+        print e
+        sys.exit(1)
+    # Reload the library when we receive SIGHUP.
+    signal.signal(signal.SIGHUP, lambda signum, frame:
+                      library_loader.reload_in_background())
+    if watch:
+        try:
+            library_loader.watch()
+        except NotImplementedError:
+            print "Warning: this backend can't watch for changes. " \
+                "Send SIGHUP to reload the library instead."
+        except OSError, e:
+            print "Warning: couldn't watch for changes: %s" % (e.strerror,)
+        else:
+            print "Watching for changes to the library."
     basedir = os.path.abspath(os.path.dirname(os.path.realpath(sys.argv[0])))
 
     auth_data = None
@@ -356,24 +760,39 @@ def run_server(backend, bind_address, port, bitrate, basic_auth_file=None):
             s_user, s_pass = split_user_pass(line.rstrip())
             auth_data[s_user] = s_pass
     zeya_handler = ZeyaHandler(backend,
-                               library_repr,
+                               library_loader,
                                os.path.join(basedir, 'resources'),
                                bitrate,
                                auth_type=NO_AUTH if basic_auth_file is None else BASIC_AUTH,
                                auth_data=auth_data,
+                               shape_buffered=shape_buffered,
+                               default_format=format,
+                               bitrate_ladder=bitrate_ladder,
+                               adaptive_bitrate=adaptive_bitrate,
                                )
+    if server_type == 'async':
+        # Import the server module conditionally, like the backends.
+        from asyncserver import AsyncHTTPServer, IPV6AsyncHTTPServer
+        server_classes = (IPV6AsyncHTTPServer, AsyncHTTPServer)
+        server_args = (backend, bitrate)
+    else:
+        server_classes = (IPV6ThreadedHTTPServer, ThreadedHTTPServer)
+        server_args = ()
     try:
-        server = IPV6ThreadedHTTPServer((bind_address, port), zeya_handler)
+        server = server_classes[0]((bind_address, port), zeya_handler,
+                                   *server_args)
     except socket.error:
         # One possible failure mode (among many others...) is that IPv6 is
         # disabled, which manifests as a socket.error. If this happens, attempt
         # to bind only on IPv4.
-        server = ThreadedHTTPServer((bind_address, port), zeya_handler)
+        server = server_classes[1]((bind_address, port), zeya_handler,
+                                   *server_args)
 
     if bind_address != '':
         print "Binding to address %s" % bind_address
 
     print "Listening on port %d" % (port,)
+    print "Send SIGHUP to process %d to reload the library." % (os.getpid(),)
     # Start up a web server.
     try:
         server.serve_forever()
@@ -384,7 +803,10 @@ def run_server(backend, bind_address, port, bitrate, basic_auth_file=None):
 
 if __name__ == '__main__':
     try:
-        (show_help, backend_type, bitrate, bind_address, port, path, basic_auth_file) = \
+        (show_help, backend_type, bitrate, bind_address, port, path,
+         basic_auth_file, cache_dir, cache_size, shape_buffered,
+         server_type, max_transcodes, max_queue_wait, watch, scan_workers,
+         format, bitrate_ladder, adaptive_bitrate) = \
             options.get_options(sys.argv[1:])
     except options.BadArgsError, e:
         print e
@@ -399,4 +821,7 @@ if __name__ == '__main__':
     except IOError, e:
         print e
         sys.exit(1)
-    run_server(backend, bind_address, port, bitrate, basic_auth_file)
+    run_server(backend, bind_address, port, bitrate, basic_auth_file,
+               cache_dir, cache_size, shape_buffered, server_type,
+               max_transcodes, max_queue_wait, watch, format, bitrate_ladder,
+               adaptive_bitrate)
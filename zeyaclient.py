@@ -35,6 +35,7 @@ import signal
 import subprocess
 import sys
 import time
+import urllib
 import urllib2
 
 try:
@@ -52,25 +53,37 @@ class BadArgsError(Exception):
     def __str__(self):
         return "Error: %s" % (self.error_message,)
 
-def song_matches(query, song):
+# Number of search results to fetch from the server at once.
+PAGE_SIZE = 500
+
+def get_json(url):
+    return json.loads(urllib2.urlopen(url).read())
+
+def find_songs(server_path, query):
     """
-    Return True if the query matches the given song.
+    Return the songs that match the query, best matches first.
 
     A query might look like "help, the beatles"
 
     A song is considered to match if each comma-separated component of the
     query appears somewhere in one of the song's metadata fields. Matching is
-    case-insensitive.
+    case-insensitive, and is done by the server (see search.py), so we never
+    have to download the whole library.
     """
-    parts = [part.strip() for part in query.lower().split(",")]
-    return all(part in song['album'].lower() or part in song['title'].lower() \
-                   or part in song['artist'].lower() for part in parts)
+    songs = []
+    while True:
+        results = get_json(
+            "%s/search?q=%s&offset=%d&limit=%d&fields=title,artist"
+            % (server_path, urllib.quote(query), len(songs), PAGE_SIZE))
+        songs.extend(results['library'])
+        if not results['library'] or len(songs) >= results['total']:
+            return songs
 
 # TODO: refactor the parts that directly interact with the server into a
 # separate module.
 def run(server_path):
     try:
-        library_file = urllib2.urlopen(server_path + "/getlibrary")
+        library_size = get_json(server_path + "/getlibrary?limit=0")['total']
     except ValueError, e:
         print "Error: %r is not a valid server name." % (server_path,)
         if not server_path.lower().startswith("http://"):
@@ -80,8 +93,7 @@ def run(server_path):
     except urllib2.URLError, e:
         print "Error: %s" % (e.reason,)
         sys.exit(1)
-    library_data = json.loads(library_file.read())['library']
-    print "Loaded %d songs from library." % (len(library_data),)
+    print "Connected to a library of %d songs." % (library_size,)
     print 'You can issue queries like: "Beatles" or "help, the beatles"'
     while True:
         # Prompt user for a query...
@@ -94,8 +106,11 @@ def run(server_path):
         if not query:
             break
         # ...then play all the songs we can find that match the query.
-        matching_songs = \
-            [song for song in library_data if song_matches(query, song)]
+        try:
+            matching_songs = find_songs(server_path, query)
+        except urllib2.URLError, e:
+            print "Error: %s" % (getattr(e, 'reason', e),)
+            continue
         for song in matching_songs:
             print "\r%s - %s" % (song['title'], song['artist'])
             song_url = "%s/getcontent?key=%d" % (server_path, song['key'])
@@ -22,15 +22,38 @@
 # Test suite for Zeya.
 
 import StringIO
+import errno
+import gzip
+import httplib
 import os
+import pickle
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 import backends
+import cache
+import common
 import decoders
+import directory
+import encoders
+import library
 import m3u
+import metadb
 import options
 import pls
 import rhythmbox
+import search
+import songtable
+import static
+import zeya
+from asyncserver import AsyncHTTPServer, HTTPChannel
 
 class FakeTagpy():
     """
@@ -56,6 +79,725 @@ class TagData():
         self.title = title
         self.album = album
 
+class FakeBackend(backends.LibraryBackend):
+    """
+    Backend whose songs are the given files. The key of each song is its
+    index in the list.
+    """
+    def __init__(self, filenames):
+        self.filenames = filenames
+    def get_library_contents(self):
+        return [{'key': key, 'title': os.path.basename(filename),
+                 'artist': '', 'album': ''}
+                for key, filename in enumerate(self.filenames)]
+    def get_playlists(self):
+        return []
+    def get_filename_from_key(self, key):
+        return self.filenames[int(key)]
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.source_dir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.source_dir)
+    def make_source(self, name, data):
+        filename = os.path.join(self.source_dir, name)
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        return filename
+    def fill(self, transcode_cache, key, data):
+        fill = transcode_cache.begin_fill(key)
+        fill.write(data)
+        fill.commit()
+    def test_fill_and_read(self):
+        """
+        Test that committed entries can be read back, and aborted entries
+        can't.
+        """
+        transcode_cache = cache.TranscodeCache(self.cache_dir, 1024)
+        filename = self.make_source("1.flac", "abc")
+        key = transcode_cache.get_key(filename, ["oggenc", "-b", "64"])
+        self.assertEqual(None, transcode_cache.open_entry(key))
+        fill = transcode_cache.begin_fill(key)
+        fill.write("encoded")
+        fill.abort()
+        self.assertEqual(None, transcode_cache.open_entry(key))
+        self.fill(transcode_cache, key, "encoded")
+        self.assertEqual("encoded", transcode_cache.open_entry(key).read())
+    def test_key(self):
+        """
+        Test that the cache key depends on the source file and encoder.
+        """
+        transcode_cache = cache.TranscodeCache(self.cache_dir, 1024)
+        filename = self.make_source("1.flac", "abc")
+        key1 = transcode_cache.get_key(filename, ["oggenc", "-b", "64"])
+        key2 = transcode_cache.get_key(filename, ["oggenc", "-b", "128"])
+        self.assertNotEqual(key1, key2)
+        self.make_source("1.flac", "abcd")
+        key3 = transcode_cache.get_key(filename, ["oggenc", "-b", "64"])
+        self.assertNotEqual(key1, key3)
+        key4 = transcode_cache.get_key(filename, ["lame", "-b", "64"], 'mp3')
+        self.assertTrue(key4.endswith('.mp3'))
+    def test_eviction(self):
+        """
+        Test that the least recently used entries are evicted first.
+        """
+        transcode_cache = cache.TranscodeCache(self.cache_dir, 10)
+        self.fill(transcode_cache, "a", "12345")
+        os.utime(transcode_cache.get_entry_path("a"), (1000, 1000))
+        self.fill(transcode_cache, "b", "12345")
+        os.utime(transcode_cache.get_entry_path("b"), (2000, 2000))
+        # Reading 'a' makes 'b' the least recently used entry.
+        transcode_cache.open_entry("a").close()
+        self.fill(transcode_cache, "c", "12345")
+        self.assertEqual(None, transcode_cache.open_entry("b"))
+        self.assertNotEqual(None, transcode_cache.open_entry("a"))
+        self.assertNotEqual(None, transcode_cache.open_entry("c"))
+
+class SharedTranscodeTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, "0123456789" * 10000)
+        os.close(fd)
+    def tearDown(self):
+        os.remove(self.filename)
+    def test_join_transcode(self):
+        """
+        Test that concurrent requests share one pipeline, and that each reader
+        receives all of the data.
+        """
+        decode_command = ["/bin/cat", self.filename]
+        encode_command = ["/bin/cat"]
+        t1 = backends.join_transcode(self.filename, decode_command,
+                                     encode_command)
+        t2 = backends.join_transcode(self.filename, decode_command,
+                                     encode_command)
+        self.assertTrue(t1.transcode is t2.transcode)
+        self.assertEqual("0123456789" * 10000, "".join(t1.chunks()))
+        self.assertEqual("0123456789" * 10000, "".join(t2.chunks()))
+        t1.release()
+        t2.release()
+        self.assertFalse(self.filename in
+                         [transcode_id[0] for transcode_id
+                          in backends.active_transcodes])
+    def test_skip_bytes(self):
+        """
+        Test that the requested amount of decoder output is discarded.
+        """
+        transcode = backends.join_transcode(
+            self.filename, ["/bin/cat", self.filename], ["/bin/cat"],
+            start=1, skip_bytes=25)
+        self.assertEqual(("0123456789" * 10000)[25:],
+                         "".join(transcode.chunks()))
+        transcode.release()
+    def test_read_without_blocking(self):
+        """
+        Test reading the output of a pipeline whose output is collected by
+        the caller.
+        """
+        started = []
+        reader = backends.join_transcode(
+            self.filename, ["/bin/true"], ["/bin/true"],
+            start_transcode=started.append)
+        transcode = started[0]
+        self.assertEqual('', reader.read())
+        self.assertFalse(reader.at_end())
+        transcode.add_output("abc")
+        self.assertEqual("abc", reader.read())
+        transcode.finish(True)
+        self.assertEqual('', reader.read())
+        self.assertTrue(reader.at_end())
+        reader.release()
+
+class TranscodeSlotsTest(unittest.TestCase):
+    def test_limit(self):
+        """
+        Test that no more than the maximum number of slots are handed out, and
+        that waiting requests time out.
+        """
+        slots = backends.TranscodeSlots(2, 0.1)
+        slot1 = slots.acquire('a')
+        slot2 = slots.acquire('b')
+        self.assertEqual(None, slots.try_acquire('c'))
+        try:
+            slots.acquire('c')
+            self.fail("acquire should have raised TranscodeBusyError")
+        except backends.TranscodeBusyError, e:
+            self.assertEqual(1, e.retry_after)
+        slot1.release()
+        slot1.release()
+        slot3 = slots.try_acquire('c')
+        self.assertNotEqual(None, slot3)
+        self.assertEqual(None, slots.try_acquire('c'))
+    def test_priority(self):
+        """
+        Test that playback goes ahead of prefetches, and that clients with
+        fewer running encoders go first.
+        """
+        slots = backends.TranscodeSlots(2, 10)
+        slots.acquire('a')
+        slot = slots.acquire('x')
+        granted = []
+        slots.wait('a', False, granted.append)
+        slots.wait('b', True, granted.append)
+        slots.wait('c', False, granted.append)
+        waiter = slots.wait('d', False, granted.append)
+        self.assertTrue(slots.cancel(waiter))
+        slot.release()
+        self.assertEqual(['c'], [s.client for s in granted])
+        granted[-1].release()
+        self.assertEqual(['c', 'a'], [s.client for s in granted])
+        granted[-1].release()
+        self.assertEqual(['c', 'a', 'b'], [s.client for s in granted])
+
+class PrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, "0123456789" * 1000)
+        os.close(fd)
+    def tearDown(self):
+        os.remove(self.filename)
+    def open_prefetch(self, acquire_slot):
+        return backends.join_transcode(
+            self.filename, ["/bin/cat", self.filename], ["/bin/cat"],
+            acquire_slot=acquire_slot)
+    def test_claim(self):
+        """
+        Test that a prefetched stream is handed to the request for it, and
+        that seeking within the current song doesn't cancel the prefetch.
+        """
+        prefetcher = backends.Prefetcher()
+        self.assertEqual(None, prefetcher.claim('a', 'song1'))
+        prefetcher.start('a', 'song2', self.open_prefetch)
+        self.assertEqual(None, prefetcher.claim('a', 'song1', False))
+        self.assertEqual(None, prefetcher.claim('b', 'song2'))
+        self.assertEqual('song2', prefetcher.get_stream_id('a'))
+        reader = prefetcher.claim('a', 'song2')
+        self.assertEqual("0123456789" * 1000, "".join(reader.chunks()))
+        reader.release()
+        self.assertEqual(None, prefetcher.get_stream_id('a'))
+        self.assertEqual(None, prefetcher.claim('a', 'song2'))
+    def test_cancel(self):
+        """
+        Test that prefetches wait for a free slot, and that skipping to
+        another song cancels them.
+        """
+        slots = backends.TranscodeSlots(1, 10)
+        slot = slots.acquire('x')
+        prefetcher = backends.Prefetcher()
+        prefetcher.start('a', 'song2', self.open_prefetch, slots)
+        self.assertEqual(None, prefetcher.claim('a', 'song2'))
+        prefetcher.start('a', 'song3', self.open_prefetch, slots)
+        self.assertEqual(None, prefetcher.claim('a', 'song4'))
+        slot.release()
+        # Nobody is waiting for the slot any more.
+        self.assertNotEqual(None, slots.try_acquire('x'))
+    def test_expire(self):
+        """
+        Test that a prefetch that isn't claimed is dropped after its lifetime,
+        even if no more requests arrive, and that its stream is released.
+        """
+        prefetcher = backends.Prefetcher(lifetime=0.1)
+        prefetcher.start('a', 'song2', self.open_prefetch)
+        transcode = prefetcher._prefetches['a'].reader.transcode
+        self.assertEqual(1, transcode.readers)
+        deadline = time.time() + 5
+        while prefetcher._prefetches and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual({}, prefetcher._prefetches)
+        self.assertEqual(0, transcode.readers)
+        self.assertEqual(None, prefetcher.claim('a', 'song2'))
+        # Expired prefetches are also dropped when they're looked up.
+        prefetcher = backends.Prefetcher(lifetime=0)
+        prefetcher.start('a', 'song2', self.open_prefetch)
+        self.assertEqual(None, prefetcher.get_stream_id('a'))
+
+class StaticTest(unittest.TestCase):
+    def test_choose_encoding(self):
+        self.assertEqual(None, static.choose_encoding(None, ['gzip']))
+        self.assertEqual('gzip', static.choose_encoding(
+                "deflate, gzip;q=0.5", ['gzip', 'deflate']))
+        self.assertEqual('deflate', static.choose_encoding(
+                "gzip;q=0, deflate", ['gzip', 'deflate']))
+        self.assertEqual(None, static.choose_encoding("identity", ['gzip']))
+    def test_resource(self):
+        """
+        Test that resources are compressed, and have distinct ETags for each
+        encoding.
+        """
+        data = "var x = 1;\n" * 100
+        resource = static.Resource(data, 'text/javascript', 1000)
+        self.assertEqual(['gzip', 'deflate'], resource.encodings)
+        self.assertEqual(data, zlib.decompress(resource.get_data('deflate')))
+        self.assertNotEqual(resource.get_etag(None),
+                            resource.get_etag('gzip'))
+        etag = resource.get_etag('gzip')
+        self.assertTrue(resource.matches(etag, None, 'gzip'))
+        self.assertFalse(resource.matches(etag, None, None))
+        self.assertTrue(resource.matches(
+                None, "Thu, 01 Jan 1970 00:16:40 GMT", 'gzip'))
+        self.assertFalse(resource.matches(
+                None, "Thu, 01 Jan 1970 00:16:39 GMT", 'gzip'))
+        self.assertEqual([], static.Resource("x", 'image/png', 1000,
+                                             compress=False).encodings)
+    def test_streamed_resource(self):
+        """
+        Test that a streamed resource can be decoded from each of its forms,
+        and has the same lengths and ETags as an equivalent Resource.
+        """
+        chunks = ['{"library": [', '{"key": 1}, ' * 100, '{"key": 2}]}']
+        data = ''.join(chunks)
+        resource = static.StreamedResource(lambda: iter(chunks), 'text/html')
+        expected = static.Resource(data, 'text/html')
+        self.assertEqual(['gzip', 'deflate'], resource.encodings)
+        self.assertEqual(data, ''.join(resource.get_chunks(None)))
+        self.assertEqual(data, ''.join(resource.get_chunks(None)))
+        gzipped = gzip.GzipFile(fileobj=StringIO.StringIO(
+                resource.get_data('gzip')))
+        self.assertEqual(data, gzipped.read())
+        self.assertEqual(data, zlib.decompress(resource.get_data('deflate')))
+        for encoding in [None, 'gzip', 'deflate']:
+            self.assertEqual(len(resource.get_data(encoding)),
+                             resource.get_length(encoding))
+            self.assertEqual(expected.get_etag(encoding),
+                             resource.get_etag(encoding))
+        self.assertEqual([], static.StreamedResource(lambda: ['{}'],
+                                                     'text/html').encodings)
+    def test_reload(self):
+        """
+        Test that files are only read again when they've been modified.
+        """
+        basedir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(basedir, "a.css")
+            f = open(filename, 'w')
+            f.write("a {}")
+            f.close()
+            os.utime(filename, (1000, 1000))
+            resources = static.ResourceDirectory(basedir)
+            resource = resources.get("a.css", 'text/css')
+            self.assertTrue(resource is resources.get("a.css", 'text/css'))
+            f = open(filename, 'w')
+            f.write("b {}")
+            f.close()
+            os.utime(filename, (2000, 2000))
+            self.assertEqual("b {}",
+                             resources.get("a.css", 'text/css').get_data())
+            self.assertRaises(IOError, resources.get, "b.css", 'text/css')
+        finally:
+            shutil.rmtree(basedir)
+
+class LibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.library = library.Library(
+            [{'key': i, 'title': 't%d' % (i,), 'artist': 'a', 'album': 'b'}
+             for i in range(5)],
+            [{'name': 'p', 'items': [3, 1, 4]}])
+    def test_get_songs(self):
+        page = self.library.get_songs(1, 2, ['title'])
+        self.assertEqual(5, page['total'])
+        self.assertEqual([{'key': 1, 'title': 't1'}, {'key': 2, 'title': 't2'}],
+                         page['library'])
+        self.assertEqual([4], [song['key'] for song
+                               in self.library.get_songs(4)['library']])
+        self.assertRaises(ValueError, self.library.get_songs, 0, None, ['x'])
+        self.assertRaises(ValueError, self.library.get_songs, -1)
+        self.assertRaises(ValueError, self.library.get_songs, 0,
+                          library.MAX_PAGE_SIZE + 1)
+    def test_get_playlist(self):
+        self.assertEqual({'playlists': [{'id': 0, 'name': 'p', 'size': 3}]},
+                         self.library.get_playlist_summaries())
+        playlist = self.library.get_playlist(0, 1, 5)
+        self.assertEqual(3, playlist['total'])
+        self.assertEqual([1, 4], playlist['items'])
+        self.assertRaises(KeyError, self.library.get_playlist, 1)
+        self.assertEqual({'playlists': None},
+                         library.Library([], None).get_playlist_summaries())
+    def test_search(self):
+        results = self.library.search("T3", fields=['artist'])
+        self.assertEqual({'total': 1, 'offset': 0, 'keys': [3],
+                          'library': [{'key': 3, 'artist': 'a'}]}, results)
+        self.assertEqual([2, 3], self.library.search("t", 2, 2)['keys'])
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        songs = [("Help!", "The Beatles", "Help!"),
+                 ("Yesterday", "The Beatles", "Help!"),
+                 ("Helpless", "Neil Young", "Decade"),
+                 ("I Need Help", "Someone", "Beatles Covers")]
+        self.index = search.SearchIndex(
+            [{'key': key, 'title': title, 'artist': artist, 'album': album}
+             for key, (title, artist, album) in enumerate(songs)])
+    def test_matches(self):
+        """
+        Test that every comma-separated part of a query has to match, in any
+        field, ignoring case.
+        """
+        self.assertEqual([1], self.index.search("yesterday, BEATLES"))
+        self.assertEqual([0, 1], sorted(self.index.search("help, the beatles")))
+        self.assertEqual([], self.index.search("help, young, beatles"))
+        self.assertEqual([], self.index.search("zzz"))
+    def test_short_parts(self):
+        self.assertEqual([0, 1, 2, 3], sorted(self.index.search("e")))
+        self.assertEqual([2], self.index.search("ng, he"))
+        self.assertEqual(4, len(self.index.search(" , ")))
+    def test_colons(self):
+        """
+        Test that a part of a query containing a colon is matched literally.
+        """
+        self.assertEqual([], self.index.search("artist:beatles"))
+    def test_ranking(self):
+        """
+        Test that exact matches come before prefix matches, which come before
+        matches at the start of a word, which come before other matches.
+        """
+        self.assertEqual([2], self.index.search("neil young"))
+        self.assertEqual([3, 0, 1], self.index.search("beatles"))
+        self.assertEqual([0, 1, 2, 3], self.index.search("help"))
+    def test_shared_values(self):
+        """
+        Test that each distinct value is folded once, and that values which
+        are already folded aren't copied.
+        """
+        table = songtable.SongTable(
+            [(0, u'help', u'The Beatles', u'Help!', '/a.ogg'),
+             (1, u'Yesterday', u'The Beatles', u'Help!', '/b.ogg')])
+        index = search.SearchIndex(table)
+        self.assertEqual([1], index.search("yesterday, beatles"))
+        artists = index._values['artist']
+        self.assertEqual(u'the beatles', artists[0])
+        self.assertTrue(artists[0] is artists[1])
+        self.assertTrue(index._values['title'][0] is table.titles[0])
+
+class SongTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = songtable.SongTable(
+            [(30, u'Help!', u'The Beatles', u'Help!', '/b/help.ogg'),
+             (10, 'Yesterday', 'The Beatles', 'Help!', '/b/yesterday.ogg'),
+             (20, u'\u4e2d\u6587', u'', u'', '/a/\xe4\xb8\xad.ogg')])
+    def test_songs(self):
+        """
+        Test that the table can be used as a list of song dicts.
+        """
+        self.assertEqual(3, len(self.table))
+        self.assertEqual({'key': 10, 'title': u'Yesterday',
+                          'artist': u'The Beatles', 'album': u'Help!'},
+                         self.table[1])
+        self.assertEqual([30, 10, 20],
+                         [song['key'] for song in self.table])
+        self.assertEqual([20], [song['key'] for song in self.table[-1:]])
+        self.assertRaises(IndexError, lambda: self.table[3])
+        # Artists and albums are shared between songs.
+        self.assertTrue(self.table.artists[0] is self.table.artists[1])
+        self.assertTrue(self.table.albums[0] is self.table.albums[1])
+    def test_lookup(self):
+        self.assertEqual('/b/yesterday.ogg', self.table.get_filename(10))
+        self.assertEqual(2, self.table.find_key(20))
+        self.assertRaises(KeyError, self.table.get_filename, 15)
+        self.assertEqual(0, self.table.find_filename('/b/help.ogg'))
+        self.assertRaises(KeyError, self.table.find_filename, '/b')
+    def test_filter_and_sort(self):
+        sorted_table = self.table.sort_by_filename(lambda filename: filename)
+        self.assertEqual([20, 30, 10], list(sorted_table.keys))
+        self.assertEqual('/b/help.ogg', sorted_table.get_filename(30))
+        filtered = self.table.filter_filenames(
+            lambda filename: filename.startswith('/b/'))
+        self.assertEqual(list(self.table)[:2], filtered)
+    def test_iter_json(self):
+        """
+        Test that the table is encoded the same way as a list of dicts.
+        """
+        chunk_size = songtable.JSON_CHUNK_SIZE
+        songtable.JSON_CHUNK_SIZE = 2
+        try:
+            data = ''.join(self.table.iter_json())
+        finally:
+            songtable.JSON_CHUNK_SIZE = chunk_size
+        self.assertEqual(list(self.table), library.json.loads(data))
+        self.assertEqual('[]', ''.join(songtable.SongTable().iter_json()))
+
+class AssignKeyTest(unittest.TestCase):
+    def test_assign_key(self):
+        key = backends.assign_key('/music/a.ogg', {})
+        self.assertEqual(key, backends.assign_key('/music/a.ogg', set([1])))
+        self.assertTrue(0 <= key < backends.KEY_LIMIT)
+        self.assertEqual(key, backends.assign_key(u'/music/a.ogg', {}))
+        # Collisions are resolved by using the next free key.
+        self.assertEqual(key + 1, backends.assign_key('/music/a.ogg',
+                                                      set([key])))
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst(self):
+        """
+        Test that a full bucket's worth of data can be written right away,
+        and that more data has to wait.
+        """
+        # 1 MB/sec.
+        limiter = backends.RateLimiter(4096, burst=50000)
+        start_time = time.time()
+        limiter.wait(50000)
+        limiter.record(50000)
+        self.assertTrue(time.time() - start_time < 0.04)
+        limiter.wait(100000)
+        self.assertTrue(time.time() - start_time >= 0.04)
+    def test_unlimited(self):
+        limiter = backends.RateLimiter(None)
+        start_time = time.time()
+        for i in range(100):
+            limiter.wait(1000000)
+            limiter.record(1000000)
+        self.assertTrue(time.time() - start_time < 0.04)
+
+class BitrateAdapterTest(unittest.TestCase):
+    def make_meter(self, num_bytes, seconds):
+        meter = backends.ThroughputMeter()
+        meter.num_bytes = num_bytes
+        meter.seconds = seconds
+        return meter
+    def test_meter(self):
+        """
+        Test that the data that fits in the buffer isn't counted.
+        """
+        meter = backends.ThroughputMeter(buffer_size=1024)
+        meter.finish(1024)
+        meter.start()
+        time.sleep(0.05)
+        meter.finish(1024)
+        # 1 KB in 0.05 seconds.
+        self.assertTrue(100 < meter.get_throughput() <= 160)
+        meter = backends.ThroughputMeter(buffer_size=1024)
+        meter.start()
+        time.sleep(0.05)
+        meter.finish(1024)
+        self.assertEqual(None, meter.get_throughput())
+    def test_slow_client(self):
+        """
+        Test that a client that can't keep up is sent lower bitrates, but no
+        higher than the one it asked for.
+        """
+        adapter = backends.BitrateAdapter((32, 64, 128, 256))
+        self.assertEqual(128, adapter.choose('a', 'ogg', 128))
+        # 100 kbits/sec.
+        adapter.record('a', self.make_meter(1280000, 100))
+        self.assertEqual(64, adapter.choose('a', 'ogg', 128))
+        self.assertEqual(48, adapter.choose('a', 'ogg', 48))
+        # Opus needs half the bandwidth for the same quality.
+        self.assertEqual(128, adapter.choose('a', 'opus', 128))
+        self.assertEqual(128, adapter.choose('b', 'ogg', 128))
+        # Clients that can't keep up with the lowest bitrate get that one.
+        adapter.record('a', self.make_meter(960000, 500))
+        self.assertEqual(32, adapter.choose('a', 'ogg', 128))
+    def test_fast_client(self):
+        """
+        Test that a client gets the bitrate it asked for once it keeps up, and
+        that short measurements are ignored.
+        """
+        adapter = backends.BitrateAdapter((32, 64, 128, 256))
+        adapter.record('a', self.make_meter(1280000, 100))
+        adapter.record('a', self.make_meter(1000, 10))
+        self.assertEqual(64, adapter.choose('a', 'ogg', 128))
+        adapter.record('a', self.make_meter(1280000, 0))
+        self.assertEqual(256, adapter.choose('a', 'ogg', 256))
+
+class DirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        # Don't depend on tagpy being able to read the (empty) test files.
+        self.extract_metadata = directory.extract_metadata
+        directory.extract_metadata = lambda filename: \
+            backends.extract_metadata(
+            filename, FakeTagpy(TagData('Artist', 'Title', 'Album')))
+    def tearDown(self):
+        directory.extract_metadata = self.extract_metadata
+        shutil.rmtree(self.tempdir)
+    def test_sort_key(self):
+        """
+        Verify that files sort in the order in which the directory is scanned.
+        """
+        backend = directory.DirectoryBackend(self.tempdir, save_db=False)
+        filenames = [os.path.join(self.tempdir, filename) for filename
+                     in ['b/1.ogg', 'b/a/1.ogg', 'b/a/10.ogg', 'b/a/9.ogg',
+                         'B/a.ogg', 'a.ogg', 'c.ogg']]
+        filenames.sort(key=backend.get_sort_key)
+        self.assertEqual(['a.ogg', 'c.ogg', 'B/a.ogg', 'b/1.ogg', 'b/a/1.ogg',
+                          'b/a/9.ogg', 'b/a/10.ogg'],
+                         [filename[len(self.tempdir) + 1:]
+                          for filename in filenames])
+    def test_file_table(self):
+        """
+        Verify that the stats of each song's file stay with it.
+        """
+        table = directory.FileTable()
+        table.append(1, u'T', u'A', u'B', '/b.ogg', 10.5, 100)
+        table.append(2, u'T', u'A', u'B', '/a.ogg', 20.0, None)
+        table = table.sort_by_filename(lambda filename: filename)
+        self.assertEqual([(2, u'T', u'A', u'B', '/a.ogg', 20.0, None),
+                          (1, u'T', u'A', u'B', '/b.ogg', 10.5, 100)],
+                         list(table.stat_rows()))
+        self.assertEqual((10.5, 100, u'T', u'A', u'B'),
+                         table.get_metadb_row(1))
+        other = table.filter_filenames(lambda filename: True)
+        self.assertEqual(table, other)
+        other.mtimes[0] = 0
+        self.assertNotEqual(table, other)
+    def test_parallel_scan(self):
+        """
+        Verify that a parallel scan gives the same results as a serial one.
+        """
+        for dirname in ['a', 'b']:
+            os.mkdir(os.path.join(self.tempdir, dirname))
+            for i in range(10):
+                open(os.path.join(self.tempdir, dirname, '%d.ogg' % (i,)),
+                     'w').close()
+        open(os.path.join(self.tempdir, 'p.m3u'), 'w').write('b/3.ogg\n')
+        serial = directory.DirectoryBackend(self.tempdir, save_db=False)
+        parallel = directory.DirectoryBackend(self.tempdir, save_db=False,
+                                              scan_workers=2)
+        self.assertEqual(serial.get_library_contents(),
+                         parallel.get_library_contents())
+        self.assertEqual(serial.get_playlists(), parallel.get_playlists())
+        self.assertEqual(serial.db, parallel.db)
+    def test_update_files(self):
+        """
+        Verify that updating the library after some files have changed gives
+        the same result as scanning the directory again.
+        """
+        for dirname in ['a', 'b']:
+            os.mkdir(os.path.join(self.tempdir, dirname))
+        for name in ['a/1.ogg', 'a/2.ogg', 'b/1.ogg', 'b/10.ogg', 'c.ogg']:
+            open(os.path.join(self.tempdir, name), 'w').close()
+        # The playlist refers to songs that are scanned later.
+        open(os.path.join(self.tempdir, 'p.m3u'), 'w').write(
+            'b/10.ogg\na/2.ogg\n')
+        backend = directory.DirectoryBackend(self.tempdir, save_db=False)
+        for dirname in ['B', 'd']:
+            os.mkdir(os.path.join(self.tempdir, dirname))
+        changed = [os.path.join(self.tempdir, name)
+                   for name in ['a/3.ogg', 'B/1.ogg', 'd/1.ogg', 'b/10.ogg']]
+        for filename in changed[:3]:
+            open(filename, 'w').close()
+        os.remove(changed[3])
+        self.assertTrue(backend.update_files(changed))
+        scanned = directory.DirectoryBackend(self.tempdir, save_db=False)
+        self.assertEqual(scanned.db, backend.db)
+        self.assertEqual(scanned.get_playlists(), backend.get_playlists())
+    def test_stable_keys(self):
+        """
+        Verify that songs get the same keys when the directory is scanned
+        again, even if other songs have been added.
+        """
+        for name in ['b.ogg', 'c.ogg']:
+            open(os.path.join(self.tempdir, name), 'w').close()
+        backend = directory.DirectoryBackend(self.tempdir, save_db=False)
+        keys = dict(zip(backend.db.filenames, backend.db.keys))
+        open(os.path.join(self.tempdir, 'a.ogg'), 'w').close()
+        backend = directory.DirectoryBackend(self.tempdir, save_db=False)
+        self.assertEqual(3, len(backend.db))
+        for filename, key in keys.iteritems():
+            self.assertEqual(filename, backend.get_filename_from_key(key))
+    def test_migrate_pickled_db(self):
+        """
+        Verify that a pickled database is converted, and its metadata used.
+        """
+        filename = os.path.join(self.tempdir, 'a.ogg')
+        open(filename, 'w').close()
+        db_filename = os.path.join(self.tempdir, 'zeya.db')
+        pickle.dump({directory.DB: [{'key': 0, 'title': u'T', 'artist': u'A',
+                                     'album': u'B'}],
+                     directory.MTIMES: {filename: time.time() + 10},
+                     directory.KEY_FILENAME: {0: filename}},
+                    open(db_filename, 'wb'))
+        backend = directory.DirectoryBackend(self.tempdir)
+        self.assertEqual([(backend.db.keys[0], u'T', u'A', u'B', filename)],
+                         list(backend.db.rows()))
+        self.assertTrue(metadb.is_sqlite_file(db_filename))
+        rows = metadb.MetadataStore(db_filename).load()
+        self.assertEqual([filename], rows.keys())
+        self.assertEqual((0, u'T', u'A', u'B'), rows[filename][1:])
+    def test_save_changed_rows(self):
+        """
+        Verify that only new and modified songs are written to the database.
+        """
+        class RecordingStore(metadb.MetadataStore):
+            def update(self, rows, removed, *args):
+                updates.append((sorted(rows.keys()), removed))
+                metadb.MetadataStore.update(self, rows, removed, *args)
+        updates = []
+        backend = directory.DirectoryBackend(self.tempdir)
+        backend._store = RecordingStore(backend.get_db_filename())
+        filenames = [os.path.join(self.tempdir, name)
+                     for name in ['a.ogg', 'b.ogg', 'c.ogg']]
+        for filename in filenames:
+            open(filename, 'w').close()
+        backend.reload()
+        self.assertEqual([(filenames, [])], updates)
+        backend.reload()
+        self.assertEqual(1, len(updates))
+        open(filenames[1], 'w').write('x')
+        os.remove(filenames[2])
+        backend.reload()
+        self.assertEqual((filenames[1:2], filenames[2:]), updates[1])
+        self.assertEqual(filenames[:2],
+                         sorted(metadb.MetadataStore(
+                    backend.get_db_filename()).load().keys()))
+    def test_skip_unchanged_directories(self):
+        """
+        Verify that on startup, the files in directories that haven't changed
+        aren't listed or statted again, but the others are.
+        """
+        for dirname in ['a', 'b']:
+            os.mkdir(os.path.join(self.tempdir, dirname))
+            open(os.path.join(self.tempdir, dirname, '1.ogg'), 'w').close()
+        # Make the directories old enough that their listings are saved.
+        past = time.time() - 60
+        for dirname in ['a', 'b', '']:
+            os.utime(os.path.join(self.tempdir, dirname), (past, past))
+        backend = directory.DirectoryBackend(self.tempdir)
+        # (The top directory changed when the database was created in it.)
+        self.assertEqual([os.path.join(self.tempdir, dirname)
+                          for dirname in ['a', 'b']],
+                         sorted(backend.directories.keys()))
+        listing = backend.directories[os.path.join(self.tempdir, 'a')]
+        self.assertEqual((('1.ogg',), ()), listing[1:])
+        self.assertEqual(backend.directories,
+                         metadb.MetadataStore(
+                backend.get_db_filename()).load_directories())
+        open(os.path.join(self.tempdir, 'b', '2.ogg'), 'w').close()
+        listed = []
+        list_directory = directory.list_directory
+        directory.list_directory = lambda path: \
+            listed.append(path) or list_directory(path)
+        try:
+            backend = directory.DirectoryBackend(self.tempdir)
+        finally:
+            directory.list_directory = list_directory
+        self.assertEqual([self.tempdir, os.path.join(self.tempdir, 'b')],
+                         listed)
+        self.assertEqual(['a/1.ogg', 'b/1.ogg', 'b/2.ogg'],
+                         sorted([filename[len(self.tempdir) + 1:] for filename
+                                 in backend.db.filenames]))
+    def test_watch(self):
+        """
+        Verify that the watcher reports changes to files in new directories.
+        """
+        try:
+            watcher = directory.DirectoryWatcher(self.tempdir, None)
+        except OSError:
+            # inotify isn't available.
+            return
+        subdir = os.path.join(self.tempdir, 'a')
+        os.mkdir(subdir)
+        changed = set()
+        watcher.handle_events(watcher._watches.read_events(), changed)
+        self.assertEqual(set([subdir]), changed)
+        open(os.path.join(subdir, 'x.ogg'), 'w').close()
+        changed = set()
+        watcher.handle_events(watcher._watches.read_events(), changed)
+        self.assertEqual(set([os.path.join(subdir, 'x.ogg')]), changed)
+
 class CommonTest(unittest.TestCase):
     def test_tokenization(self):
         """
@@ -67,6 +809,23 @@ class CommonTest(unittest.TestCase):
         t1 = rhythmbox.tokenize_filename(filename1)
         t2 = rhythmbox.tokenize_filename(filename2)
         self.assertTrue(t1 < t2)
+    def test_parse_byte_range(self):
+        """
+        Test parsing of HTTP Range headers.
+        """
+        self.assertEqual((0, 499), common.parse_byte_range("bytes=0-499", 1000))
+        self.assertEqual((500, 999), common.parse_byte_range("bytes=500-", 1000))
+        self.assertEqual((900, 999), common.parse_byte_range("bytes=-100", 1000))
+        self.assertEqual((0, 999), common.parse_byte_range("bytes=-2000", 1000))
+        self.assertEqual((990, 999),
+                         common.parse_byte_range("bytes=990-2000", 1000))
+        self.assertEqual(None, common.parse_byte_range("bytes=1000-", 1000))
+        self.assertRaises(ValueError, common.parse_byte_range,
+                          "bytes=0-1,5-6", 1000)
+        self.assertRaises(ValueError, common.parse_byte_range,
+                          "bytes=5-1", 1000)
+        self.assertRaises(ValueError, common.parse_byte_range,
+                          "lines=0-1", 1000)
 
 class DecodersTest(unittest.TestCase):
     def test_extensions(self):
@@ -86,6 +845,90 @@ class DecodersTest(unittest.TestCase):
         """
         self.assertTrue(decoders.get_decoder("/path/to/SOMETHING.MP3")[0]
                         .startswith("/usr/bin"))
+    def test_get_decoder_with_start(self):
+        """
+        Test decoders.get_decoder for decoders that can seek.
+        """
+        self.assertTrue(decoders.decoder_can_seek("/path/to/a.flac"))
+        command = decoders.get_decoder("/path/to/a.flac", 75.5)
+        self.assertEqual("--skip=1:15.500", command[-2])
+        self.assertEqual("/path/to/a.flac", command[-1])
+        self.assertFalse(decoders.decoder_can_seek("/path/to/a.mp3"))
+        self.assertEqual(decoders.get_decoder("/path/to/a.mp3"),
+                         decoders.get_decoder("/path/to/a.mp3", 10))
+    def test_pcm_offset(self):
+        self.assertEqual(44100 * 4, decoders.get_pcm_offset(1))
+        self.assertEqual(0, decoders.get_pcm_offset(0.5) % 4)
+
+class EncodersTest(unittest.TestCase):
+    def test_get_encoder(self):
+        """
+        Test that the bitrate is passed to the encoder.
+        """
+        command = encoders.get_encoder('mp3', 128)
+        self.assertEqual("/usr/bin/lame", command[0])
+        self.assertEqual("128", command[command.index("-b") + 1])
+    def test_get_bitrate(self):
+        """
+        Test that bitrates are scaled for each format and clamped to its
+        ladder.
+        """
+        self.assertEqual(100, encoders.get_bitrate('ogg', 100))
+        self.assertEqual(48, encoders.get_bitrate('opus', 100))
+        self.assertEqual(160, encoders.get_bitrate('mp3', 128))
+        self.assertEqual(16, encoders.get_bitrate('opus', 8))
+    def test_clamp_bitrate(self):
+        ladder = (32, 64, 128)
+        self.assertEqual(64, encoders.clamp_bitrate(100, ladder))
+        self.assertEqual(128, encoders.clamp_bitrate(128, ladder))
+        self.assertEqual(128, encoders.clamp_bitrate(500, ladder))
+        self.assertEqual(32, encoders.clamp_bitrate(8, ladder))
+    def test_choose_format(self):
+        available = ['ogg', 'opus', 'mp3']
+        self.assertEqual('ogg', encoders.choose_format(None, available))
+        self.assertEqual('ogg', encoders.choose_format("*/*", available))
+        self.assertEqual('mp3', encoders.choose_format(
+                "audio/mpeg, audio/ogg;q=0.5", available))
+        self.assertEqual('opus', encoders.choose_format(
+                "audio/*", ['opus', 'mp3']))
+        self.assertEqual('mp3', encoders.choose_format(
+                "audio/*;q=0.5, audio/ogg;q=0", available))
+        self.assertEqual(None, encoders.choose_format("text/html",
+                                                      available))
+
+class VorbisHeaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def make_file(self, name, nominal_bitrate, magic='\x01vorbis'):
+        """
+        Write the first Ogg page of a Vorbis file with the specified nominal
+        bitrate, and return its filename.
+        """
+        id_header = magic + struct.pack('<IBIiii', 0, 2, 44100, 0,
+                                        nominal_bitrate, 0) + '\xb8\x01'
+        page = 'OggS' + '\x00\x02' + '\x00' * 20 + '\x01' \
+            + chr(len(id_header)) + id_header
+        filename = os.path.join(self.tmpdir, name)
+        f = open(filename, 'wb')
+        f.write(page)
+        f.close()
+        return filename
+    def test_nominal_bitrate(self):
+        filename = self.make_file("1.ogg", 96000)
+        self.assertEqual(96000, decoders.get_vorbis_nominal_bitrate(filename))
+        self.assertEqual(None, decoders.get_vorbis_nominal_bitrate(
+                self.make_file("2.ogg", 96000, magic='OpusHead')))
+        self.assertEqual(None, decoders.get_vorbis_nominal_bitrate(
+                self.make_file("3.ogg", 0)))
+    def test_can_pass_through(self):
+        filename = self.make_file("1.ogg", 96000)
+        self.assertTrue(decoders.can_pass_through(filename, 128))
+        self.assertTrue(decoders.can_pass_through(filename, 96))
+        self.assertFalse(decoders.can_pass_through(filename, 64))
+        self.assertFalse(decoders.can_pass_through(
+                self.make_file("1.flac", 96000), 128))
 
 class M3uTest(unittest.TestCase):
     def test_parse_m3u(self):
@@ -105,6 +948,42 @@ class M3uTest(unittest.TestCase):
                                    StringIO.StringIO(playlist_data))
         self.assertEqual(['/home/phil/music/1 One.flac', '/home/phil/music/2 Two.flac'],
                          playlist.get_filenames())
+    def test_repeated_entries(self):
+        """
+        Test that a song listed more than once in the playlist appears in the
+        library once for each time it's listed, under different keys.
+        """
+        playlist_dir = tempfile.mkdtemp()
+        extract_metadata = m3u.extract_metadata
+        m3u.extract_metadata = lambda filename: \
+            backends.extract_metadata(
+            filename, FakeTagpy(TagData('Artist', 'Title', 'Album')))
+        try:
+            playlist_path = os.path.join(playlist_dir, 'foo.m3u')
+            playlist_file = open(playlist_path, 'w')
+            playlist_file.write("1 One.flac\n2 Two.flac\n1 One.flac\n")
+            playlist_file.close()
+            backend = m3u.M3uBackend(playlist_path)
+            keys = [song['key'] for song in backend.get_library_contents()]
+            self.assertEqual(3, len(set(keys)))
+            self.assertEqual(['1 One.flac', '2 Two.flac', '1 One.flac'],
+                             [os.path.basename(
+                                 backend.get_filename_from_key(key))
+                              for key in keys])
+        finally:
+            m3u.extract_metadata = extract_metadata
+            shutil.rmtree(playlist_dir)
+    def test_unreadable_playlist(self):
+        """
+        Test that a playlist that can't be read raises IOError, rather than
+        exiting (which would kill the thread reloading the library).
+        """
+        playlist_dir = tempfile.mkdtemp()
+        try:
+            backend = m3u.M3uBackend(playlist_dir)
+            self.assertRaises(IOError, backend.get_library_contents)
+        finally:
+            shutil.rmtree(playlist_dir)
 
 class MetadataExtractionTest(unittest.TestCase):
     def test_with_metadata(self):
@@ -176,12 +1055,72 @@ class OptionsTest(unittest.TestCase):
     def test_port(self):
         params = options.get_options(["-p9999"])
         self.assertEqual(9999, params[4])
+    def test_cache(self):
+        params = options.get_options(["--cache_dir=/tmp/zeya",
+                                      "--cache_size=10"])
+        self.assertEqual('/tmp/zeya', params[7])
+        self.assertEqual(10 * 1024 * 1024, params[8])
+    def test_buffered_shaping(self):
+        self.assertTrue(options.get_options([])[9])
+        self.assertFalse(options.get_options(["--no_buffered_shaping"])[9])
+    def test_watch(self):
+        self.assertFalse(options.get_options([])[13])
+        self.assertTrue(options.get_options(["--watch"])[13])
+    def test_scan_workers(self):
+        self.assertEqual(1, options.get_options([])[14])
+        self.assertEqual(4, options.get_options(["--scan_workers=4"])[14])
+        self.assertRaises(options.BadArgsError, options.get_options,
+                          ["--scan_workers=0"])
+    def test_server(self):
+        self.assertEqual('threaded', options.get_options([])[10])
+        params = options.get_options(["--server=async"])
+        self.assertEqual('async', params[10])
+    def test_bad_server(self):
+        try:
+            params = options.get_options(["--server=forking"])
+            self.fail("get_options should have raised BadArgsError")
+        except options.BadArgsError:
+            pass
+    def test_max_transcodes(self):
+        # Encoders aren't limited unless that's requested.
+        self.assertEqual(0, options.get_options([])[11])
+        params = options.get_options(["--max_transcodes=2",
+                                      "--max_queue_wait=5"])
+        self.assertEqual(2, params[11])
+        self.assertEqual(5, params[12])
+    def test_bad_max_transcodes(self):
+        try:
+            params = options.get_options(["--max_transcodes=-1"])
+            self.fail("get_options should have raised BadArgsError")
+        except options.BadArgsError:
+            pass
+    def test_bad_cache_size(self):
+        try:
+            params = options.get_options(["--cache_size=-1"])
+            self.fail("get_options should have raised BadArgsError")
+        except options.BadArgsError:
+            pass
     def test_bad_port(self):
         try:
             params = options.get_options(["--port=p"])
             self.fail("get_options should have raised BadArgsError")
         except options.BadArgsError:
             pass
+    def test_format(self):
+        self.assertEqual('ogg', options.get_options([])[15])
+        self.assertEqual('opus', options.get_options(["--format=opus"])[15])
+        self.assertRaises(options.BadArgsError, options.get_options,
+                          ["--format=wav"])
+    def test_bitrates(self):
+        self.assertEqual(encoders.DEFAULT_BITRATE_LADDER,
+                         options.get_options([])[16])
+        self.assertEqual((48, 96, 128),
+                         options.get_options(["--bitrates=128,48,96"])[16])
+        self.assertFalse(options.get_options([])[17])
+        self.assertTrue(options.get_options(["--adaptive_bitrate"])[17])
+        for value in ["", "64,x", "0,64"]:
+            self.assertRaises(options.BadArgsError, options.get_options,
+                              ["--bitrates=" + value])
 
 class PlsTest(unittest.TestCase):
     def test_parse_pls(self):
@@ -233,6 +1172,421 @@ class RhythmboxTest(unittest.TestCase):
         key2 = library[1]['key']
         self.assertEqual(u'/tmp/\u4e2d\u6587.flac'.encode('UTF-8'),
                          backend.get_filename_from_key(key2))
+    def test_keys_stable(self):
+        """
+        Verify that songs keep their keys when the library is read again.
+        """
+        backend = rhythmbox.RhythmboxBackend(open("testdata/rhythmbox.xml"))
+        library = backend.get_library_contents()
+        data = open("testdata/rhythmbox.xml").read()
+        # Remove the first song and add a new one.
+        start = data.index('<entry')
+        end = data.index('</entry>') + len('</entry>')
+        entry = data[start:end].replace('Help', 'Yesterday')
+        contents = backend.read_library(
+            StringIO.StringIO(data[:start] + data[end:].replace(
+                    '</rhythmdb>', entry + '</rhythmdb>')))
+        # (Songs are sorted by filename.)
+        self.assertEqual(library[1], contents[1])
+        self.assertEqual(u'Yesterday!', contents[0]['title'])
+        self.assertFalse(contents[0]['key'] in
+                         [song['key'] for song in library])
+        self.assertEqual('/tmp/Beatles, The/Yesterday.flac',
+                         contents.get_filename(contents[0]['key']))
+    def test_cache(self):
+        """
+        Verify that the parsed library is saved and used on startup, and
+        reloaded once the Rhythmbox DB changes.
+        """
+        tempdir = tempfile.mkdtemp()
+        paths = (rhythmbox.RB_DBFILE, rhythmbox.RB_PLAYLISTFILE,
+                 rhythmbox.RB_CACHEFILE)
+        db_path = os.path.join(tempdir, 'rhythmdb.xml')
+        rhythmbox.RB_DBFILE = db_path
+        rhythmbox.RB_PLAYLISTFILE = os.path.join(tempdir, 'playlists.xml')
+        rhythmbox.RB_CACHEFILE = os.path.join(tempdir, 'cache', 'rhythmbox')
+        read_library = rhythmbox.RhythmboxBackend.read_library
+        try:
+            data = open("testdata/rhythmbox.xml").read()
+            open(db_path, 'w').write(data)
+            library = rhythmbox.RhythmboxBackend().get_library_contents()
+            def fail(self, dbfile):
+                raise AssertionError("The library was parsed again")
+            rhythmbox.RhythmboxBackend.read_library = fail
+            backend = rhythmbox.RhythmboxBackend()
+            self.assertEqual(library, backend.get_library_contents())
+            self.assertEqual([], backend.get_playlists())
+            self.assertFalse(backend.needs_reload())
+            rhythmbox.RhythmboxBackend.read_library = read_library
+            # Remove the first song. Until the backend is reloaded, it
+            # continues to use the saved library.
+            start = data.index('<entry')
+            end = data.index('</entry>') + len('</entry>')
+            open(db_path, 'w').write(data[:start] + data[end:])
+            backend = rhythmbox.RhythmboxBackend()
+            self.assertEqual(library, backend.get_library_contents())
+            self.assertTrue(backend.needs_reload())
+            backend.reload()
+            self.assertFalse(backend.needs_reload())
+            self.assertEqual(library[1:], backend.get_library_contents())
+            backend = rhythmbox.RhythmboxBackend()
+            self.assertEqual(library[1:], backend.get_library_contents())
+        finally:
+            rhythmbox.RhythmboxBackend.read_library = read_library
+            (rhythmbox.RB_DBFILE, rhythmbox.RB_PLAYLISTFILE,
+             rhythmbox.RB_CACHEFILE) = paths
+            shutil.rmtree(tempdir)
+
+class ZeyaHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data = "0123456789" * 10
+        filename = os.path.join(self.tempdir, 'song.raw')
+        open(filename, 'w').write(self.data)
+        # Encoding is the identity transformation, so each stream holds the
+        # contents of the song file.
+        self.saved_encoder = encoders.encoders['ogg']
+        decoders.decoders['raw'] = ("/bin/cat",)
+        encoders.encoders['ogg'] = lambda bitrate: ("/bin/cat",)
+        self.backend = FakeBackend([filename])
+        self.library_loader = library.LibraryLoader(self.backend)
+        self.handler_class = self.make_handler()
+    def tearDown(self):
+        del decoders.decoders['raw']
+        encoders.encoders['ogg'] = self.saved_encoder
+        shutil.rmtree(self.tempdir)
+    def make_handler(self, **kwargs):
+        """
+        Return a request handler class serving self.backend.
+        """
+        resource_basedir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'resources')
+        handler_class = zeya.ZeyaHandler(self.backend, self.library_loader,
+                                         resource_basedir, 64, **kwargs)
+        class QuietHandler(handler_class):
+            def log_message(self, format, *args):
+                pass
+        return QuietHandler
+    def request(self, path, headers={}, handler_class=None):
+        """
+        Send a GET request for path (with the given headers) to a handler,
+        and return the httplib.HTTPResponse, with its body stored in .body.
+        """
+        if handler_class is None:
+            handler_class = self.handler_class
+        client_sock, server_sock = socket.socketpair()
+        def handle():
+            try:
+                handler_class(server_sock, ('127.0.0.1', 1024), None)
+            except ValueError:
+                # The handler closes its output when it's done, which newer
+                # versions of BaseHTTPServer don't expect.
+                pass
+            server_sock.close()
+        thread = threading.Thread(target=handle)
+        thread.start()
+        client_sock.sendall(self.format_request(path, headers))
+        response = httplib.HTTPResponse(client_sock)
+        response.begin()
+        response.body = response.read()
+        thread.join()
+        # httplib doesn't read the body of some responses (such as 304), so
+        # collect anything else the handler sent too.
+        response.body += client_sock.makefile('rb').read()
+        client_sock.close()
+        return response
+    def format_request(self, path, headers):
+        return ("GET %s HTTP/1.0\r\n" % (path,)
+                + "".join(["%s: %s\r\n" % item for item in headers.items()])
+                + "\r\n")
+    def test_complete_file(self):
+        """
+        Test serving a buffered stream without a Range header.
+        """
+        response = self.request('/getcontent?key=0&buffered=true')
+        self.assertEqual(200, response.status)
+        self.assertEqual('100', response.getheader('Content-Length'))
+        self.assertEqual('bytes', response.getheader('Accept-Ranges'))
+        self.assertEqual(self.data, response.body)
+    def test_byte_range(self):
+        """
+        Test serving part of a buffered stream.
+        """
+        response = self.request('/getcontent?key=0&buffered=true',
+                                {'Range': 'bytes=10-19'})
+        self.assertEqual(206, response.status)
+        self.assertEqual('bytes 10-19/100',
+                         response.getheader('Content-Range'))
+        self.assertEqual('10', response.getheader('Content-Length'))
+        self.assertEqual(self.data[10:20], response.body)
+    def test_open_ended_range(self):
+        """
+        Test serving the end of a buffered stream, from a given offset.
+        """
+        response = self.request('/getcontent?key=0&buffered=true',
+                                {'Range': 'bytes=95-'})
+        self.assertEqual(206, response.status)
+        self.assertEqual('bytes 95-99/100',
+                         response.getheader('Content-Range'))
+        self.assertEqual(self.data[95:], response.body)
+    def test_suffix_range(self):
+        """
+        Test serving the last few bytes of a buffered stream.
+        """
+        response = self.request('/getcontent?key=0&buffered=true',
+                                {'Range': 'bytes=-5'})
+        self.assertEqual(206, response.status)
+        self.assertEqual('bytes 95-99/100',
+                         response.getheader('Content-Range'))
+        self.assertEqual(self.data[-5:], response.body)
+    def test_whole_range(self):
+        """
+        Test that a range covering the whole stream is served as a complete
+        response, and that a malformed one is ignored.
+        """
+        for range_header in ['bytes=0-', 'bytes=0-1000', 'bytes=5-1']:
+            response = self.request('/getcontent?key=0&buffered=true',
+                                    {'Range': range_header})
+            self.assertEqual(200, response.status)
+            self.assertEqual(None, response.getheader('Content-Range'))
+            self.assertEqual(self.data, response.body)
+    def test_unsatisfiable_range(self):
+        """
+        Test that a range beyond the end of the stream is rejected.
+        """
+        response = self.request('/getcontent?key=0&buffered=true',
+                                {'Range': 'bytes=500-'})
+        self.assertEqual(416, response.status)
+        self.assertEqual('bytes */100', response.getheader('Content-Range'))
+        self.assertEqual('', response.body)
+    def test_start(self):
+        """
+        Test serving a stream that begins partway into the song.
+        """
+        # 0.2 ms of audio is 35 bytes of decoder output, which is rounded
+        # down to a whole sample frame.
+        response = self.request('/getcontent?key=0&start=0.0002')
+        self.assertEqual(200, response.status)
+        self.assertEqual(self.data[32:], response.body)
+    def test_busy(self):
+        """
+        Test that a request that can't get an encoder in time is told to try
+        again later.
+        """
+        slots = backends.TranscodeSlots(1, 0.1)
+        self.backend.set_transcode_slots(slots)
+        slot = slots.acquire('x')
+        response = self.request('/getcontent?key=0')
+        self.assertEqual(503, response.status)
+        self.assertEqual('1', response.getheader('Retry-After'))
+        self.assertEqual('', response.body)
+        slot.release()
+        response = self.request('/getcontent?key=0')
+        self.assertEqual(200, response.status)
+        self.assertEqual(self.data, response.body)
+    def test_prefetch_bitrate(self):
+        """
+        Test that a prefetched stream is served at the bitrate it was
+        prefetched at, unless the client asks for another one.
+        """
+        bitrates = []
+        def encode_command(bitrate):
+            if bitrate:
+                bitrates.append(bitrate)
+            return ("/bin/cat",)
+        encoders.encoders['ogg'] = encode_command
+        self.backend.set_prefetcher(backends.Prefetcher())
+        handler_class = self.make_handler(adaptive_bitrate=True)
+        response = self.request('/prefetch?key=0&bitrate=32',
+                                handler_class=handler_class)
+        self.assertEqual(204, response.status)
+        response = self.request('/getcontent?key=0',
+                                handler_class=handler_class)
+        self.assertEqual(self.data, response.body)
+        self.assertEqual([32], bitrates)
+        response = self.request('/prefetch?key=0&bitrate=32',
+                                handler_class=handler_class)
+        response = self.request('/getcontent?key=0&bitrate=128',
+                                handler_class=handler_class)
+        self.assertEqual(self.data, response.body)
+        self.assertEqual([32, 32, 128], bitrates)
+    def test_prefetch_session(self):
+        """
+        Test that clients at the same address don't get each other's
+        prefetches if they identify themselves with a session argument.
+        """
+        bitrates = []
+        def encode_command(bitrate):
+            if bitrate:
+                bitrates.append(bitrate)
+            return ("/bin/cat",)
+        encoders.encoders['ogg'] = encode_command
+        self.backend.set_prefetcher(backends.Prefetcher())
+        response = self.request('/prefetch?session=a&key=0&bitrate=32')
+        self.assertEqual(204, response.status)
+        response = self.request('/getcontent?session=b&key=0&bitrate=32')
+        self.assertEqual(self.data, response.body)
+        self.assertEqual([32, 32], bitrates)
+        response = self.request('/getcontent?session=a&key=0')
+        self.assertEqual(self.data, response.body)
+        self.assertEqual([32, 32], bitrates)
+    def test_resource_not_modified(self):
+        """
+        Test that a static resource isn't sent again to a client that has
+        the current version, in the encoding it asked for.
+        """
+        response = self.request('/zeya.css')
+        self.assertEqual(200, response.status)
+        etag = response.getheader('ETag')
+        response = self.request('/zeya.css', {'If-None-Match': etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual(etag, response.getheader('ETag'))
+        self.assertEqual('', response.body)
+        response = self.request('/zeya.css', {'If-None-Match': etag,
+                                              'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response.status)
+        self.assertEqual('gzip', response.getheader('Content-Encoding'))
+        gzip_etag = response.getheader('ETag')
+        self.assertNotEqual(etag, gzip_etag)
+        response = self.request('/zeya.css', {'If-None-Match': gzip_etag,
+                                              'Accept-Encoding': 'gzip'})
+        self.assertEqual(304, response.status)
+        self.assertEqual('', response.body)
+    def test_library_not_modified(self):
+        """
+        Test that the library isn't sent again to a client that has the
+        current version, and is sent once it changes.
+        """
+        response = self.request('/getlibrary')
+        self.assertEqual(200, response.status)
+        etag = response.getheader('ETag')
+        response = self.request('/getlibrary', {'If-None-Match': etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual('', response.body)
+        filename = os.path.join(self.tempdir, 'other.raw')
+        open(filename, 'w').write(self.data)
+        self.backend.filenames.append(filename)
+        self.library_loader.reload()
+        response = self.request('/getlibrary', {'If-None-Match': etag})
+        self.assertEqual(200, response.status)
+        self.assertNotEqual(etag, response.getheader('ETag'))
+        self.assertTrue('other.raw' in response.body)
+
+class StringSocket():
+    """
+    Stand-in for a socket from which httplib reads a response that has been
+    received already.
+    """
+    def __init__(self, data):
+        self.data = data
+    def makefile(self, *args):
+        return StringIO.StringIO(self.data)
+
+class AsyncServerTest(ZeyaHandlerTest):
+    """
+    Runs the request handler tests against the asyncore server, which serves
+    streams itself, as well as tests of its own.
+    """
+    def setUp(self):
+        ZeyaHandlerTest.setUp(self)
+        # Map from each handler class to the AsyncHTTPServer using it.
+        self.servers = {}
+    def tearDown(self):
+        for server in self.servers.values():
+            server.server_close()
+        ZeyaHandlerTest.tearDown(self)
+    def get_server(self, handler_class=None):
+        if handler_class is None:
+            handler_class = self.handler_class
+        if handler_class not in self.servers:
+            self.servers[handler_class] = AsyncHTTPServer(
+                ('127.0.0.1', 0), handler_class, self.backend, 64)
+        return self.servers[handler_class]
+    def connect(self, server, path, headers={}):
+        """
+        Send a GET request for path to the server over a new connection, and
+        return the client's end of it.
+        """
+        client_sock, server_sock = socket.socketpair()
+        HTTPChannel(server_sock, ('127.0.0.1', 1024), server)
+        client_sock.sendall(self.format_request(path, headers))
+        client_sock.setblocking(0)
+        return client_sock
+    def poll_until(self, server, condition):
+        """
+        Run the server's event loop until condition() returns True.
+        """
+        deadline = time.time() + 10
+        while not condition():
+            if time.time() > deadline:
+                self.fail("timed out waiting for the server")
+            server.poll(0.01)
+    def request(self, path, headers={}, handler_class=None):
+        server = self.get_server(handler_class)
+        client_sock = self.connect(server, path, headers)
+        received = []
+        def receive():
+            try:
+                data = client_sock.recv(65536)
+            except socket.error, e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                return False
+            received.append(data)
+            return not data
+        self.poll_until(server, receive)
+        client_sock.close()
+        data = "".join(received)
+        response = httplib.HTTPResponse(StringSocket(data))
+        response.begin()
+        response.body = data[data.index("\r\n\r\n") + 4:]
+        return response
+    def test_disconnect(self):
+        """
+        Test that clients that disconnect while waiting for an encoder, or
+        while receiving a stream, give it up.
+        """
+        # The decoder blocks reading from the pipe until it's stopped.
+        fifo = os.path.join(self.tempdir, 'fifo.raw')
+        os.mkfifo(fifo)
+        self.backend.filenames.append(fifo)
+        slots = backends.TranscodeSlots(1, 10)
+        self.backend.set_transcode_slots(slots)
+        server = self.get_server()
+        streaming_sock = self.connect(server, '/getcontent?key=1')
+        def get_transcode():
+            for transcode_id, transcode in backends.active_transcodes.items():
+                if transcode_id[0] == fifo:
+                    return transcode
+        self.poll_until(server, get_transcode)
+        transcode = get_transcode()
+        waiting_sock = self.connect(server, '/getcontent?key=0')
+        self.poll_until(server, lambda: slots._waiters)
+        # The encoders have copies of the client sockets, so shut them down
+        # rather than just closing them.
+        waiting_sock.shutdown(socket.SHUT_RDWR)
+        self.poll_until(server, lambda: not slots._waiters)
+        self.assertFalse(transcode.finished)
+        streaming_sock.shutdown(socket.SHUT_RDWR)
+        self.poll_until(server, lambda: transcode.finished)
+        self.assertEqual(0, transcode.readers)
+        self.assertNotEqual(None, slots.try_acquire('x'))
+    def test_reap(self):
+        """
+        Test that the server waits for processes to exit without blocking
+        its event loop, and reports whether they succeeded.
+        """
+        server = self.get_server()
+        results = []
+        processes = [subprocess.Popen(["sleep", "0.2"]),
+                     subprocess.Popen(["true"])]
+        server.reap(processes, results.append)
+        self.assertEqual([], results)
+        self.poll_until(server, lambda: results)
+        self.assertEqual([True], results)
+        server.reap([subprocess.Popen(["false"])], results.append)
+        self.poll_until(server, lambda: len(results) == 2)
+        self.assertEqual([True, False], results)
 
 if __name__ == "__main__":
     unittest.main()